@@ -8,6 +8,7 @@ import tempfile
 import schedule
 import time
 from dotenv import load_dotenv
+import feishu_token
 
 # 加载环境变量
 load_dotenv()
@@ -163,42 +164,43 @@ async def capture_grafana_screenshot():
         logger.error(traceback.format_exc())
         return None
 async def get_tenant_access_token():
-    url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
-    payload = {"app_id": APP_ID, "app_secret": APP_SECRET}
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(url, json=payload)
-        resp.raise_for_status()
-        data = resp.json()
-        if data.get("code", 0) == 0:
-            return data["tenant_access_token"]
-        else:
-            logger.error(f"获取tenant_access_token失败: {data}")
-            return None
+    # 进程内缓存，过期前后台刷新，并发调用只请求一次
+    return await feishu_token.get_tenant_access_token_async(APP_ID, APP_SECRET)
 async def upload_image_to_feishu(file_path):
-    tenant_access_token = await get_tenant_access_token()
-    if not tenant_access_token:
-        logger.error("无法获取tenant_access_token，图片上传中止")
-        return None
     url = "https://open.feishu.cn/open-apis/im/v1/images"
-    headers = {"Authorization": f"Bearer {tenant_access_token}"}
-    try:
-        with open(file_path, "rb") as f:
-            files = {"image": (os.path.basename(file_path), f, "image/png")}
-            form_data = {"image_type": "message"}
-            async with httpx.AsyncClient() as client:
-                resp = await client.post(url, headers=headers, data=form_data, files=files)
-                resp.raise_for_status()
-                data = resp.json()
-                if data.get("code", 0) == 0:
-                    image_key = data["data"]["image_key"]
-                    logger.info(f"图片上传成功，image_key: {image_key}")
-                    return image_key
-                else:
-                    logger.error(f"图片上传失败: {data}")
-                    return None
-    except Exception as e:
-        logger.error(f"上传图片到飞书失败: {str(e)}")
-        return None
+    # token 失效时丢弃缓存的 token，重新获取后再试一次
+    for attempt in range(2):
+        tenant_access_token = await get_tenant_access_token()
+        if not tenant_access_token:
+            logger.error("无法获取tenant_access_token，图片上传中止")
+            return None
+        headers = {"Authorization": f"Bearer {tenant_access_token}"}
+        try:
+            with open(file_path, "rb") as f:
+                files = {"image": (os.path.basename(file_path), f, "image/png")}
+                form_data = {"image_type": "message"}
+                async with httpx.AsyncClient() as client:
+                    resp = await client.post(url, headers=headers, data=form_data, files=files)
+                    try:
+                        data = resp.json()
+                    except ValueError:
+                        data = {}
+                    if data.get("code") in feishu_token.TOKEN_INVALID_CODES and attempt == 0:
+                        logger.warning(f"tenant_access_token 已失效，重新获取后重试: {data.get('msg')}")
+                        feishu_token.invalidate_tenant_access_token(APP_ID, APP_SECRET, tenant_access_token)
+                        continue
+                    resp.raise_for_status()
+                    if data.get("code", 0) == 0:
+                        image_key = data["data"]["image_key"]
+                        logger.info(f"图片上传成功，image_key: {image_key}")
+                        return image_key
+                    else:
+                        logger.error(f"图片上传失败: {data}")
+                        return None
+        except Exception as e:
+            logger.error(f"上传图片到飞书失败: {str(e)}")
+            return None
+    return None
 async def send_feishu_message():
     screenshot_key = await capture_grafana_screenshot()
     card_data = build_card_data(screenshot_key)
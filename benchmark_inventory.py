@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GPU 库存查询基准测试
+在本地 Grafana 替身（grafana_stub_server.py）上测量：
+  1. 解析吞吐：Grafana 响应 -> GrafanaFrame / 字典列表
+  2. 聚合耗时：库存立方体构建与各类汇总
+  3. 端到端延迟：get_gpu_inventory_by_type 冷 / 热缓存，同步 / 异步
+
+用法:
+    python benchmark_inventory.py
+    python benchmark_inventory.py --sizes 10,1000,100000 --latency 0.05 --save baseline.json
+    python benchmark_inventory.py --compare baseline.json --tolerance 0.25   # 变慢超过 25% 时退出码为 1
+
+跑完后检查 /metrics 输出中有 grafana_request_duration_seconds，缺少时退出码同样为 1。
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List
+
+import gpu_inventory
+from grafana_stub_server import GrafanaStubServer
+from metrics import render_metrics
+
+
+def _percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    index = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def _measure(func: Callable[[], object], repeat: int, setup: Callable[[], object] = None) -> List[float]:
+    """执行 repeat 次，返回每次的耗时（秒）；setup 不计入耗时"""
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+class BenchmarkReport:
+    """基准结果：名称 -> 耗时中位数（秒）"""
+
+    def __init__(self):
+        self.results: Dict[str, Dict] = {}
+
+    def add(self, name: str, samples: List[float], rows: int = None):
+        result = {
+            "median": statistics.median(samples),
+            "p95": _percentile(samples, 0.95),
+            "runs": len(samples),
+        }
+        if rows:
+            result["rows_per_sec"] = rows / result["median"] if result["median"] > 0 else None
+        self.results[name] = result
+        throughput = f"  {result['rows_per_sec']:>12,.0f} 行/秒" if result.get("rows_per_sec") else ""
+        print(f"  {name:<44} {result['median'] * 1000:>10.3f} ms  p95 {result['p95'] * 1000:>10.3f} ms{throughput}")
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.results, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {path}")
+
+    def compare(self, path: str, tolerance: float) -> List[str]:
+        """与基线比较，返回变慢超过 tolerance 的项"""
+        with open(path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = []
+        print(f"\n与基线 {path} 比较（容差 {tolerance:.0%}）:")
+        for name, result in self.results.items():
+            base = baseline.get(name)
+            if not base or not base.get("median"):
+                continue
+            ratio = result["median"] / base["median"]
+            mark = "❌" if ratio > 1 + tolerance else "✅"
+            print(f"  {mark} {name:<44} {ratio:>6.2f}x")
+            if ratio > 1 + tolerance:
+                regressions.append(name)
+        return regressions
+
+
+def bench_parse(stub: GrafanaStubServer, report: BenchmarkReport, sizes: List[int], repeat: int):
+    """解析吞吐（不含网络）与 query_grafana 全流程（零延迟）"""
+    print("\n[1] 解析吞吐")
+    stub.latency = 0.0
+    sql = gpu_inventory.INVENTORY_SNAPSHOT_SQL
+    for rows in sizes:
+        stub.rows = rows
+        body = stub.response_body([{"refId": "A", "rawSql": sql}])
+
+        def parse():
+            frames, _ = gpu_inventory._parse_grafana_response(json.loads(body), ["A"])
+            return frames["A"]
+
+        report.add(f"parse_frame[{rows}]", _measure(parse, repeat), rows)
+        report.add(f"parse_dicts[{rows}]", _measure(lambda: parse().to_dicts(), repeat), rows)
+        report.add(f"query_grafana_frame[{rows}]", _measure(lambda: gpu_inventory.query_grafana_frame(sql), repeat), rows)
+        report.add(f"query_grafana[{rows}]", _measure(lambda: gpu_inventory.query_grafana(sql), repeat), rows)
+
+
+def bench_aggregate(stub: GrafanaStubServer, report: BenchmarkReport, sizes: List[int], repeat: int):
+    """库存立方体构建与汇总"""
+    print("\n[2] 聚合耗时")
+    stub.latency = 0.0
+    for rows in sizes:
+        stub.rows = rows
+        frame = gpu_inventory.query_grafana_frame(gpu_inventory.INVENTORY_SNAPSHOT_SQL)
+        cube_holder = {}
+
+        def build():
+            cube_holder["cube"] = gpu_inventory.InventoryCube(frame)
+
+        report.add(f"cube_build[{rows}]", _measure(build, repeat), rows)
+        # 每次使用新立方体，避免命中立方体内的结果缓存
+        report.add(f"summarize_all[{rows}]",
+                   _measure(lambda: cube_holder["cube"].summarize_all(), repeat, setup=build))
+        report.add(f"summarize_type[{rows}]",
+                   _measure(lambda: cube_holder["cube"].summarize_type("4090", "国内", False), repeat, setup=build))
+        report.add(f"by_idc[{rows}]",
+                   _measure(lambda: cube_holder["cube"].by_idc("4090"), repeat, setup=build))
+
+
+def bench_end_to_end(stub: GrafanaStubServer, report: BenchmarkReport, rows: int, latency: float, repeat: int):
+    """端到端：冷缓存（每次重新查询）与热缓存"""
+    print(f"\n[3] 端到端延迟（{rows} 行，替身延迟 {latency * 1000:.0f} ms）")
+    stub.rows = rows
+    stub.latency = latency
+    query = lambda: gpu_inventory.get_gpu_inventory_by_type("4090")
+
+    report.add(f"e2e_cold[{rows}]", _measure(query, repeat, setup=gpu_inventory.invalidate_inventory_cache))
+    query()
+    report.add(f"e2e_warm[{rows}]", _measure(query, repeat))
+
+    async def run_async():
+        samples = []
+        for _ in range(repeat):
+            gpu_inventory.invalidate_inventory_cache()
+            started = time.perf_counter()
+            await gpu_inventory.get_gpu_inventory_by_type_async("4090")
+            samples.append(time.perf_counter() - started)
+        await gpu_inventory.close_grafana_async_client()
+        return samples
+
+    report.add(f"e2e_cold_async[{rows}]", asyncio.run(run_async()))
+
+
+def check_metrics() -> bool:
+    """跑完基准后 /metrics 输出中应有 Grafana 请求耗时的样本"""
+    ok = "grafana_request_duration_seconds_count{" in render_metrics()
+    print(f"\n{'✅' if ok else '❌'} /metrics 输出{'包含' if ok else '缺少'} grafana_request_duration_seconds")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GPU 库存查询基准测试")
+    parser.add_argument("--sizes", default="10,1000,10000,100000", help="数据帧行数，逗号分隔")
+    parser.add_argument("--repeat", type=int, default=5, help="每项重复次数")
+    parser.add_argument("--latency", type=float, default=0.05, help="端到端测试时替身的延迟（秒）")
+    parser.add_argument("--e2e-rows", type=int, default=1000, help="端到端测试的行数")
+    parser.add_argument("--replay", help="使用录制的 Grafana 响应代替合成数据")
+    parser.add_argument("--save", help="保存结果到 JSON 文件")
+    parser.add_argument("--compare", help="与基线 JSON 比较")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="允许的变慢比例")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    replay = None
+    if args.replay:
+        with open(args.replay, "r", encoding="utf-8") as f:
+            replay = json.load(f)
+
+    stub = GrafanaStubServer(port=0, replay=replay).start()
+    # 指向替身（gpu_inventory 在调用时读取这两个配置）
+    gpu_inventory.GRAFANA_URL = stub.url
+    gpu_inventory.GRAFANA_API_KEY = gpu_inventory.GRAFANA_API_KEY or "stub"
+
+    print("=" * 60)
+    print(f"GPU 库存查询基准测试（Grafana 替身: {stub.url}）")
+    print("=" * 60)
+
+    report = BenchmarkReport()
+    try:
+        bench_parse(stub, report, sizes, args.repeat)
+        bench_aggregate(stub, report, sizes, args.repeat)
+        bench_end_to_end(stub, report, args.e2e_rows, args.latency, args.repeat)
+    finally:
+        gpu_inventory.close_grafana_session()
+        stub.stop()
+
+    metrics_ok = check_metrics()
+    if args.save:
+        report.save(args.save)
+    if args.compare:
+        regressions = report.compare(args.compare, args.tolerance)
+        if regressions:
+            print(f"\n❌ {len(regressions)} 项变慢: {', '.join(regressions)}")
+            sys.exit(1)
+        print("\n✅ 没有发现性能回退")
+    if not metrics_ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""
+飞书消息并发投递
+同一条消息发给多个接收人时，用有界线程池并发发送，每秒和每分钟两个令牌桶限制整个应用的发送速率
+（飞书 im/v1/messages 接口按应用限频 50 次/秒、1000 次/分钟）；
+失败的接收人按退避间隔单独重试，成功的不会重复发送，最后返回每个接收人的结果
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# 发送速率（次/秒）与突发上限
+FEISHU_SEND_RATE = float(os.getenv("FEISHU_SEND_RATE", "50"))
+FEISHU_SEND_BURST = int(os.getenv("FEISHU_SEND_BURST", "0")) or max(int(FEISHU_SEND_RATE), 1)
+
+# 每分钟发送上限（按 上限/60 次/秒 补充，最多积累一分钟的额度）
+FEISHU_SEND_RATE_PER_MINUTE = float(os.getenv("FEISHU_SEND_RATE_PER_MINUTE", "1000"))
+
+# 并发线程数
+FEISHU_SEND_WORKERS = int(os.getenv("FEISHU_SEND_WORKERS", "8"))
+
+# 失败接收人的重试轮数与首轮退避（秒），之后每轮翻倍
+FEISHU_SEND_RETRIES = int(os.getenv("FEISHU_SEND_RETRIES", "2"))
+FEISHU_SEND_RETRY_BACKOFF = float(os.getenv("FEISHU_SEND_RETRY_BACKOFF", "1"))
+
+# 可以重试的飞书错误码：应用触发频率限制、消息接口触发频率限制
+RETRYABLE_CODES = (99991400, 230020)
+
+
+# 飞书 receive_id_type
+RECEIVE_ID_TYPES = ("open_id", "user_id", "union_id", "chat_id", "email")
+
+# ID 前缀 -> receive_id_type（open_id / chat_id / union_id 由飞书生成，前缀固定）
+RECEIVE_ID_PREFIXES = {"ou_": "open_id", "oc_": "chat_id", "on_": "union_id"}
+
+
+def parse_recipient(recipient: str) -> Tuple[str, Optional[str]]:
+    """
+    解析接收人，返回 (receive_id, receive_id_type)，类型无法确定时为 None
+
+    支持显式写法 "user_id:abc123"；否则按前缀（ou_ / oc_ / on_）和邮箱格式推断。
+    """
+    recipient = recipient.strip()
+    id_type, sep, receive_id = recipient.partition(":")
+    if sep and id_type in RECEIVE_ID_TYPES:
+        return receive_id, id_type
+    for prefix, id_type in RECEIVE_ID_PREFIXES.items():
+        if recipient.startswith(prefix):
+            return recipient, id_type
+    if "@" in recipient:
+        return recipient, "email"
+    return recipient, None
+
+
+class ReceiveIdTypeCache:
+    """
+    接收人 -> 已确认可用的 receive_id_type（JSON 文件持久化）
+
+    无法从 ID 推断类型的接收人第一次发送时需要逐个尝试，成功后记住，之后每次只需一次请求。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._types: Optional[Dict[str, str]] = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, str]:
+        """需持有 _lock"""
+        if self._types is None:
+            self._types = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        self._types = {k: v for k, v in json.load(f).items() if v in RECEIVE_ID_TYPES}
+                except Exception as e:
+                    logger.warning(f"读取 receive_id_type 缓存失败: {e}")
+        return self._types
+
+    def get(self, receive_id: str) -> Optional[str]:
+        with self._lock:
+            return self._load().get(receive_id)
+
+    def remember(self, receive_id: str, id_type: str):
+        with self._lock:
+            types = self._load()
+            if types.get(receive_id) != id_type:
+                types[receive_id] = id_type
+                self._dirty = True
+
+    def forget(self, receive_id: str):
+        with self._lock:
+            if self._load().pop(receive_id, None) is not None:
+                self._dirty = True
+
+    def save(self):
+        """有变化时写回文件"""
+        with self._lock:
+            if not self._dirty:
+                return
+            types = dict(self._types or {})
+            self._dirty = False
+        try:
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(types, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.warning(f"保存 receive_id_type 缓存失败: {e}")
+
+
+class TokenBucket:
+    """
+    令牌桶限速器（线程安全）
+
+    以 rate 个/秒的速度补充令牌，最多积累 capacity 个；acquire() 在令牌不足时等待。
+    """
+
+    def __init__(self, rate: float, capacity: Optional[int] = None):
+        self.rate = rate
+        self.capacity = capacity or max(int(rate), 1)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """有足够令牌时立即取走并返回 True，否则返回 False"""
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1, timeout: Optional[float] = None) -> bool:
+        """取令牌，不足时等待；timeout 秒内没取到返回 False"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def release(self, tokens: float = 1):
+        """退还取走的令牌"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + tokens)
+
+
+class CombinedLimiter:
+    """
+    多个令牌桶同时限速（如每秒 + 每分钟），每次要从每个桶各取一个令牌
+
+    按传入顺序取令牌，没取全时退还已取的；把最慢的桶放在前面，等待它时不会占着其他桶的令牌。
+    """
+
+    def __init__(self, *buckets: TokenBucket):
+        self.buckets = buckets
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        taken = []
+        for bucket in self.buckets:
+            if not bucket.try_acquire(tokens):
+                for held in taken:
+                    held.release(tokens)
+                return False
+            taken.append(bucket)
+        return True
+
+    def acquire(self, tokens: float = 1, timeout: Optional[float] = None) -> bool:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        taken = []
+        for bucket in self.buckets:
+            remaining = max(deadline - time.monotonic(), 0) if deadline is not None else None
+            if not bucket.acquire(tokens, remaining):
+                for held in taken:
+                    held.release(tokens)
+                return False
+            taken.append(bucket)
+        return True
+
+
+# 进程内共享的发送限速器（同一应用的所有发送共用）：每分钟上限 + 每秒上限
+feishu_send_limiter = CombinedLimiter(
+    TokenBucket(FEISHU_SEND_RATE_PER_MINUTE / 60, max(int(FEISHU_SEND_RATE_PER_MINUTE), 1)),
+    TokenBucket(FEISHU_SEND_RATE, FEISHU_SEND_BURST),
+)
+
+
+class SendOutcome(NamedTuple):
+    """单次发送的结果"""
+    ok: bool
+    code: Optional[int] = None        # 飞书返回的 code（HTTP 错误时为状态码）
+    error: Optional[str] = None
+    retryable: bool = False           # 失败是否值得重试（限频、网络、服务端错误）
+
+
+class DeliveryResult(NamedTuple):
+    """单个接收人的最终结果"""
+    recipient: str
+    ok: bool
+    attempts: int
+    code: Optional[int] = None
+    error: Optional[str] = None
+    elapsed: float = 0.0              # 从开始投递到最后一次尝试结束（秒）
+
+
+class DeliveryReport:
+    """一次投递的全部结果"""
+
+    def __init__(self, results: List[DeliveryResult], elapsed: float):
+        self.results = results
+        self.elapsed = elapsed
+
+    @property
+    def succeeded(self) -> List[DeliveryResult]:
+        return [result for result in self.results if result.ok]
+
+    @property
+    def failed(self) -> List[DeliveryResult]:
+        return [result for result in self.results if not result.ok]
+
+    @property
+    def all_ok(self) -> bool:
+        return all(result.ok for result in self.results)
+
+    def summary(self) -> Dict:
+        return {
+            "recipients": len(self.results),
+            "succeeded": len(self.succeeded),
+            "failed": len(self.failed),
+            "attempts": sum(result.attempts for result in self.results),
+            "elapsed": round(self.elapsed, 3),
+        }
+
+
+def is_retryable(code: Optional[int] = None, status: Optional[int] = None) -> bool:
+    """根据飞书 code 或 HTTP 状态码判断失败是否可以重试"""
+    if status is not None and (status == 429 or status >= 500):
+        return True
+    return code in RETRYABLE_CODES
+
+
+def deliver(
+    recipients: Iterable[str],
+    send: Callable[[str], SendOutcome],
+    max_workers: int = FEISHU_SEND_WORKERS,
+    retries: int = FEISHU_SEND_RETRIES,
+    backoff: float = FEISHU_SEND_RETRY_BACKOFF,
+    limiter: Optional[Union[TokenBucket, CombinedLimiter]] = feishu_send_limiter
+) -> DeliveryReport:
+    """
+    并发发送给多个接收人
+
+    每次调用 send 前从 limiter 取一个令牌；send 抛出的异常视为可重试的失败。
+    第一轮全部发送后，只把可重试的失败接收人放入下一轮，每轮前等待 backoff * 2^(轮次-1) 秒。
+
+    Args:
+        recipients: 接收人（重复的只发一次）
+        send: 发送函数，参数为接收人，返回 SendOutcome
+        max_workers: 并发线程数
+        retries: 最多重试轮数
+        backoff: 首轮重试前的等待（秒）
+        limiter: 限速器，None 表示不限速
+    """
+    pending = list(dict.fromkeys(recipients))
+    started = time.monotonic()
+    attempts: Dict[str, int] = {recipient: 0 for recipient in pending}
+    results: Dict[str, DeliveryResult] = {}
+
+    def attempt(recipient: str):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            outcome = send(recipient)
+        except Exception as e:
+            outcome = SendOutcome(False, error=str(e), retryable=True)
+        return outcome, time.monotonic() - started
+
+    if not pending:
+        return DeliveryReport([], 0.0)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pending))),
+                            thread_name_prefix="feishu-send") as executor:
+        for round_index in range(retries + 1):
+            if round_index:
+                time.sleep(backoff * 2 ** (round_index - 1))
+            outcomes = list(executor.map(attempt, pending))
+            retry = []
+            for recipient, (outcome, elapsed) in zip(pending, outcomes):
+                attempts[recipient] += 1
+                results[recipient] = DeliveryResult(
+                    recipient, outcome.ok, attempts[recipient], outcome.code, outcome.error, elapsed
+                )
+                if not outcome.ok and outcome.retryable:
+                    retry.append(recipient)
+            if not retry:
+                break
+            if round_index < retries:
+                logger.warning(f"{len(retry)} 个接收人发送失败，{backoff * 2 ** round_index:.1f} 秒后重试")
+            pending = retry
+
+    ordered = [results[recipient] for recipient in attempts]
+    return DeliveryReport(ordered, time.monotonic() - started)
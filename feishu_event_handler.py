@@ -12,9 +12,11 @@ import hmac
 import hashlib
 import base64
 from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from typing import Dict, Any, Optional
 import Instance
+import feishu_token
+from metrics import CONTENT_TYPE, render_metrics
 
 # 配置日志
 logging.basicConfig(
@@ -70,28 +72,25 @@ def verify_signature(timestamp: str, nonce: str, body: str, signature: str) -> b
 
 def get_tenant_access_token() -> Optional[str]:
     """
-    获取飞书 tenant_access_token
+    获取飞书 tenant_access_token（进程内缓存，过期前后台刷新）
+    
+    飞书返回 feishu_token.TOKEN_INVALID_CODES 时先调用 invalidate_tenant_access_token(token)，
+    再重新获取并重试一次（发送到群的消息由 Instance.send_feishu_message 完成，已按此处理）
     
     Returns:
         str: tenant_access_token
     """
-    import httpx
-    url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
-    payload = {"app_id": APP_ID, "app_secret": APP_SECRET}
+    return feishu_token.get_tenant_access_token(APP_ID, APP_SECRET)
+
+
+def invalidate_tenant_access_token(token: Optional[str] = None):
+    """
+    丢弃缓存的 tenant_access_token
     
-    try:
-        with httpx.Client() as client:
-            resp = client.post(url, json=payload, timeout=10)
-            resp.raise_for_status()
-            data = resp.json()
-            if data.get("code", 0) == 0:
-                return data["tenant_access_token"]
-            else:
-                logger.error(f"获取tenant_access_token失败: {data}")
-                return None
-    except Exception as e:
-        logger.error(f"获取tenant_access_token异常: {str(e)}")
-        return None
+    Args:
+        token: 失效的 token，只有它仍是当前缓存的 token 时才丢弃
+    """
+    feishu_token.invalidate_tenant_access_token(APP_ID, APP_SECRET, token)
 
 
 def is_bot_mentioned(event_data: Dict) -> bool:
@@ -261,6 +260,12 @@ def health():
     }), 200
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus 指标"""
+    return Response(render_metrics(), status=200, headers={"Content-Type": CONTENT_TYPE})
+
+
 @app.route('/', methods=['GET'])
 def index():
     """首页"""
@@ -269,7 +274,8 @@ def index():
         "version": "1.0.0",
         "endpoints": {
             "/feishu/event": "飞书事件回调端点",
-            "/health": "健康检查"
+            "/health": "健康检查",
+            "/metrics": "Prometheus 指标"
         }
     }), 200
 
@@ -281,6 +287,7 @@ if __name__ == '__main__':
     logger.info("服务端点:")
     logger.info("  - POST /feishu/event : 飞书事件回调")
     logger.info("  - GET  /health       : 健康检查")
+    logger.info("  - GET  /metrics      : Prometheus 指标")
     logger.info("=" * 60)
     logger.info("配置说明:")
     logger.info("  1. 在飞书开放平台配置事件订阅")
@@ -0,0 +1,225 @@
+"""
+飞书 tenant_access_token 进程内缓存
+同一应用在进程内共用一个 token，缓存到过期前 FEISHU_TOKEN_REFRESH_MARGIN 秒；
+过期前在后台提前刷新，调用方几乎总是直接拿到内存中的 token。
+并发调用方共享同一次获取（single-flight），同步和异步入口共用同一份缓存。
+
+用法:
+    token = feishu_token.get_tenant_access_token(APP_ID, APP_SECRET)
+    token = await feishu_token.get_tenant_access_token_async(APP_ID, APP_SECRET)
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+FEISHU_TOKEN_URL = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
+
+# 过期前多少秒视为需要刷新（飞书 token 有效期 2 小时，剩余不足 30 分钟时重新获取会返回新 token）
+FEISHU_TOKEN_REFRESH_MARGIN = float(os.getenv("FEISHU_TOKEN_REFRESH_MARGIN", "300"))
+
+# 获取失败后多少秒内不再重试（仍有未过期的 token 时继续使用它）
+FEISHU_TOKEN_RETRY_INTERVAL = float(os.getenv("FEISHU_TOKEN_RETRY_INTERVAL", "10"))
+
+# 飞书返回的 token 无效 / 过期错误码，调用方遇到时应 invalidate() 后重试
+TOKEN_INVALID_CODES = (99991661, 99991663, 99991668)
+
+
+class TenantTokenProvider:
+    """
+    单个飞书应用的 tenant_access_token 提供者
+
+    - get() / get_async()：缓存有效时直接返回；否则由第一个调用方获取，其余调用方等待并共享结果
+    - 获取成功后安排一次后台刷新（过期前 refresh_margin 秒），长期运行的服务不会在请求路径上等待 token
+    - 获取失败时，如果旧 token 尚未过期则继续返回旧 token，并在 retry_interval 内不再重复请求
+    """
+
+    def __init__(
+        self,
+        app_id: str,
+        app_secret: str,
+        refresh_margin: float = FEISHU_TOKEN_REFRESH_MARGIN,
+        retry_interval: float = FEISHU_TOKEN_RETRY_INTERVAL,
+        timeout: float = 10
+    ):
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+        self._last_attempt = 0.0
+        self._last_error: Optional[str] = None
+        self._fetch_count = 0
+        self._lock = threading.Lock()        # 保护上面的状态
+        self._fetch_lock = threading.Lock()  # 同一时刻只允许一个获取请求
+        self._timer: Optional[threading.Timer] = None
+
+    def _is_fresh(self) -> bool:
+        return self._token is not None and time.time() < self._refresh_at
+
+    def _usable(self) -> Optional[str]:
+        """未过期的 token（可能已进入提前刷新窗口），需持有 _lock"""
+        if self._token is not None and time.time() < self._expires_at:
+            return self._token
+        return None
+
+    def _fetch(self) -> Tuple[Optional[str], float]:
+        """请求飞书获取 token，返回 (token, 有效期秒数)"""
+        payload = {"app_id": self.app_id, "app_secret": self.app_secret}
+        with httpx.Client(timeout=self.timeout) as client:
+            resp = client.post(FEISHU_TOKEN_URL, json=payload)
+            resp.raise_for_status()
+            data = resp.json()
+        if data.get("code", 0) != 0:
+            raise RuntimeError(f"获取tenant_access_token失败: {data}")
+        return data["tenant_access_token"], float(data.get("expire", 7200))
+
+    def _refresh_delay(self, expire: float) -> float:
+        """获取后多久进入刷新窗口：过期前 refresh_margin 秒，有效期很短时取一半"""
+        return max(expire - self.refresh_margin, expire / 2, 1.0)
+
+    def _schedule_refresh(self, delay: float):
+        """delay 秒后在后台刷新"""
+        timer = threading.Timer(delay, self._background_refresh)
+        timer.daemon = True
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = timer
+        timer.start()
+
+    def _background_refresh(self):
+        self.get(force_refresh=True)
+        # get() 失败时仍会返回未过期的旧 token，是否成功要看 _last_error；
+        # 失败时稍后再试，直到旧 token 过期（过期后由下一个调用方获取）
+        with self._lock:
+            failed = self._last_error is not None
+            remaining = self._expires_at - time.time()
+        if failed and remaining > 0:
+            self._schedule_refresh(min(self.retry_interval, remaining))
+
+    def get(self, force_refresh: bool = False) -> Optional[str]:
+        """获取 token，失败且没有未过期的旧 token 时返回 None"""
+        with self._lock:
+            if not force_refresh and self._is_fresh():
+                return self._token
+            fetch_count = self._fetch_count
+
+        with self._fetch_lock:
+            with self._lock:
+                # 等待期间其他调用方已经获取过
+                if self._fetch_count != fetch_count:
+                    return self._token if self._is_fresh() else self._usable()
+                # 刚失败过，不立即重试
+                if not force_refresh and time.time() - self._last_attempt < self.retry_interval and self._last_error:
+                    return self._usable()
+                self._last_attempt = time.time()
+
+            try:
+                token, expire = self._fetch()
+            except Exception as e:
+                logger.error(f"获取tenant_access_token异常: {str(e)}")
+                with self._lock:
+                    self._last_error = str(e)
+                    self._fetch_count += 1
+                    return self._usable()
+
+            with self._lock:
+                self._token = token
+                now = time.time()
+                self._expires_at = now + expire
+                self._refresh_at = now + self._refresh_delay(expire)
+                self._last_error = None
+                self._fetch_count += 1
+        self._schedule_refresh(self._refresh_delay(expire))
+        return token
+
+    async def get_async(self, force_refresh: bool = False) -> Optional[str]:
+        """异步获取 token：缓存有效时直接返回，否则在线程中获取（与同步调用方共享同一次请求）"""
+        with self._lock:
+            if not force_refresh and self._is_fresh():
+                return self._token
+        return await asyncio.to_thread(self.get, force_refresh)
+
+    def invalidate(self, token: Optional[str] = None):
+        """
+        丢弃缓存的 token（飞书返回 TOKEN_INVALID_CODES 时调用）
+
+        传入 token 时只有它仍是当前 token 才丢弃，避免并发调用方丢掉刚刷新的新 token。
+        """
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = self._refresh_at = 0.0
+                self._last_error = None
+
+    def close(self):
+        """取消后台刷新"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def status(self) -> Dict:
+        """缓存状态：是否有 token、剩余有效期、获取次数、最近错误"""
+        with self._lock:
+            return {
+                "has_token": self._token is not None,
+                "expires_in": max(self._expires_at - time.time(), 0) if self._token else None,
+                "fetch_count": self._fetch_count,
+                "last_error": self._last_error,
+            }
+
+
+_providers: Dict[str, TenantTokenProvider] = {}
+_providers_lock = threading.Lock()
+
+
+def get_token_provider(app_id: str = None, app_secret: str = None) -> TenantTokenProvider:
+    """
+    获取应用的 token 提供者（进程内每个 app_id 一个）
+
+    不传参数时使用 FEISHU_APP_ID / FEISHU_APP_SECRET。
+    """
+    app_id = app_id or os.getenv("FEISHU_APP_ID")
+    app_secret = app_secret or os.getenv("FEISHU_APP_SECRET")
+    with _providers_lock:
+        provider = _providers.get(app_id)
+        if provider is None or provider.app_secret != app_secret:
+            if provider is not None:
+                provider.close()
+            provider = _providers[app_id] = TenantTokenProvider(app_id, app_secret)
+        return provider
+
+
+def get_tenant_access_token(app_id: str = None, app_secret: str = None, force_refresh: bool = False) -> Optional[str]:
+    """获取 tenant_access_token（同步）"""
+    return get_token_provider(app_id, app_secret).get(force_refresh)
+
+
+async def get_tenant_access_token_async(
+    app_id: str = None,
+    app_secret: str = None,
+    force_refresh: bool = False
+) -> Optional[str]:
+    """获取 tenant_access_token（异步）"""
+    return await get_token_provider(app_id, app_secret).get_async(force_refresh)
+
+
+def invalidate_tenant_access_token(app_id: str = None, app_secret: str = None, token: str = None):
+    """丢弃缓存的 tenant_access_token"""
+    get_token_provider(app_id, app_secret).invalidate(token)
@@ -3,10 +3,31 @@ GPU 库存查询模块
 通过 Grafana API 查询 GPU 库存数据
 """
 
+import asyncio
+import contextvars
+import csv
+import json
 import os
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+import httpx
+import numpy as np
 import requests
-from typing import Optional, Dict, List, Tuple
+from requests.adapters import HTTPAdapter
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
 from dotenv import load_dotenv
+from gpu_models import GPU_MODELS, lookup_gpu_model, match_gpu_model, short_gpu_name
+from inventory_records import GpuInventory, IdcInventory, to_dicts
+from inventory_sql import InventoryFilter, InventoryQuery, QueryBuilder, make_filter
+from inventory_store import InventoryStore
+from metrics import PARSE_BUCKETS, SIZE_BUCKETS, counter, gauge, histogram, start_metrics_server
 
 # 加载环境变量
 load_dotenv()
@@ -16,37 +37,374 @@ GRAFANA_URL = os.getenv("GRAFANA_URL", "https://grafana.aicloud.paigod.work")
 GRAFANA_API_KEY = os.getenv("GRAFANA_API_KEY")
 GRAFANA_DATASOURCE_UID = os.getenv("GRAFANA_DATASOURCE_UID", "een5ao3qgwyrkc")
 
+# Grafana HTTP 连接池配置
+GRAFANA_POOL_SIZE = int(os.getenv("GRAFANA_POOL_SIZE", "10"))
+GRAFANA_CONNECT_TIMEOUT = float(os.getenv("GRAFANA_CONNECT_TIMEOUT", "5"))
+GRAFANA_READ_TIMEOUT = float(os.getenv("GRAFANA_READ_TIMEOUT", "30"))
+
+# 单次调用的默认时间预算（秒），超出后返回缓存/旧快照，0 表示不限（只受 GRAFANA_READ_TIMEOUT 约束）
+GRAFANA_QUERY_BUDGET = float(os.getenv("GRAFANA_QUERY_BUDGET", "0"))
+
+# 对冲请求：第一个请求超过 p95 延迟仍未返回时再发一个相同请求，取先返回的结果
+GRAFANA_HEDGE = os.getenv("GRAFANA_HEDGE", "false").lower() == "true"
+# 固定的对冲等待时间（秒），为空时使用最近请求的 p95；样本不足时使用 GRAFANA_HEDGE_DEFAULT_DELAY
+GRAFANA_HEDGE_AFTER = float(os.getenv("GRAFANA_HEDGE_AFTER") or 0) or None
+GRAFANA_HEDGE_DEFAULT_DELAY = float(os.getenv("GRAFANA_HEDGE_DEFAULT_DELAY", "1"))
+
+# 飞书机器人问答的调用策略（见 get_gpu_availability）
+INVENTORY_BOT_BUDGET = float(os.getenv("INVENTORY_BOT_BUDGET", "3"))
+INVENTORY_BOT_HEDGE = os.getenv("INVENTORY_BOT_HEDGE", "true").lower() == "true"
+
+# 库存快照缓存有效期（秒），0 表示不缓存
+INVENTORY_CACHE_TTL = float(os.getenv("INVENTORY_CACHE_TTL", "60"))
+
+# 熔断：连续失败 GRAFANA_BREAKER_THRESHOLD 次后熔断，GRAFANA_BREAKER_RESET 秒后放行一次试探请求
+GRAFANA_BREAKER_THRESHOLD = int(os.getenv("GRAFANA_BREAKER_THRESHOLD", "5"))
+GRAFANA_BREAKER_RESET = float(os.getenv("GRAFANA_BREAKER_RESET", "30"))
+
+# 刷新失败时可以继续返回的旧快照的最大年龄（秒）
+INVENTORY_STALE_MAX_AGE = float(os.getenv("INVENTORY_STALE_MAX_AGE", "1800"))
+
+# 后台刷新间隔（秒），见 start_background_refresh
+INVENTORY_REFRESH_INTERVAL = float(os.getenv("INVENTORY_REFRESH_INTERVAL", "30"))
+
+# 库存历史数据库（SQLite），设置后每次成功刷新的 (gpu_product_name, idc) 快照都会写入，见 enable_inventory_history
+# （保留天数见 inventory_store.INVENTORY_HISTORY_RETENTION_DAYS）
+INVENTORY_HISTORY_DB = os.getenv("INVENTORY_HISTORY_DB", "")
+
+# 节点级查询：节点主键列（用于 keyset 分页的排序兜底），以及额外返回的列（逗号分隔）
+INVENTORY_NODE_ID_COLUMN = os.getenv("INVENTORY_NODE_ID_COLUMN", "id")
+INVENTORY_NODE_EXTRA_COLUMNS = [c.strip() for c in os.getenv("INVENTORY_NODE_EXTRA_COLUMNS", "").split(",") if c.strip()]
+INVENTORY_NODE_PAGE_SIZE = int(os.getenv("INVENTORY_NODE_PAGE_SIZE", "500"))
+
+# 按 SQL 文本缓存的查询结果条数上限，见 query_inventory_frame
+INVENTORY_RESULT_CACHE_SIZE = int(os.getenv("INVENTORY_RESULT_CACHE_SIZE", "128"))
+
+# 库存查询模式：
+#   "idc"        按 (gpu_product_name, idc) 聚合，地区/高主频在 Python 中判断
+#   "classified" 地区/高主频在 SQL 中用 CASE 计算并参与 GROUP BY，返回行数更少
+INVENTORY_QUERY_MODE = os.getenv("INVENTORY_QUERY_MODE", "idc")
+
 # 海外机房关键词
 OVERSEAS_IDC_KEYWORDS = ["dallas", "canopy", "gcore"]
 
 # 高主频机房关键词（供应商为 bingte）
 HIGH_FREQ_IDC_KEYWORDS = ["bingte"]
 
-# GPU 类型映射（用户输入 -> 数据库中的名称）
-GPU_TYPE_MAP = {
-    "5090": "NVIDIA GeForce RTX 5090",
-    "4090": "NVIDIA GeForce RTX 4090",
-    "3090": "NVIDIA GeForce RTX 3090",
-    "H100": "NVIDIA H100 80GB HBM3",
-    "H20": "NVIDIA H20",
-    "H200": "NVIDIA H200",
-    "A100": "NVIDIA A100-SXM4-80GB",
-    "L40S": "NVIDIA L40S",
-    "5880": "NVIDIA RTX 5880 Ada Generation",
-    "6000": "NVIDIA RTX 6000 Ada Generation",
+# 机房供应商关键词（机房名包含关键词 -> 供应商），未命中的机房供应商为空
+IDC_SUPPLIER_KEYWORDS = {
+    "bingte": "bingte",
+    "canopy": "canopy",
+    "gcore": "gcore",
 }
 
+# 机房分类结果缓存条数上限
+IDC_CACHE_SIZE = int(os.getenv("IDC_CACHE_SIZE", "1024"))
 
-def query_grafana(sql: str) -> List[Dict]:
-    """
-    通过 Grafana API 执行 SQL 查询
+# GPU 类型映射（简称 -> 数据库中的名称），由 gpu_models 注册表生成
+GPU_TYPE_MAP = {model.short: model.db_name for model in GPU_MODELS if model.db_name}
+
+
+# 模块级连接池：复用 TCP/TLS 连接，避免每次查询都重新握手
+_session: Optional[requests.Session] = None
+_adapter: Optional[HTTPAdapter] = None
+_session_lock = threading.Lock()
+_request_count = 0
+
+
+def get_grafana_session() -> requests.Session:
+    """获取共享的 Grafana HTTP 会话（首次调用时创建）"""
+    global _session, _adapter
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GRAFANA_POOL_SIZE)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update({"Connection": "keep-alive"})
+                _adapter = adapter
+                _session = session
+    return _session
 
-    Args:
-        sql: SQL 查询语句
+
+def close_grafana_session():
+    """关闭共享会话并清空连接统计"""
+    global _session, _adapter, _request_count
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _adapter = None
+        _request_count = 0
+
+
+def get_connection_stats() -> Dict:
+    """
+    连接复用统计
 
     Returns:
-        查询结果列表，每个元素是一个字典
+        {"requests": 请求数, "new_connections": 新建连接数, "reused": 复用连接的请求数}
+    """
+    new_connections = 0
+    if _adapter is not None:
+        pools = _adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                new_connections += pool.num_connections
+    return {
+        "requests": _request_count,
+        "new_connections": new_connections,
+        "reused": max(_request_count - new_connections, 0),
+    }
+
+
+class CircuitOpenError(RuntimeError):
+    """熔断器打开，请求被直接拒绝"""
+
+
+class CircuitBreaker:
+    """
+    Grafana 请求熔断器
+
+    closed:    正常放行，连续失败达到阈值后进入 open
+    open:      直接抛出 CircuitOpenError，reset_timeout 秒后进入 half_open
+    half_open: 只放行一个试探请求，成功则关闭，失败则重新打开
+    """
+
+    def __init__(self, threshold: int = GRAFANA_BREAKER_THRESHOLD, reset_timeout: float = GRAFANA_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._trips = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    def _current_state(self) -> str:
+        if self._state == "open" and time.time() - self._opened_at >= self.reset_timeout:
+            self._state = "half_open"
+        return self._state
+
+    def before_call(self):
+        """请求前调用，熔断中时抛出 CircuitOpenError"""
+        with self._lock:
+            state = self._current_state()
+            if state == "closed":
+                return
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            self._rejected += 1
+            raise CircuitOpenError(f"Grafana 熔断中，{self._retry_after():.1f} 秒后重试")
+
+    def record_success(self):
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == "half_open" or self._failures >= self.threshold:
+                if self._state != "open":
+                    self._trips += 1
+                self._state = "open"
+                self._opened_at = time.time()
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        with self._lock:
+            self._trial_in_flight = False
+
+    def _retry_after(self) -> float:
+        if self._state != "open":
+            return 0.0
+        return max(self.reset_timeout - (time.time() - self._opened_at), 0.0)
+
+    def retry_after(self) -> float:
+        """距离允许试探请求还有多少秒，未熔断时为 0"""
+        with self._lock:
+            self._current_state()
+            return self._retry_after()
+
+    def reset(self):
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def status(self) -> Dict:
+        """熔断器状态，供监控使用"""
+        with self._lock:
+            return {
+                "state": self._current_state(),
+                "consecutive_failures": self._failures,
+                "threshold": self.threshold,
+                "reset_timeout": self.reset_timeout,
+                "retry_after": self._retry_after(),
+                "trips": self._trips,
+                "rejected": self._rejected,
+            }
+
+
+grafana_breaker = CircuitBreaker()
+
+
+def get_grafana_breaker_status() -> Dict:
+    """Grafana 熔断器状态"""
+    return grafana_breaker.status()
+
+
+def _infer_column(values: List[Any], field_type: Optional[str] = None) -> np.ndarray:
+    """
+    推断列的 NumPy 类型：
+    全为整数 -> int64；数值（含空值）-> float64，空值为 NaN；其他 -> object
     """
+    if field_type not in (None, "number", "time"):
+        return np.array(values, dtype=object)
+
+    has_null = False
+    all_int = True
+    for v in values:
+        if v is None:
+            has_null = True
+        elif isinstance(v, bool) or not isinstance(v, (int, float)):
+            return np.array(values, dtype=object)
+        elif not isinstance(v, int):
+            all_int = False
+
+    if all_int and not has_null:
+        return np.array(values, dtype=np.int64)
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+class GrafanaFrame:
+    """
+    Grafana 查询结果（列式）
+
+    每列保存为一个 NumPy 数组，行只在需要时（row / rows / to_dicts）才构建，
+    大结果集上的过滤和汇总可以直接对列做向量化计算。
+    """
+
+    def __init__(self, columns: Optional[Dict[str, np.ndarray]] = None, stale: bool = False):
+        self.columns: Dict[str, np.ndarray] = columns or {}
+        self.stale = stale  # 刷新失败时返回的旧快照
+        self.num_rows = len(next(iter(self.columns.values()))) if self.columns else 0
+
+    @classmethod
+    def from_grafana(cls, frame: Dict) -> "GrafanaFrame":
+        """从 Grafana data frame（schema.fields + data.values）构建"""
+        schema = frame.get("schema", {}).get("fields", [])
+        values = frame.get("data", {}).get("values", [])
+        num_rows = len(values[0]) if values and values[0] else 0
+
+        columns = {}
+        for j, field in enumerate(schema):
+            if j < len(values) and values[j] is not None:
+                columns[field["name"]] = _infer_column(values[j], field.get("type"))
+            else:
+                columns[field["name"]] = np.full(num_rows, None, dtype=object)
+        return cls(columns)
+
+    @classmethod
+    def from_dicts(cls, rows: List[Dict]) -> "GrafanaFrame":
+        """从字典列表构建（列名取自第一行）"""
+        if not rows:
+            return cls()
+        names = list(rows[0])
+        return cls({name: _infer_column([row.get(name) for row in rows]) for name in names})
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.columns)
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.columns
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return self.columns.get(name, default)
+
+    def numeric(self, name: str) -> np.ndarray:
+        """返回数值列，空值和缺失列按 0 处理（与 row.get(x, 0) or 0 一致）"""
+        col = self.columns.get(name)
+        if col is None:
+            return np.zeros(self.num_rows, dtype=np.int64)
+        if col.dtype == object:
+            col = np.array([v or 0 for v in col], dtype=np.float64)
+        if col.dtype.kind == "f":
+            col = np.nan_to_num(col)
+        return col
+
+    def text(self, name: str) -> np.ndarray:
+        """返回字符串列，空值和缺失列按空字符串处理"""
+        col = self.columns.get(name)
+        if col is None:
+            return np.full(self.num_rows, "", dtype=object)
+        return np.array(["" if v is None else v for v in col], dtype=object)
+
+    def row(self, i: int) -> Dict:
+        """构建第 i 行的字典"""
+        return {name: _to_python(col[i]) for name, col in self.columns.items()}
+
+    def rows(self, indices: Optional[np.ndarray] = None) -> Iterator[Dict]:
+        """逐行产出字典，indices 为空时遍历全部行"""
+        if indices is None:
+            indices = range(self.num_rows)
+        for i in indices:
+            yield self.row(i)
+
+    def to_dicts(self) -> List[Dict]:
+        """转换为字典列表（与 query_grafana 的返回格式一致）"""
+        names = self.names
+        lists = [_column_to_list(self.columns[name]) for name in names]
+        return [dict(zip(names, values)) for values in zip(*lists)]
+
+
+def _to_python(value: Any) -> Any:
+    """NumPy 标量转换为 Python 原生类型，NaN 还原为 None"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def _column_to_list(col: np.ndarray) -> List[Any]:
+    if col.dtype.kind == "f":
+        return [None if v != v else v for v in col.tolist()]
+    return col.tolist()
+
+
+def _ref_id(index: int) -> str:
+    """第 index 个查询的 refId：A, B, ..., Z, AA, AB, ..."""
+    ref = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        ref = chr(ord("A") + rem) + ref
+    return ref
+
+
+def _normalize_queries(sqls: Union[List[str], Dict[str, str]]) -> Dict[str, str]:
+    """SQL 列表按顺序分配 refId；字典则直接作为 refId -> SQL"""
+    if isinstance(sqls, dict):
+        return dict(sqls)
+    return {_ref_id(i): sql for i, sql in enumerate(sqls)}
+
+
+def _grafana_request(queries: Dict[str, str]) -> Tuple[str, Dict, Dict]:
+    """构建 Grafana 查询请求（refId -> SQL），返回 (url, headers, payload)"""
     if not GRAFANA_API_KEY:
         raise ValueError("GRAFANA_API_KEY 未配置")
 
@@ -62,138 +420,1638 @@ def query_grafana(sql: str) -> List[Dict]:
                 "datasource": {"type": "mysql", "uid": GRAFANA_DATASOURCE_UID},
                 "rawSql": sql,
                 "format": "table",
-                "refId": "A"
+                "refId": ref_id
             }
+            for ref_id, sql in queries.items()
         ]
     }
+    return url, headers, payload
+
+
+def _parse_grafana_response(data: Dict, ref_ids: List[str]) -> Tuple[Dict[str, GrafanaFrame], Dict[str, str]]:
+    """
+    解析 Grafana 返回的数据格式
+
+    Returns:
+        (refId -> GrafanaFrame, refId -> 错误信息)
+    """
+    results = data.get("results", {})
+    frames = {}
+    errors = {}
+    for ref_id in ref_ids:
+        result = results.get(ref_id, {})
+        if result.get("error"):
+            errors[ref_id] = result["error"]
+        result_frames = result.get("frames", [])
+        frames[ref_id] = GrafanaFrame.from_grafana(result_frames[0]) if result_frames else GrafanaFrame()
+    return frames, errors
+
+
+class LatencyBudgetExceeded(TimeoutError):
+    """调用超出时间预算"""
+
+
+class QueryPolicy(NamedTuple):
+    """
+    Grafana 调用策略
+
+    budget: 单次调用（包括等待其他调用方的刷新）的时间上限（秒），None 表示不限
+    hedge: 是否发送对冲请求
+    hedge_after: 对冲等待时间（秒），None 表示使用最近请求的 p95
+    """
+    budget: Optional[float] = None
+    hedge: bool = False
+    hedge_after: Optional[float] = None
+
+
+DEFAULT_QUERY_POLICY = QueryPolicy(GRAFANA_QUERY_BUDGET or None, GRAFANA_HEDGE, GRAFANA_HEDGE_AFTER)
+
+_query_policy: contextvars.ContextVar = contextvars.ContextVar("grafana_query_policy", default=DEFAULT_QUERY_POLICY)
+_query_deadline: contextvars.ContextVar = contextvars.ContextVar("grafana_query_deadline", default=None)
+
+
+def current_query_policy() -> QueryPolicy:
+    """当前上下文的调用策略"""
+    return _query_policy.get()
+
+
+@contextmanager
+def query_policy(budget: Optional[float] = None, hedge: Optional[bool] = None, hedge_after: Optional[float] = None):
+    """
+    在 with 块内使用指定的调用策略（未指定的项沿用外层策略），对同步和异步调用都有效
+
+    例：聊天机器人要求 3 秒内回复，超时就用缓存数据：
+        with query_policy(budget=3, hedge=True):
+            info = get_gpu_inventory_by_type("4090")
+
+    budget=0 表示不限时。
+    """
+    policy = _query_policy.get()
+    if budget is not None:
+        policy = policy._replace(budget=budget or None)
+    if hedge is not None:
+        policy = policy._replace(hedge=hedge)
+    if hedge_after is not None:
+        policy = policy._replace(hedge_after=hedge_after)
+    token = _query_policy.set(policy)
+    try:
+        yield policy
+    finally:
+        _query_policy.reset(token)
+
+
+@contextmanager
+def _deadline_scope():
+    """为一次调用确定截止时间（time.monotonic），外层已有截止时间时沿用"""
+    deadline = _query_deadline.get()
+    if deadline is not None:
+        yield deadline
+        return
+    budget = _query_policy.get().budget
+    if not budget:
+        yield None
+        return
+    deadline = time.monotonic() + budget
+    token = _query_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _query_deadline.reset(token)
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else max(deadline - time.monotonic(), 0.0)
+
+
+class LatencyTracker:
+    """最近 window 次成功请求的耗时，用于计算对冲等待时间"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.stats = {"hedged": 0, "hedge_wins": 0, "budget_exceeded": 0}
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+        GRAFANA_POLICY_EVENTS.inc(event=key)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """耗时的 q 分位数（秒），样本不足时为 None"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = list(self._samples)
+        return float(np.percentile(samples, q))
+
+    def hedge_delay(self, policy: QueryPolicy) -> float:
+        if policy.hedge_after is not None:
+            return policy.hedge_after
+        p95 = self.percentile(95)
+        return p95 if p95 is not None else GRAFANA_HEDGE_DEFAULT_DELAY
+
+    def status(self) -> Dict:
+        with self._lock:
+            status = dict(self.stats)
+            status["samples"] = len(self._samples)
+        status["p50"] = self.percentile(50)
+        status["p95"] = self.percentile(95)
+        return status
+
+
+grafana_latency = LatencyTracker()
+
+
+def get_grafana_latency_stats() -> Dict:
+    """Grafana 请求延迟分位数和对冲/超预算次数"""
+    return grafana_latency.status()
+
+
+# Grafana 调用指标（通过 metrics.render_metrics() 输出到 /metrics）
+GRAFANA_REQUEST_SECONDS = histogram(
+    "grafana_request_duration_seconds", "Grafana /api/ds/query 请求耗时（不含解析）", ["client", "outcome"]
+)
+GRAFANA_PARSE_SECONDS = histogram(
+    "grafana_parse_duration_seconds", "Grafana 响应解析耗时（JSON 解码 + 构建列式结果）", buckets=PARSE_BUCKETS
+)
+GRAFANA_RESPONSE_BYTES = histogram("grafana_response_bytes", "Grafana 响应体大小", buckets=SIZE_BUCKETS)
+GRAFANA_ROWS = counter("grafana_rows_total", "Grafana 查询返回的总行数")
+GRAFANA_ERRORS = counter(
+    "grafana_errors_total", "Grafana 调用失败次数（http / decode / query / circuit_open）", ["kind"]
+)
+GRAFANA_POLICY_EVENTS = counter(
+    "grafana_policy_events_total", "对冲请求、对冲胜出、超出时间预算的次数", ["event"]
+)
+
+
+def _before_call():
+    try:
+        grafana_breaker.before_call()
+    except CircuitOpenError:
+        GRAFANA_ERRORS.inc(kind="circuit_open")
+        raise
+
+
+def _record_request_failure(client: str, started: float, error: Exception, read_timeout: float):
+    """
+    记录一次请求失败
+
+    超时被时间预算截短（read_timeout 小于配置的连接 / 读超时）时，超时说明的是调用方赶时间而不是 Grafana 故障：
+    不计入熔断器和错误数（只释放 half_open 的试探名额），返回 LatencyBudgetExceeded 供调用方抛出，
+    由对冲逻辑计入 budget_exceeded；其他失败返回 None。
+    """
+    if isinstance(error, (requests.ConnectTimeout, httpx.ConnectTimeout)):
+        budget_limited = read_timeout < GRAFANA_CONNECT_TIMEOUT
+    else:
+        budget_limited = read_timeout < GRAFANA_READ_TIMEOUT and isinstance(error, (requests.Timeout, httpx.TimeoutException))
+    if budget_limited:
+        grafana_breaker.release_trial()
+        return LatencyBudgetExceeded(f"Grafana 请求在时间预算内（{read_timeout:.2f} 秒）未返回")
+    grafana_breaker.record_failure()
+    GRAFANA_ERRORS.inc(kind="http")
+    GRAFANA_REQUEST_SECONDS.observe(time.monotonic() - started, client=client, outcome="error")
+    return None
+
+
+def _finish_response(client: str, started: float, content: bytes, ref_ids: List[str]):
+    """记录耗时并解析响应，JSON 解码失败按请求失败处理"""
+    elapsed = time.monotonic() - started
+    parse_started = time.perf_counter()
+    try:
+        data = json.loads(content)
+    except Exception:
+        grafana_breaker.record_failure()
+        GRAFANA_ERRORS.inc(kind="decode")
+        GRAFANA_REQUEST_SECONDS.observe(elapsed, client=client, outcome="error")
+        raise
+    grafana_breaker.record_success()
+    grafana_latency.record(elapsed)
+    GRAFANA_REQUEST_SECONDS.observe(elapsed, client=client, outcome="success")
+    GRAFANA_RESPONSE_BYTES.observe(len(content))
+
+    frames, errors = _parse_grafana_response(data, ref_ids)
+    GRAFANA_PARSE_SECONDS.observe(time.perf_counter() - parse_started)
+    GRAFANA_ROWS.inc(sum(len(frame) for frame in frames.values()))
+    if errors:
+        GRAFANA_ERRORS.inc(len(errors), kind="query")
+    return frames, errors
+
+
+def _post_grafana_once(queries: Dict[str, str], read_timeout: float = GRAFANA_READ_TIMEOUT) -> Tuple[Dict[str, GrafanaFrame], Dict[str, str]]:
+    """发送一次 POST，HTTP 失败时抛出异常"""
+    global _request_count
+    url, headers, payload = _grafana_request(queries)
+
+    _before_call()
+    session = get_grafana_session()
+    with _session_lock:
+        _request_count += 1
+    started = time.monotonic()
+    try:
+        response = session.post(
+            url, json=payload, headers=headers,
+            timeout=(min(GRAFANA_CONNECT_TIMEOUT, read_timeout), read_timeout)
+        )
+        response.raise_for_status()
+    except Exception as e:
+        budget_error = _record_request_failure("sync", started, e, read_timeout)
+        if budget_error is not None:
+            raise budget_error from e
+        raise
+    return _finish_response("sync", started, response.content, list(queries))
+
+
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _session_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(max_workers=GRAFANA_POOL_SIZE, thread_name_prefix="grafana-hedge")
+    return _hedge_executor
+
+
+def _post_grafana_hedged(queries: Dict[str, str], policy: QueryPolicy, deadline: Optional[float]):
+    """
+    带时间预算和对冲的 POST
+
+    请求在线程池中执行；到对冲时间仍未返回时再发一个相同请求，取第一个成功的结果。
+    超出预算时抛出 LatencyBudgetExceeded，未完成的请求在后台自行结束（结果丢弃）；
+    被预算截短的超时不计入熔断器，只计入 budget_exceeded。
+    """
+    def launch() -> Future:
+        remaining = _remaining(deadline)
+        read_timeout = GRAFANA_READ_TIMEOUT if remaining is None else min(GRAFANA_READ_TIMEOUT, max(remaining, 0.01))
+        return _get_hedge_executor().submit(_post_grafana_once, queries, read_timeout)
+
+    first = launch()
+    pending = {first}
+    hedge_at = time.monotonic() + grafana_latency.hedge_delay(policy) if policy.hedge else None
+    last_error: Optional[BaseException] = None
+
+    while pending:
+        waits = [t - time.monotonic() for t in (deadline, hedge_at) if t is not None]
+        done, pending = wait(pending, timeout=max(min(waits), 0) if waits else None, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is not first:
+                    grafana_latency.count("hedge_wins")
+                return future.result()
+            last_error = future.exception()
+
+        now = time.monotonic()
+        if hedge_at is not None and now >= hedge_at:
+            hedge_at = None
+            if pending and (deadline is None or now < deadline):
+                grafana_latency.count("hedged")
+                pending.add(launch())
+        if deadline is not None and now >= deadline and pending:
+            grafana_latency.count("budget_exceeded")
+            raise LatencyBudgetExceeded(f"Grafana 查询超出时间预算 {policy.budget or 0:.1f} 秒")
+
+    if isinstance(last_error, LatencyBudgetExceeded):
+        grafana_latency.count("budget_exceeded")
+    raise last_error
+
+
+def _post_grafana(queries: Dict[str, str]) -> Tuple[Dict[str, GrafanaFrame], Dict[str, str]]:
+    """一次 POST 执行多条查询，HTTP 失败时抛出异常；按 query_policy 应用时间预算和对冲"""
+    policy = _query_policy.get()
+    with _deadline_scope() as deadline:
+        if deadline is None and not policy.hedge:
+            return _post_grafana_once(queries)
+        return _post_grafana_hedged(queries, policy, deadline)
+
+
+def _execute_grafana_frame(sql: str) -> GrafanaFrame:
+    """
+    执行 Grafana SQL 查询并返回列式结果，失败时抛出异常
+    （供缓存等需要区分失败与空结果的调用方使用）
+    """
+    frames, errors = _post_grafana({"A": sql})
+    if errors:
+        raise RuntimeError(errors["A"])
+    return frames["A"]
+
+
+# 异步客户端：httpx.AsyncClient 的连接绑定在事件循环上，每个循环一个客户端
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[httpx.AsyncClient, AsyncIterator]]" = weakref.WeakKeyDictionary()
 
+
+async def _close_on_loop_shutdown(client: httpx.AsyncClient) -> AsyncIterator[None]:
+    """
+    循环关闭前关闭客户端：启动后由事件循环跟踪，asyncio.run 结束时 shutdown_asyncgens() 会执行 finally，
+    此时循环仍在运行，连接可以正常关闭（循环关闭后就无法再 aclose）
+    """
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        yield
+    finally:
+        await client.aclose()
+
+
+def get_grafana_async_client() -> httpx.AsyncClient:
+    """获取当前事件循环共享的 Grafana 异步客户端"""
+    loop = asyncio.get_running_loop()
+    with _session_lock:
+        entry = _async_clients.get(loop)
+        if entry is not None and not entry[0].is_closed:
+            return entry[0]
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(GRAFANA_READ_TIMEOUT, connect=GRAFANA_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=GRAFANA_POOL_SIZE,
+                max_keepalive_connections=GRAFANA_POOL_SIZE
+            )
+        )
+        guard = _close_on_loop_shutdown(client)
+        _async_clients[loop] = (client, guard)
+        # 没有经过 shutdown_asyncgens 就关闭的循环，其客户端已无法关闭，丢掉引用让连接随对象回收
+        for closed in [other for other in _async_clients if other.is_closed()]:
+            del _async_clients[closed]
+    loop.create_task(guard.__anext__())
+    return client
+
+
+async def close_grafana_async_client():
+    """关闭当前事件循环的异步客户端"""
+    entry = _async_clients.pop(asyncio.get_running_loop(), None)
+    if entry is not None:
+        client, guard = entry
+        await guard.aclose()
+        await client.aclose()
+
+
+async def _post_grafana_once_async(queries: Dict[str, str], read_timeout: float = GRAFANA_READ_TIMEOUT):
+    """_post_grafana_once 的异步版本"""
+    url, headers, payload = _grafana_request(queries)
+
+    _before_call()
+    client = get_grafana_async_client()
+    started = time.monotonic()
+    try:
+        response = await client.post(
+            url, json=payload, headers=headers,
+            timeout=httpx.Timeout(read_timeout, connect=min(GRAFANA_CONNECT_TIMEOUT, read_timeout))
+        )
         response.raise_for_status()
-        data = response.json()
-
-        # 解析 Grafana 返回的数据格式
-        if "results" in data and "A" in data["results"]:
-            frames = data["results"]["A"].get("frames", [])
-            if frames:
-                frame = frames[0]
-                schema = frame.get("schema", {}).get("fields", [])
-                values = frame.get("data", {}).get("values", [])
-
-                # 构建列名到索引的映射
-                columns = [field["name"] for field in schema]
-
-                # 转换为字典列表
-                rows = []
-                if values and len(values) > 0:
-                    num_rows = len(values[0]) if values[0] else 0
-                    for i in range(num_rows):
-                        row = {}
-                        for j, col_name in enumerate(columns):
-                            row[col_name] = values[j][i] if j < len(values) else None
-                        rows.append(row)
-
-                return rows
+    except asyncio.CancelledError:
+        # 请求被取消不算失败，但要释放 half_open 的试探名额
+        grafana_breaker.release_trial()
+        raise
+    except Exception as e:
+        budget_error = _record_request_failure("async", started, e, read_timeout)
+        if budget_error is not None:
+            raise budget_error from e
+        raise
+    return _finish_response("async", started, response.content, list(queries))
+
+
+async def _post_grafana_hedged_async(queries: Dict[str, str], policy: QueryPolicy, deadline: Optional[float]):
+    """_post_grafana_hedged 的异步版本，结束时取消未完成的请求"""
+    def launch() -> asyncio.Task:
+        remaining = _remaining(deadline)
+        read_timeout = GRAFANA_READ_TIMEOUT if remaining is None else min(GRAFANA_READ_TIMEOUT, max(remaining, 0.01))
+        return asyncio.ensure_future(_post_grafana_once_async(queries, read_timeout))
+
+    first = launch()
+    pending = {first}
+    hedge_at = time.monotonic() + grafana_latency.hedge_delay(policy) if policy.hedge else None
+    last_error: Optional[BaseException] = None
+
+    try:
+        while pending:
+            waits = [t - time.monotonic() for t in (deadline, hedge_at) if t is not None]
+            done, pending = await asyncio.wait(
+                pending, timeout=max(min(waits), 0) if waits else None, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    if task is not first:
+                        grafana_latency.count("hedge_wins")
+                    return task.result()
+                last_error = task.exception()
+
+            now = time.monotonic()
+            if hedge_at is not None and now >= hedge_at:
+                hedge_at = None
+                if pending and (deadline is None or now < deadline):
+                    grafana_latency.count("hedged")
+                    pending.add(launch())
+            if deadline is not None and now >= deadline and pending:
+                grafana_latency.count("budget_exceeded")
+                raise LatencyBudgetExceeded(f"Grafana 查询超出时间预算 {policy.budget or 0:.1f} 秒")
+    finally:
+        for task in pending:
+            task.cancel()
+
+    if isinstance(last_error, LatencyBudgetExceeded):
+        grafana_latency.count("budget_exceeded")
+    raise last_error
+
+
+async def _post_grafana_async(queries: Dict[str, str]) -> Tuple[Dict[str, GrafanaFrame], Dict[str, str]]:
+    """_post_grafana 的异步版本"""
+    policy = _query_policy.get()
+    with _deadline_scope() as deadline:
+        if deadline is None and not policy.hedge:
+            return await _post_grafana_once_async(queries)
+        return await _post_grafana_hedged_async(queries, policy, deadline)
+
+
+async def _execute_grafana_frame_async(sql: str) -> GrafanaFrame:
+    """_execute_grafana_frame 的异步版本，失败时抛出异常"""
+    frames, errors = await _post_grafana_async({"A": sql})
+    if errors:
+        raise RuntimeError(errors["A"])
+    return frames["A"]
+
+
+def _execute_grafana_query(sql: str) -> List[Dict]:
+    """执行 Grafana SQL 查询并返回字典列表，失败时抛出异常"""
+    return _execute_grafana_frame(sql).to_dicts()
+
+
+def query_grafana_frame(sql: str) -> GrafanaFrame:
+    """
+    通过 Grafana API 执行 SQL 查询，返回列式结果
+
+    Args:
+        sql: SQL 查询语句
+
+    Returns:
+        GrafanaFrame，查询失败时为空
+    """
+    try:
+        return _execute_grafana_frame(sql)
+    except Exception as e:
+        print(f"Grafana API 查询失败: {e}")
+        return GrafanaFrame()
+
 
+def query_grafana(sql: str) -> List[Dict]:
+    """
+    通过 Grafana API 执行 SQL 查询
+
+    Args:
+        sql: SQL 查询语句
+
+    Returns:
+        查询结果列表，每个元素是一个字典
+    """
+    try:
+        return _execute_grafana_query(sql)
+    except Exception as e:
+        print(f"Grafana API 查询失败: {e}")
         return []
+
+
+async def query_grafana_frame_async(sql: str) -> GrafanaFrame:
+    """query_grafana_frame 的异步版本，查询失败时返回空结果"""
+    try:
+        return await _execute_grafana_frame_async(sql)
+    except Exception as e:
+        print(f"Grafana API 查询失败: {e}")
+        return GrafanaFrame()
+
+
+async def query_grafana_async(sql: str) -> List[Dict]:
+    """
+    query_grafana 的异步版本，基于共享的 httpx.AsyncClient，不阻塞事件循环
+
+    Args:
+        sql: SQL 查询语句
+
+    Returns:
+        查询结果列表，每个元素是一个字典
+    """
+    frame = await query_grafana_frame_async(sql)
+    return frame.to_dicts()
+
+
+def _batch_result(
+    queries: Dict[str, str],
+    frames: Dict[str, GrafanaFrame],
+    errors: Dict[str, str]
+) -> Dict[str, GrafanaFrame]:
+    for ref_id, error in errors.items():
+        print(f"Grafana API 查询失败 ({ref_id}): {error}")
+    return {ref_id: frames.get(ref_id, GrafanaFrame()) for ref_id in queries}
+
+
+def query_grafana_batch_frames(sqls: Union[List[str], Dict[str, str]]) -> Dict[str, GrafanaFrame]:
+    """
+    在一次 /api/ds/query 请求中执行多条 SQL，返回列式结果
+
+    Args:
+        sqls: SQL 列表（按顺序分配 refId A, B, C...）或 refId -> SQL 的字典
+
+    Returns:
+        refId -> GrafanaFrame，失败的查询为空
+    """
+    queries = _normalize_queries(sqls)
+    if not queries:
+        return {}
+    try:
+        frames, errors = _post_grafana(queries)
+    except Exception as e:
+        print(f"Grafana API 查询失败: {e}")
+        return {ref_id: GrafanaFrame() for ref_id in queries}
+    return _batch_result(queries, frames, errors)
+
+
+def query_grafana_batch(sqls: Union[List[str], Dict[str, str]]) -> Dict[str, List[Dict]]:
+    """
+    在一次 /api/ds/query 请求中执行多条 SQL
+
+    Args:
+        sqls: SQL 列表（按顺序分配 refId A, B, C...）或 refId -> SQL 的字典
+
+    Returns:
+        refId -> 查询结果列表，失败的查询为空列表
+    """
+    return {ref_id: frame.to_dicts() for ref_id, frame in query_grafana_batch_frames(sqls).items()}
+
+
+async def query_grafana_batch_frames_async(sqls: Union[List[str], Dict[str, str]]) -> Dict[str, GrafanaFrame]:
+    """query_grafana_batch_frames 的异步版本"""
+    queries = _normalize_queries(sqls)
+    if not queries:
+        return {}
+    try:
+        frames, errors = await _post_grafana_async(queries)
     except Exception as e:
         print(f"Grafana API 查询失败: {e}")
+        return {ref_id: GrafanaFrame() for ref_id in queries}
+    return _batch_result(queries, frames, errors)
+
+
+async def query_grafana_batch_async(sqls: Union[List[str], Dict[str, str]]) -> Dict[str, List[Dict]]:
+    """query_grafana_batch 的异步版本"""
+    frames = await query_grafana_batch_frames_async(sqls)
+    return {ref_id: frame.to_dicts() for ref_id, frame in frames.items()}
+
+
+query_builder = QueryBuilder(INVENTORY_NODE_ID_COLUMN, INVENTORY_NODE_EXTRA_COLUMNS)
+
+
+def render_inventory_sql(query: InventoryQuery) -> str:
+    """按当前机房关键词渲染查询，返回规范化的 SQL 文本"""
+    return query_builder.render(query, OVERSEAS_IDC_KEYWORDS, HIGH_FREQ_IDC_KEYWORDS)
+
+
+# (gpu_product_name, idc) 聚合快照
+INVENTORY_SNAPSHOT_QUERY = InventoryQuery(group_by=("gpu_product_name", "idc"))
+INVENTORY_SNAPSHOT_SQL = render_inventory_sql(INVENTORY_SNAPSHOT_QUERY)
+
+
+class InventorySnapshotCache:
+    """
+    库存快照缓存
+
+    在 TTL 内直接返回上一次的查询结果；过期后由第一个调用方刷新，
+    其余并发调用方等待这一次刷新完成并共享结果（single-flight）。
+    查询失败不会写入缓存。
+
+    刷新失败（包括熔断时的快速失败）时，如果上一份成功的快照不超过 INVENTORY_STALE_MAX_AGE，
+    返回它的副本并标记 stale=True，同时在后台线程重新验证（stale-while-revalidate）；
+    重新验证进行期间，后续调用方直接拿到旧快照，不再各自等待 Grafana。没有可用旧快照时返回空结果。
+
+    get() 供同步调用方使用；get_async() 在事件循环内通过 async_fetcher 刷新，
+    同一循环内的并发协程共享一个刷新任务，两者共用同一份快照。
+
+    pinned 为 True 时（由后台刷新线程维护），只要有快照就直接返回，不再因 TTL 过期而同步刷新；
+    后台刷新失败期间同样不同步刷新，按上面的规则返回标记 stale 的旧快照或空结果。
+
+    当前 query_policy 设置了时间预算时，等待刷新（包括等待其他调用方的刷新）最多到截止时间，
+    超时后返回旧快照副本（不超过 stale_max_age）或空结果。
+
+    add_listener() 注册的回调在每次成功刷新后以 (快照, 查询时间戳) 调用，用于持久化历史等，
+    回调异常只打印，不影响查询结果。
+    """
+
+    def __init__(
+        self,
+        fetcher: Callable[[], GrafanaFrame],
+        ttl: float = INVENTORY_CACHE_TTL,
+        async_fetcher: Optional[Callable[[], Awaitable[GrafanaFrame]]] = None
+    ):
+        self.fetcher = fetcher
+        self.async_fetcher = async_fetcher
+        self.ttl = ttl
+        self._rows: Optional[GrafanaFrame] = None
+        self._fetched_at = 0.0
+        self._flights = 0          # 已完成的刷新次数（成功或失败）
+        self._last_error: Optional[Exception] = None
+        self._lock = threading.Lock()          # 保护上面的状态
+        self._refresh_lock = threading.Lock()  # 同一时刻只允许一个刷新请求
+        self._async_task: Optional[asyncio.Task] = None
+        self._revalidating = False
+        self.pinned = False
+        self.stale_max_age = INVENTORY_STALE_MAX_AGE
+        self._listeners: List[Callable[[GrafanaFrame, float], None]] = []
+
+    def _is_fresh(self) -> bool:
+        if self._rows is None:
+            return False
+        if self.pinned:
+            return self._last_error is None
+        return time.time() - self._fetched_at < self.ttl
+
+    def _pinned_view(self) -> Optional[GrafanaFrame]:
+        """
+        pinned 且后台刷新失败时的返回值（由刷新线程负责重试，调用方不再同步刷新）：
+        不超过 stale_max_age 的旧快照副本，太旧时为空结果；不适用时为 None。需持有 _lock
+        """
+        if not self.pinned or self._rows is None or self._last_error is None:
+            return None
+        stale = self._stale_view()
+        return stale if stale is not None else GrafanaFrame()
+
+    def _store(self, rows: GrafanaFrame) -> GrafanaFrame:
+        with self._lock:
+            self._rows = rows
+            self._fetched_at = fetched_at = time.time()
+            self._last_error = None
+            self._flights += 1
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(rows, fetched_at)
+            except Exception as e:
+                print(f"库存快照回调失败: {e}")
+        return rows
+
+    def add_listener(self, listener: Callable[[GrafanaFrame, float], None]):
+        """注册刷新成功后的回调"""
+        with self._lock:
+            if listener not in self._listeners:
+                self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[GrafanaFrame, float], None]):
+        """取消回调"""
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def _stale_view(self) -> Optional[GrafanaFrame]:
+        """可用的旧快照副本（标记 stale），没有或太旧时为 None，需持有 _lock"""
+        if self._rows is None or time.time() - self._fetched_at > self.stale_max_age:
+            return None
+        return GrafanaFrame(self._rows.columns, stale=True)
+
+    def _fallback(self) -> GrafanaFrame:
+        """刷新失败时的返回值：旧快照（并触发后台重新验证）或空结果"""
+        with self._lock:
+            stale = self._stale_view()
+            if stale is None:
+                return GrafanaFrame()
+            # 后台刷新线程运行时由它负责重试
+            if self.pinned or self._revalidating:
+                return stale
+            self._revalidating = True
+        threading.Thread(target=self._revalidate, name="inventory-revalidate", daemon=True).start()
+        return stale
+
+    def _revalidate(self):
+        """后台重新验证：等熔断器允许试探后再刷新一次"""
+        try:
+            wait = grafana_breaker.retry_after()
+            if wait > 0:
+                time.sleep(wait)
+            with self._refresh_lock:
+                try:
+                    rows = self.fetcher()
+                except Exception as e:
+                    with self._lock:
+                        self._last_error = e
+                        self._flights += 1
+                    return
+                self._store(rows)
+        finally:
+            with self._lock:
+                self._revalidating = False
+
+    def _fail(self, error: Exception) -> GrafanaFrame:
+        self._record_error(error)
+        return self._fallback()
+
+    def _record_error(self, error: Exception):
+        print(f"Grafana API 查询失败: {error}")
+        with self._lock:
+            self._last_error = error
+            self._flights += 1
+
+    def get(self, force_refresh: bool = False, strict: bool = False) -> GrafanaFrame:
+        """
+        获取快照，过期或 force_refresh 时刷新
+
+        strict 为 True 时只返回成功刷新的快照：刷新失败或超出时间预算时抛出异常，
+        不返回旧快照或空结果（供 keyset 分页等不能把失败当成"没有更多数据"的调用方使用）。
+        """
+        with self._lock:
+            if not force_refresh and self._is_fresh():
+                return self._rows
+            if not strict:
+                pinned = None if force_refresh else self._pinned_view()
+                if pinned is not None:
+                    return pinned
+                # 正在后台重新验证，直接返回旧快照
+                if not force_refresh and self._revalidating:
+                    stale = self._stale_view()
+                    if stale is not None:
+                        return stale
+            flights = self._flights
+
+        with _deadline_scope() as deadline:
+            # 有时间预算时，等其他调用方的刷新最多等到截止时间
+            remaining = _remaining(deadline)
+            if not self._refresh_lock.acquire(timeout=-1 if remaining is None else remaining):
+                return self._budget_fallback(strict)
+            try:
+                with self._lock:
+                    # 等锁期间已有其他调用方完成刷新，直接复用它的结果
+                    # （其他调用方因为自己的时间预算放弃的刷新不算失败，由本调用方重新刷新）
+                    if self._flights != flights and not isinstance(self._last_error, LatencyBudgetExceeded):
+                        if self._last_error is None:
+                            return self._rows
+                        if strict:
+                            raise self._last_error
+                        stale = self._stale_view()
+                        return stale if stale is not None else GrafanaFrame()
+
+                try:
+                    rows = self.fetcher()
+                except Exception as e:
+                    if strict:
+                        self._record_error(e)
+                        raise
+                    return self._fail(e)
+                return self._store(rows)
+            finally:
+                self._refresh_lock.release()
+
+    def _budget_fallback(self, strict: bool = False) -> GrafanaFrame:
+        """等待刷新超出时间预算：返回当前（可能过期的）快照副本，没有时返回空结果；strict 时抛出 LatencyBudgetExceeded"""
+        grafana_latency.count("budget_exceeded")
+        if strict:
+            raise LatencyBudgetExceeded("库存查询超出时间预算")
+        print("库存查询超出时间预算，返回缓存数据")
+        with self._lock:
+            stale = self._stale_view()
+        return stale if stale is not None else GrafanaFrame()
+
+    async def _refresh_async(self) -> Tuple[GrafanaFrame, Optional[Exception]]:
+        """刷新一次，返回 (结果, 异常)；失败时结果为旧快照副本或空结果"""
+        try:
+            rows = await self.async_fetcher()
+        except Exception as e:
+            return self._fail(e), e
+        return self._store(rows), None
+
+    async def get_async(self, force_refresh: bool = False, strict: bool = False) -> GrafanaFrame:
+        """get() 的异步版本，不阻塞事件循环"""
+        with self._lock:
+            if not force_refresh and self._is_fresh():
+                return self._rows
+            if not strict:
+                pinned = None if force_refresh else self._pinned_view()
+                if pinned is not None:
+                    return pinned
+                if not force_refresh and self._revalidating:
+                    stale = self._stale_view()
+                    if stale is not None:
+                        return stale
+
+        if self.async_fetcher is None:
+            return await asyncio.to_thread(self.get, force_refresh, strict)
+
+        loop = asyncio.get_running_loop()
+        task = self._async_task
+        if task is None or task.done() or task.get_loop() is not loop:
+            # 共享的刷新任务不继承当前调用方的时间预算（create_task 会复制当前上下文），
+            # 否则有预算的调用方创建的任务会把不限时的调用方的刷新也截断；预算只用于下面的等待
+            context = contextvars.copy_context()
+            context.run(_query_deadline.set, None)
+            context.run(_query_policy.set, _query_policy.get()._replace(budget=None))
+            task = context.run(loop.create_task, self._refresh_async())
+            self._async_task = task
+
+        with _deadline_scope() as deadline:
+            # shield：某个调用方被取消或超时时不影响其他等待同一刷新的协程
+            try:
+                rows, error = await asyncio.wait_for(asyncio.shield(task), _remaining(deadline))
+            except asyncio.TimeoutError:
+                return self._budget_fallback(strict)
+            if strict and error is not None:
+                raise error
+            return rows
+
+    def invalidate(self):
+        """清空缓存，下次访问时重新查询"""
+        with self._lock:
+            self._rows = None
+            self._fetched_at = 0.0
+
+    @property
+    def age(self) -> Optional[float]:
+        """当前快照的年龄（秒），无快照时为 None"""
+        with self._lock:
+            if self._rows is None:
+                return None
+            return time.time() - self._fetched_at
+
+    @property
+    def fetched_at(self) -> Optional[float]:
+        """当前快照的查询时间（时间戳），无快照时为 None"""
+        with self._lock:
+            return self._fetched_at if self._rows is not None else None
+
+    @property
+    def is_stale(self) -> bool:
+        """最近一次刷新失败、当前只能提供旧快照"""
+        with self._lock:
+            return self._rows is not None and self._last_error is not None
+
+    @property
+    def last_error(self) -> Optional[Exception]:
+        """最近一次刷新的异常，成功时为 None"""
+        with self._lock:
+            return self._last_error
+
+
+inventory_cache = InventorySnapshotCache(
+    lambda: _execute_grafana_frame(INVENTORY_SNAPSHOT_SQL),
+    async_fetcher=lambda: _execute_grafana_frame_async(INVENTORY_SNAPSHOT_SQL)
+)
+
+
+def build_classified_inventory_sql() -> str:
+    """
+    构建按 (gpu_product_name, region, is_high_freq) 聚合的 SQL
+    region / is_high_freq 由 OVERSEAS_IDC_KEYWORDS / HIGH_FREQ_IDC_KEYWORDS 生成，
+    每次调用时按当前关键词渲染，关键词修改后立即生效
+    """
+    return render_inventory_sql(InventoryQuery(group_by=("gpu_product_name", "region", "is_high_freq")))
+
+
+classified_inventory_cache = InventorySnapshotCache(
+    lambda: _execute_grafana_frame(build_classified_inventory_sql()),
+    async_fetcher=lambda: _execute_grafana_frame_async(build_classified_inventory_sql())
+)
+
+
+INVENTORY_CACHE_AGE = gauge("inventory_cache_age_seconds", "库存快照的年龄（秒），无快照时不输出", ["cache"])
+INVENTORY_CACHE_AGE.set_function(lambda: inventory_cache.age, cache="idc")
+INVENTORY_CACHE_AGE.set_function(lambda: classified_inventory_cache.age, cache="classified")
+INVENTORY_CACHE_STALE = gauge("inventory_cache_stale", "库存快照是否为刷新失败后保留的旧快照", ["cache"])
+INVENTORY_CACHE_STALE.set_function(lambda: int(inventory_cache.is_stale), cache="idc")
+INVENTORY_CACHE_STALE.set_function(lambda: int(classified_inventory_cache.is_stale), cache="classified")
+GRAFANA_CIRCUIT_OPEN = gauge("grafana_circuit_open", "Grafana 熔断器是否打开（open / half_open 为 1）")
+GRAFANA_CIRCUIT_OPEN.set_function(lambda: int(grafana_breaker.status()["state"] != "closed"))
+
+
+def get_inventory_snapshot(force_refresh: bool = False) -> GrafanaFrame:
+    """获取 (gpu_product_name, idc) 聚合快照"""
+    return inventory_cache.get(force_refresh=force_refresh)
+
+
+def get_classified_inventory_snapshot(force_refresh: bool = False) -> GrafanaFrame:
+    """获取 (gpu_product_name, region, is_high_freq) 聚合快照"""
+    return classified_inventory_cache.get(force_refresh=force_refresh)
+
+
+async def get_inventory_snapshot_async(force_refresh: bool = False) -> GrafanaFrame:
+    """get_inventory_snapshot 的异步版本"""
+    return await inventory_cache.get_async(force_refresh=force_refresh)
+
+
+async def get_classified_inventory_snapshot_async(force_refresh: bool = False) -> GrafanaFrame:
+    """get_classified_inventory_snapshot 的异步版本"""
+    return await classified_inventory_cache.get_async(force_refresh=force_refresh)
+
+
+# 按 SQL 文本缓存的查询结果：规范化的 SQL 相同即共享同一条缓存（及其 single-flight / 旧快照兜底）
+_result_caches: "OrderedDict[str, InventorySnapshotCache]" = OrderedDict()
+_result_caches_lock = threading.Lock()
+
+
+def _result_cache(sql: str) -> InventorySnapshotCache:
+    with _result_caches_lock:
+        cache = _result_caches.get(sql)
+        if cache is None:
+            cache = InventorySnapshotCache(
+                lambda: _execute_grafana_frame(sql),
+                async_fetcher=lambda: _execute_grafana_frame_async(sql)
+            )
+            _result_caches[sql] = cache
+            while len(_result_caches) > INVENTORY_RESULT_CACHE_SIZE:
+                _result_caches.popitem(last=False)
+        else:
+            _result_caches.move_to_end(sql)
+        return cache
+
+
+def _cached_query_frame(sql: str, strict: bool = False) -> GrafanaFrame:
+    return _result_cache(sql).get(strict=strict)
+
+
+async def _cached_query_frame_async(sql: str, strict: bool = False) -> GrafanaFrame:
+    return await _result_cache(sql).get_async(strict=strict)
+
+
+def query_inventory_frame(
+    gpu_type: str = None,
+    region: str = None,
+    high_freq: bool = None,
+    idc: str = None,
+    min_free: int = None,
+    group_by: Tuple[str, ...] = ("gpu_product_name", "idc"),
+    order_by: str = None,
+    limit: int = None,
+    force_refresh: bool = False
+) -> GrafanaFrame:
+    """
+    按过滤条件在服务端聚合库存（结果按 SQL 文本缓存 INVENTORY_CACHE_TTL 秒）
+
+    过滤条件先规范化再渲染，"4090" 与 "RTX4090"、region="全部" 与 None 等等价写法共用一条缓存。
+
+    Args:
+        group_by: 分组维度，取自 gpu_product_name / idc / region / is_high_freq
+        order_by: 按 total / free / used / unavailable 降序
+        limit: 最多返回的行数
+    """
+    query = InventoryQuery(make_filter(gpu_type, region, high_freq, idc, min_free), tuple(group_by), order_by, True, limit)
+    return _result_cache(render_inventory_sql(query)).get(force_refresh=force_refresh)
+
+
+def query_inventory(**kwargs) -> List[Dict]:
+    """query_inventory_frame 的字典列表版本"""
+    return query_inventory_frame(**kwargs).to_dicts()
+
+
+def invalidate_inventory_cache():
+    """使库存快照缓存和查询结果缓存失效"""
+    inventory_cache.invalidate()
+    classified_inventory_cache.invalidate()
+    with _result_caches_lock:
+        _result_caches.clear()
+
+
+def _mode_cache() -> InventorySnapshotCache:
+    """当前查询模式下汇总查询读取的快照缓存"""
+    return classified_inventory_cache if INVENTORY_QUERY_MODE == "classified" else inventory_cache
+
+
+def _active_caches() -> List[InventorySnapshotCache]:
+    """当前查询模式下会被读取的快照缓存"""
+    caches = [inventory_cache]
+    if INVENTORY_QUERY_MODE == "classified":
+        caches.append(classified_inventory_cache)
+    return caches
+
+
+class InventoryRefresher:
+    """
+    库存快照后台刷新
+
+    按固定间隔强制刷新快照，运行期间缓存处于 pinned 状态，
+    查询函数总是直接读取内存中最新的快照，不会有调用方承担 Grafana 的查询延迟。
+
+    caches 指定只刷新哪些缓存（如 watch 只刷新它监听的那一个），None 表示当前查询模式下会被读取的全部缓存。
+    """
+
+    def __init__(self, interval: float = INVENTORY_REFRESH_INTERVAL, caches: Optional[List[InventorySnapshotCache]] = None):
+        self.interval = interval
+        self.caches = caches
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._status = {
+            "running": False,
+            "interval": interval,
+            "refresh_count": 0,
+            "failure_count": 0,
+            "consecutive_failures": 0,
+            "last_attempt_at": None,
+            "last_success_at": None,
+            "last_duration": None,
+            "last_error": None,
+        }
+
+    def refresh_once(self) -> bool:
+        """立即刷新一次，返回是否成功"""
+        started = time.time()
+        errors = []
+        for cache in self._caches():
+            cache.get(force_refresh=True)
+            if cache.last_error is not None:
+                errors.append(str(cache.last_error))
+
+        with self._lock:
+            self._status["refresh_count"] += 1
+            self._status["last_attempt_at"] = started
+            self._status["last_duration"] = time.time() - started
+            if errors:
+                self._status["failure_count"] += 1
+                self._status["consecutive_failures"] += 1
+                self._status["last_error"] = "; ".join(errors)
+            else:
+                self._status["consecutive_failures"] = 0
+                self._status["last_success_at"] = time.time()
+                self._status["last_error"] = None
+        return not errors
+
+    def _caches(self) -> List[InventorySnapshotCache]:
+        return list(self.caches) if self.caches is not None else _active_caches()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh_once()
+            except Exception as e:
+                print(f"库存后台刷新异常: {e}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """启动后台刷新线程（已启动时不重复启动）"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        for cache in self._caches():
+            cache.pinned = True
+        self._thread = threading.Thread(target=self._run, name="inventory-refresher", daemon=True)
+        self._thread.start()
+        with self._lock:
+            self._status["running"] = True
+            self._status["interval"] = self.interval
+
+    def stop(self, timeout: float = 5):
+        """停止后台刷新，缓存恢复按 TTL 过期"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self._thread = None
+        for cache in (inventory_cache, classified_inventory_cache):
+            cache.pinned = False
+        with self._lock:
+            self._status["running"] = False
+
+    def status(self) -> Dict:
+        """刷新状态：次数、失败、最近成功时间、耗时、数据年龄等"""
+        with self._lock:
+            status = dict(self._status)
+        status["data_age"] = _mode_cache().age
+        status["stale"] = is_inventory_stale()
+        status["breaker"] = grafana_breaker.status()
+        return status
+
+
+inventory_refresher = InventoryRefresher()
+
+
+def start_background_refresh(interval: float = None, caches: Optional[List[InventorySnapshotCache]] = None):
+    """启动库存快照后台刷新；caches 为 None 时刷新当前查询模式下会被读取的全部缓存"""
+    if interval is not None:
+        inventory_refresher.interval = interval
+    inventory_refresher.caches = caches
+    inventory_refresher.start()
+
+
+def stop_background_refresh():
+    """停止库存快照后台刷新"""
+    inventory_refresher.stop()
+
+
+def get_refresh_status() -> Dict:
+    """后台刷新状态"""
+    return inventory_refresher.status()
+
+
+def is_inventory_stale() -> bool:
+    """当前库存数据是否为刷新失败后保留的旧快照"""
+    return any(cache.is_stale for cache in _active_caches())
+
+
+def get_inventory_data_time(cache: Optional[InventorySnapshotCache] = None) -> Optional[datetime]:
+    """当前库存数据的查询时间，无数据时为 None；cache 指定读取的缓存，默认为当前查询模式的汇总缓存"""
+    fetched_at = (cache or _mode_cache()).fetched_at
+    return datetime.fromtimestamp(fetched_at) if fetched_at else None
+
+
+_history_store: Optional[InventoryStore] = None
+
+
+def _record_snapshot(frame: GrafanaFrame, fetched_at: float):
+    """快照回调：交给历史库的后台写线程（回调在刷新路径上执行，可能在事件循环里，不能等 SQLite）"""
+    store = _history_store
+    if store is None or not len(frame):
+        return
+    store.submit(lambda: zip(
+        frame.text("gpu_product_name").tolist(),
+        frame.text("idc").tolist(),
+        *(frame.numeric(field).astype(np.int64).tolist() for field in INVENTORY_FIELDS)
+    ), fetched_at)
+
+
+def enable_inventory_history(path: str = None) -> InventoryStore:
+    """
+    开启库存历史记录：之后每次成功刷新的 (gpu_product_name, idc) 快照写入本地 SQLite
+
+    history 只记录按机房聚合的快照；classified 模式下 inventory_cache 仍由
+    get_gpu_inventory_by_region 和后台刷新线程维护。
+    """
+    global _history_store
+    store = InventoryStore(path or INVENTORY_HISTORY_DB or "inventory_history.db")
+    _history_store = store
+    inventory_cache.add_listener(_record_snapshot)
+    return store
+
+
+def disable_inventory_history():
+    """关闭库存历史记录（已写入的数据保留，等待积压的快照写完）"""
+    global _history_store
+    inventory_cache.remove_listener(_record_snapshot)
+    if _history_store is not None:
+        _history_store.flush(timeout=5)
+    _history_store = None
+
+
+def get_inventory_history(
+    gpu_type: str = None,
+    days: float = 7,
+    resolution: int = 3600,
+    field: str = "free",
+    region: str = None,
+    high_freq: bool = None,
+    agg: str = "avg",
+    start: float = None,
+    end: float = None
+) -> List[Dict]:
+    """
+    从本地历史库查询库存趋势（不访问 Grafana）
+
+    Args:
+        gpu_type: GPU 类型（如 "4090"），None 表示全部
+        days: 查询最近多少天（未指定 start 时生效）
+        resolution: 时间粒度（秒），默认按小时
+        field: total / free / used / unavailable
+        region: "国内" / "海外"
+        high_freq: 高主频筛选
+        agg: 同一粒度内多个快照的合并方式 avg / min / max
+
+    Returns:
+        [{"time": datetime, "ts": 时间戳, "value": 数值, "samples": 快照数}, ...]
+    """
+    store = _history_store
+    if store is None:
+        store = enable_inventory_history() if INVENTORY_HISTORY_DB else None
+    if store is None:
+        print("库存历史未开启，请设置 INVENTORY_HISTORY_DB 或调用 enable_inventory_history()")
         return []
 
+    # 包含刚刷新、还在写线程队列里的快照
+    store.flush(timeout=1)
+    end = end if end is not None else time.time()
+    start = start if start is not None else end - days * 86400
+
+    gpu, gpu_like = None, False
+    if gpu_type:
+        model = lookup_gpu_model(gpu_type)
+        if model and model.db_name:
+            gpu = model.db_name
+        else:
+            gpu, gpu_like = gpu_type, True
+
+    idcs = None
+    if region or high_freq is not None:
+        idcs = []
+        for idc in store.list_idcs(gpu if not gpu_like else None):
+            info = idc_registry.get(idc)
+            if region and info.region != region:
+                continue
+            if high_freq is not None and info.is_high_freq != high_freq:
+                continue
+            idcs.append(idc)
+
+    points = store.query_range(
+        gpu, start=start, end=end, resolution=resolution, field=field,
+        agg=agg, idcs=idcs, gpu_like=gpu_like
+    )
+    for point in points:
+        point["time"] = datetime.fromtimestamp(point["ts"])
+        point["value"] = _as_number(round(point["value"], 2))
+    return points
+
+
+if INVENTORY_HISTORY_DB:
+    enable_inventory_history()
+
+
+def _match_gpu_name(gpu_name: str, gpu_type: str) -> bool:
+    """判断数据库中的 GPU 名称是否符合用户输入的类型（已知类型精确匹配，否则模糊匹配）"""
+    model = lookup_gpu_model(gpu_type)
+    if model and model.db_name:
+        return gpu_name == model.db_name
+    # 与 MySQL LIKE '%xxx%' 的默认排序规则一致，不区分大小写
+    return gpu_type.lower() in (gpu_name or "").lower()
+
+
+class IdcInfo(NamedTuple):
+    """机房维度信息"""
+    idc: str
+    region: str          # "国内" / "海外"
+    is_overseas: bool
+    is_high_freq: bool
+    supplier: str
+
+
+class IdcRegistry:
+    """
+    机房维度表
+
+    每个机房只按关键词分类一次，结果放在有上限的 LRU 缓存里；
+    OVERSEAS_IDC_KEYWORDS / HIGH_FREQ_IDC_KEYWORDS / IDC_SUPPLIER_KEYWORDS
+    变化（包括原地修改列表）后，下一次查询时自动清空缓存。
+    """
+
+    def __init__(self, maxsize: int = IDC_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._cache: "OrderedDict[str, IdcInfo]" = OrderedDict()
+        self._signature = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _keywords_signature() -> Tuple:
+        return (
+            tuple(OVERSEAS_IDC_KEYWORDS),
+            tuple(HIGH_FREQ_IDC_KEYWORDS),
+            tuple(IDC_SUPPLIER_KEYWORDS.items()),
+        )
+
+    @staticmethod
+    def _classify(idc: str) -> IdcInfo:
+        idc_lower = idc.lower()
+        is_overseas = any(keyword in idc_lower for keyword in OVERSEAS_IDC_KEYWORDS)
+        is_high = any(keyword in idc_lower for keyword in HIGH_FREQ_IDC_KEYWORDS)
+        supplier = next(
+            (name for keyword, name in IDC_SUPPLIER_KEYWORDS.items() if keyword in idc_lower), ""
+        )
+        return IdcInfo(idc, "海外" if is_overseas else "国内", is_overseas, is_high, supplier)
+
+    def get(self, idc: str) -> IdcInfo:
+        """查询机房分类（带缓存）"""
+        idc = idc or ""
+        signature = self._keywords_signature()
+        with self._lock:
+            if signature != self._signature:
+                self._cache.clear()
+                self._signature = signature
+            info = self._cache.get(idc)
+            if info is not None:
+                self._cache.move_to_end(idc)
+                self.hits += 1
+                return info
+
+        info = self._classify(idc)
+        with self._lock:
+            self.misses += 1
+            self._cache[idc] = info
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return info
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._cache.clear()
+            self._signature = None
+
+    def table(self, idcs=None) -> GrafanaFrame:
+        """
+        机房维度表（列式），可按 idc 列与库存快照关联
+
+        Args:
+            idcs: 机房列表，为空时使用当前库存快照中出现的全部机房
+        """
+        if idcs is None:
+            idcs = get_inventory_snapshot().text("idc")
+        infos = [self.get(idc) for idc in sorted(set(idcs))]
+        return GrafanaFrame.from_dicts([info._asdict() for info in infos])
+
+
+idc_registry = IdcRegistry()
+
+
+def classify_idc(idc: str) -> IdcInfo:
+    """查询机房的地区、是否高主频、供应商"""
+    return idc_registry.get(idc)
+
+
+def get_idc_dimension_table(idcs=None) -> GrafanaFrame:
+    """机房维度表，见 IdcRegistry.table"""
+    return idc_registry.table(idcs)
+
 
 def is_overseas_idc(idc: str) -> bool:
     """判断是否为海外机房"""
     if not idc:
         return False
-    idc_lower = idc.lower()
-    return any(keyword in idc_lower for keyword in OVERSEAS_IDC_KEYWORDS)
+    return idc_registry.get(idc).is_overseas
 
 
 def is_high_freq_idc(idc: str) -> bool:
     """判断是否为高主频机房（bingte 供应商）"""
     if not idc:
         return False
-    idc_lower = idc.lower()
-    return any(keyword in idc_lower for keyword in HIGH_FREQ_IDC_KEYWORDS)
+    return idc_registry.get(idc).is_high_freq
+
+
+# 库存汇总字段
+INVENTORY_FIELDS = ("total", "free", "used", "unavailable")
+
+
+def _classify_idc_column(idc: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """对机房列分类，每个不同的机房只判断一次，返回 (is_overseas, is_high_freq) 布尔数组"""
+    unique_idc, inverse = np.unique(idc, return_inverse=True)
+    infos = [idc_registry.get(x) for x in unique_idc]
+    overseas = np.array([info.is_overseas for info in infos], dtype=bool)
+    high = np.array([info.is_high_freq for info in infos], dtype=bool)
+    return overseas[inverse], high[inverse]
+
+
+def _mode_snapshot() -> GrafanaFrame:
+    """按 INVENTORY_QUERY_MODE 取对应的快照"""
+    if INVENTORY_QUERY_MODE == "classified":
+        return get_classified_inventory_snapshot()
+    return get_inventory_snapshot()
+
+
+async def _mode_snapshot_async() -> GrafanaFrame:
+    if INVENTORY_QUERY_MODE == "classified":
+        return await get_classified_inventory_snapshot_async()
+    return await get_inventory_snapshot_async()
+
+
+def _as_number(value: float):
+    """汇总结果为整数时返回 int"""
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def _compact(values: np.ndarray) -> np.ndarray:
+    """整数且不超过 int32 范围时降为 int32"""
+    if values.dtype.kind in "iu" or (values.size and np.all(np.mod(values, 1) == 0)):
+        if not values.size or np.abs(values).max() < 2 ** 31:
+            return values.astype(np.int32)
+        return values.astype(np.int64)
+    return values.astype(np.float64)
+
+
+class InventoryCube:
+    """
+    库存立方体
+
+    每份快照只构建一次，之后任意 (gpu_type, region, high_freq) 组合都是数组下标或字典查找：
 
+    - cells[g, r, h, f]：GPU 型号 × 地区（国内/海外/全部）× 高主频（普通/高主频/全部）× 字段，
+      最后一个 GPU 下标为"全部型号"，"全部"一档均为预先汇总好的边际值；
+      row_counts 记录每个格子由多少行快照组成，为 0 表示没有数据
+    - 按机房聚合的快照额外保存 GPU × 机房 的行（按 total 降序），GPU 维度用偏移量切片
 
-def get_all_gpu_inventory(region: str = None, high_freq: bool = None) -> List[Dict]:
+    全部为定长 NumPy 数组（计数降为 int32），一份立方体只有几十 KB，保留多份历史也不占多少内存。
+    用户输入的 gpu_type 到 GPU 下标的解析和各查询的结果在立方体内按参数缓存。
+    """
+
+    # 地区 / 高主频维度的下标，2 为"全部"
+    REGION_INDEX = {"国内": 0, "海外": 1}
+    ALL = 2
+
+    def __init__(self, frame: GrafanaFrame):
+        names = frame.text("gpu_product_name")
+        # 空快照按机房快照处理，by_idc 返回空列表
+        if "idc" in frame or not len(frame):
+            idc = frame.text("idc")
+            is_overseas, is_high = _classify_idc_column(idc)
+        else:
+            idc = None
+            is_overseas = frame.text("region") == "海外"
+            is_high = frame.numeric("is_high_freq").astype(bool)
+
+        self.gpus, gpu_index = np.unique(names, return_inverse=True)
+        self.gpus = self.gpus.astype(object)
+        num_gpus = len(self.gpus)
+        values = np.stack([frame.numeric(field) for field in INVENTORY_FIELDS], axis=1) \
+            if len(frame) else np.zeros((0, len(INVENTORY_FIELDS)))
+        region_index = is_overseas.astype(np.intp)
+        high_index = is_high.astype(np.intp)
+
+        cells = np.zeros((num_gpus + 1, 3, 3, len(INVENTORY_FIELDS)), dtype=np.float64)
+        row_counts = np.zeros((num_gpus + 1, 3, 3), dtype=np.int32)
+        np.add.at(cells, (gpu_index, region_index, high_index), values)
+        np.add.at(row_counts, (gpu_index, region_index, high_index), 1)
+        for grid in (cells, row_counts):
+            grid[:, self.ALL] = grid[:, :self.ALL].sum(axis=1)
+            grid[:, :, self.ALL] = grid[:, :, :self.ALL].sum(axis=2)
+            grid[num_gpus] = grid[:num_gpus].sum(axis=0)
+        self.cells = _compact(cells)
+        self.row_counts = row_counts
+
+        self.has_idc = idc is not None
+        if self.has_idc:
+            # 行按 total 降序（相同时保持快照顺序），同一 GPU 的行再按 GPU 分组成连续切片
+            order = np.argsort(-values[:, 0], kind="stable")
+            self.idc_names, idc_codes = np.unique(idc, return_inverse=True)
+            self.idc_names = self.idc_names.astype(object)
+            self.row_gpu = gpu_index[order].astype(np.int32)
+            self.row_idc = idc_codes[order].astype(np.int32)
+            self.row_overseas = is_overseas[order]
+            self.row_high = is_high[order]
+            self.row_values = _compact(values[order])
+            self._gpu_rows = np.argsort(self.row_gpu, kind="stable").astype(np.int32)
+            self._gpu_offsets = np.searchsorted(self.row_gpu[self._gpu_rows], np.arange(num_gpus + 1))
+
+        self.signature = IdcRegistry._keywords_signature()
+        self._gpu_lookup: Dict[str, Tuple[int, ...]] = {}
+        self._results: Dict[Tuple, Any] = {}
+
+    def __len__(self) -> int:
+        return len(self.gpus)
+
+    @property
+    def nbytes(self) -> int:
+        """立方体数组占用的字节数"""
+        arrays = [self.cells, self.row_counts]
+        if self.has_idc:
+            arrays += [self.row_gpu, self.row_idc, self.row_overseas, self.row_high,
+                       self.row_values, self._gpu_rows, self._gpu_offsets]
+        return sum(array.nbytes for array in arrays)
+
+    def gpu_indices(self, gpu_type: str) -> Tuple[int, ...]:
+        """用户输入的 GPU 类型对应的 GPU 下标（已知类型精确匹配，否则模糊匹配）"""
+        indices = self._gpu_lookup.get(gpu_type)
+        if indices is None:
+            indices = tuple(i for i, name in enumerate(self.gpus) if _match_gpu_name(name, gpu_type))
+            self._gpu_lookup[gpu_type] = indices
+        return indices
+
+    @classmethod
+    def _axes(cls, region: str = None, high_freq: bool = None) -> Tuple[int, int]:
+        r = cls.REGION_INDEX.get(region, cls.ALL)
+        if high_freq is True:
+            h = 1
+        elif high_freq is False:
+            h = 0
+        else:
+            h = cls.ALL
+        return r, h
+
+    def _fields(self, g: int, r: int, h: int) -> List:
+        return [_as_number(value) for value in self.cells[g, r, h].tolist()]
+
+    def _cached(self, key: Tuple, build: Callable[[], Any]) -> Any:
+        if key not in self._results:
+            self._results[key] = build()
+        return self._results[key]
+
+    def summarize_all(self, region: str = None, high_freq: bool = None) -> List[GpuInventory]:
+        """按 (GPU 型号, 普通/高主频) 汇总，按总数降序"""
+        def build():
+            r, h = self._axes(region, high_freq)
+            levels = (0, 1) if h == self.ALL else (h,)
+            result = []
+            for g, name in enumerate(self.gpus):
+                for level in levels:
+                    if self.row_counts[g, r, level]:
+                        result.append(GpuInventory(name, bool(level), *self._fields(g, r, level)))
+            result.sort(key=lambda x: x.total, reverse=True)
+            return result
+
+        # 记录只读，缓存的结果可以直接共享，只复制列表
+        return list(self._cached(("all", region, high_freq), build))
+
+    def summarize_type(self, gpu_type: str, region: str = None, high_freq: bool = None) -> Optional[GpuInventory]:
+        """单个 GPU 类型的汇总，无数据时为 None"""
+        def build():
+            r, h = self._axes(region, high_freq)
+            indices = [g for g in self.gpu_indices(gpu_type) if self.row_counts[g, r, h]]
+            if not indices:
+                return None
+            sums = [_as_number(value) for value in self.cells[indices, r, h].sum(axis=0).tolist()]
+            # 模糊匹配到多个型号时取总数最多的型号名
+            name = self.gpus[max(indices, key=lambda g: self.cells[g, r, h, 0])]
+            return GpuInventory(name, high_freq if high_freq is not None else False, *sums)
+
+        return self._cached(("type", gpu_type, region, high_freq), build)
+
+    def by_idc(self, gpu_type: str = None, region: str = None) -> List[IdcInventory]:
+        """按机房列出库存（需要按机房聚合的快照），按总数降序"""
+        if not self.has_idc:
+            raise ValueError("库存立方体没有机房维度")
+
+        def build():
+            if gpu_type:
+                slices = [
+                    self._gpu_rows[self._gpu_offsets[g]:self._gpu_offsets[g + 1]]
+                    for g in self.gpu_indices(gpu_type)
+                ]
+                rows = np.sort(np.concatenate(slices)) if slices else np.zeros(0, dtype=np.int32)
+            else:
+                rows = np.arange(len(self.row_gpu))
+            if region == "海外":
+                rows = rows[self.row_overseas[rows]]
+            elif region == "国内":
+                rows = rows[~self.row_overseas[rows]]
+
+            return [
+                IdcInventory(
+                    self.gpus[self.row_gpu[i]],
+                    self.idc_names[self.row_idc[i]],
+                    bool(self.row_overseas[i]),
+                    bool(self.row_high[i]),
+                    *(_as_number(value) for value in self.row_values[i, :3].tolist())
+                )
+                for i in rows
+            ]
+
+        return list(self._cached(("idc", gpu_type, region), build))
+
+
+# 最近几份快照的立方体，按快照列字典的身份查找（旧快照副本与原快照共用同一个立方体）
+INVENTORY_CUBE_CACHE_SIZE = int(os.getenv("INVENTORY_CUBE_CACHE_SIZE", "8"))
+_cube_cache: "OrderedDict[int, Tuple[Dict, InventoryCube]]" = OrderedDict()
+_cube_lock = threading.Lock()
+
+
+def get_inventory_cube(frame: GrafanaFrame) -> InventoryCube:
+    """获取快照对应的库存立方体（每份快照只构建一次，机房关键词变化后重建）"""
+    key = id(frame.columns)
+    signature = IdcRegistry._keywords_signature()
+    with _cube_lock:
+        entry = _cube_cache.get(key)
+        if entry is not None and entry[0] is frame.columns and entry[1].signature == signature:
+            _cube_cache.move_to_end(key)
+            return entry[1]
+
+    cube = InventoryCube(frame)
+    with _cube_lock:
+        # 保存列字典的引用，避免其被回收后 id 被复用
+        _cube_cache[key] = (frame.columns, cube)
+        _cube_cache.move_to_end(key)
+        while len(_cube_cache) > INVENTORY_CUBE_CACHE_SIZE:
+            _cube_cache.popitem(last=False)
+    return cube
+
+
+def _summarize_all(frame: GrafanaFrame, region: str = None, high_freq: bool = None) -> List[GpuInventory]:
+    return get_inventory_cube(frame).summarize_all(region, high_freq)
+
+
+def _summarize_type(frame: GrafanaFrame, gpu_type: str, region: str = None, high_freq: bool = None) -> Optional[GpuInventory]:
+    return get_inventory_cube(frame).summarize_type(gpu_type, region, high_freq)
+
+
+def _summarize_by_region(frame: GrafanaFrame, gpu_type: str = None, region: str = None) -> List[IdcInventory]:
+    return get_inventory_cube(frame).by_idc(gpu_type, region)
+
+
+def get_current_inventory_cube(force_refresh: bool = False) -> InventoryCube:
+    """
+    当前查询模式下最新快照的库存立方体
+
+    需要对同一时刻的库存做多次判断（如按多个阈值检查）时，先取一次立方体再在内存中逐项查询，
+    最多一次 Grafana 往返，所有结果对应同一份快照。
+    """
+    if INVENTORY_QUERY_MODE == "classified":
+        frame = get_classified_inventory_snapshot(force_refresh)
+    else:
+        frame = get_inventory_snapshot(force_refresh)
+    return get_inventory_cube(frame)
+
+
+def get_all_gpu_inventory(region: str = None, high_freq: bool = None) -> List[GpuInventory]:
     """
     获取所有 GPU 库存汇总
 
+    返回 GpuInventory 只读记录，支持 item["free"] / item.get("free") 等字典式访问，
+    需要普通字典时用 item.to_dict()
+
     Args:
         region: "国内" 或 "海外"，None 表示全部
         high_freq: True 表示高主频，False 表示普通，None 表示全部
     """
-    sql = '''
-        SELECT
-            gpu_product_name,
-            idc,
-            SUM(total_gpu_num) as total,
-            SUM(free_gpu_num) as free,
-            SUM(used_gpu_num) as used,
-            SUM(unavailable_gpu_num) as unavailable
-        FROM nexus.nexus_nodes_v2
-        WHERE (deleted_time IS NULL OR deleted_time = 0)
-          AND gpu_product_name != ''
-        GROUP BY gpu_product_name, idc
-    '''
-
-    rows = query_grafana(sql)
-
-    # 按 GPU 类型和高主频/普通分类汇总
-    gpu_data = {}  # key: (gpu_name, is_high_freq), value: {total, free, used, unavailable}
-
-    for row in rows:
-        gpu_name = row.get("gpu_product_name", "")
-        idc = row.get("idc", "")
-        total = row.get("total", 0) or 0
-        free = row.get("free", 0) or 0
-        used = row.get("used", 0) or 0
-        unavailable = row.get("unavailable", 0) or 0
-
-        # 区域过滤
-        is_overseas = is_overseas_idc(idc)
-        if region == "海外" and not is_overseas:
-            continue
-        if region == "国内" and is_overseas:
-            continue
-
-        # 高主频过滤
-        is_high = is_high_freq_idc(idc)
-        if high_freq is True and not is_high:
-            continue
-        if high_freq is False and is_high:
-            continue
-
-        # 汇总
-        key = (gpu_name, is_high)
-        if key not in gpu_data:
-            gpu_data[key] = {"total": 0, "free": 0, "used": 0, "unavailable": 0}
-
-        gpu_data[key]["total"] += total
-        gpu_data[key]["free"] += free
-        gpu_data[key]["used"] += used
-        gpu_data[key]["unavailable"] += unavailable
-
-    # 转换为列表格式
-    result = []
-    for (gpu_name, is_high), data in gpu_data.items():
-        result.append({
-            "name": gpu_name,
-            "is_high_freq": is_high,
-            "total": data["total"],
-            "free": data["free"],
-            "used": data["used"],
-            "unavailable": data["unavailable"]
-        })
-
-    # 按总数降序排序
-    result.sort(key=lambda x: x["total"], reverse=True)
-    return result
-
-
-def get_gpu_inventory_by_type(gpu_type: str, region: str = None, high_freq: bool = None) -> Optional[Dict]:
+    return _summarize_all(_mode_snapshot(), region, high_freq)
+
+
+def get_gpu_inventory_by_type(gpu_type: str, region: str = None, high_freq: bool = None) -> Optional[GpuInventory]:
     """
     按 GPU 类型查询库存
 
@@ -202,143 +2060,167 @@ def get_gpu_inventory_by_type(gpu_type: str, region: str = None, high_freq: bool
         region: "国内" 或 "海外"，None 表示全部
         high_freq: True 表示高主频，False 表示普通，None 表示全部
     """
-    # 映射用户输入到数据库名称
-    gpu_type_upper = gpu_type.upper()
-    db_gpu_name = GPU_TYPE_MAP.get(gpu_type_upper)
-
-    if db_gpu_name:
-        # 精确匹配
-        sql = f'''
-            SELECT
-                gpu_product_name,
-                idc,
-                SUM(total_gpu_num) as total,
-                SUM(free_gpu_num) as free,
-                SUM(used_gpu_num) as used,
-                SUM(unavailable_gpu_num) as unavailable
-            FROM nexus.nexus_nodes_v2
-            WHERE (deleted_time IS NULL OR deleted_time = 0)
-              AND gpu_product_name = '{db_gpu_name}'
-            GROUP BY gpu_product_name, idc
-        '''
-    else:
-        # 模糊匹配
-        sql = f'''
-            SELECT
-                gpu_product_name,
-                idc,
-                SUM(total_gpu_num) as total,
-                SUM(free_gpu_num) as free,
-                SUM(used_gpu_num) as used,
-                SUM(unavailable_gpu_num) as unavailable
-            FROM nexus.nexus_nodes_v2
-            WHERE (deleted_time IS NULL OR deleted_time = 0)
-              AND gpu_product_name LIKE '%{gpu_type}%'
-            GROUP BY gpu_product_name, idc
-        '''
-
-    rows = query_grafana(sql)
-
-    # 汇总数据
-    result = {"total": 0, "free": 0, "used": 0, "unavailable": 0, "name": None}
-
-    for row in rows:
-        gpu_name = row.get("gpu_product_name", "")
-        idc = row.get("idc", "")
-        total = row.get("total", 0) or 0
-        free = row.get("free", 0) or 0
-        used = row.get("used", 0) or 0
-        unavailable = row.get("unavailable", 0) or 0
-
-        # 区域过滤
-        is_overseas = is_overseas_idc(idc)
-        if region == "海外" and not is_overseas:
-            continue
-        if region == "国内" and is_overseas:
-            continue
-
-        # 高主频过滤
-        is_high = is_high_freq_idc(idc)
-        if high_freq is True and not is_high:
-            continue
-        if high_freq is False and is_high:
-            continue
-
-        result["name"] = gpu_name
-        result["total"] += total
-        result["free"] += free
-        result["used"] += used
-        result["unavailable"] += unavailable
-
-    if result["name"]:
-        result["is_high_freq"] = high_freq if high_freq is not None else False
-        return result
-    return None
+    return _summarize_type(_mode_snapshot(), gpu_type, region, high_freq)
 
 
-def get_gpu_inventory_by_region(gpu_type: str = None, region: str = None) -> List[Dict]:
+def get_gpu_inventory_by_region(gpu_type: str = None, region: str = None) -> List[IdcInventory]:
     """按地区查询 GPU 库存"""
-    sql = '''
-        SELECT
-            gpu_product_name,
-            idc,
-            SUM(total_gpu_num) as total,
-            SUM(free_gpu_num) as free,
-            SUM(used_gpu_num) as used
-        FROM nexus.nexus_nodes_v2
-        WHERE (deleted_time IS NULL OR deleted_time = 0)
-          AND gpu_product_name != ''
-    '''
-
-    if gpu_type:
-        gpu_type_upper = gpu_type.upper()
-        db_gpu_name = GPU_TYPE_MAP.get(gpu_type_upper)
-        if db_gpu_name:
-            sql += f" AND gpu_product_name = '{db_gpu_name}'"
-        else:
-            sql += f" AND gpu_product_name LIKE '%{gpu_type}%'"
-
-    sql += ' GROUP BY gpu_product_name, idc ORDER BY total DESC'
-
-    rows = query_grafana(sql)
-
-    result = []
-    for row in rows:
-        idc = row.get("idc", "")
-
-        # 区域过滤
-        is_overseas = is_overseas_idc(idc)
-        if region == "海外" and not is_overseas:
-            continue
-        if region == "国内" and is_overseas:
-            continue
-
-        result.append({
-            "name": row.get("gpu_product_name", ""),
-            "idc": idc,
-            "is_overseas": is_overseas,
-            "is_high_freq": is_high_freq_idc(idc),
-            "total": row.get("total", 0) or 0,
-            "free": row.get("free", 0) or 0,
-            "used": row.get("used", 0) or 0
-        })
+    return _summarize_by_region(get_inventory_snapshot(), gpu_type, region)
+
+
+async def get_all_gpu_inventory_async(region: str = None, high_freq: bool = None) -> List[GpuInventory]:
+    """get_all_gpu_inventory 的异步版本"""
+    return _summarize_all(await _mode_snapshot_async(), region, high_freq)
+
+
+async def get_gpu_inventory_by_type_async(gpu_type: str, region: str = None, high_freq: bool = None) -> Optional[GpuInventory]:
+    """get_gpu_inventory_by_type 的异步版本"""
+    return _summarize_type(await _mode_snapshot_async(), gpu_type, region, high_freq)
+
+
+async def get_gpu_inventory_by_region_async(gpu_type: str = None, region: str = None) -> List[IdcInventory]:
+    """get_gpu_inventory_by_region 的异步版本"""
+    return _summarize_by_region(await get_inventory_snapshot_async(), gpu_type, region)
+
+
+def _node_query(
+    filter: InventoryFilter,
+    order_by: str,
+    descending: bool,
+    limit: int,
+    after: Optional[Tuple[Any, Any]] = None
+) -> str:
+    return render_inventory_sql(InventoryQuery(filter, (), order_by, descending, limit, after))
+
+
+def _next_page(
+    page: GrafanaFrame,
+    order_by: str,
+    page_limit: int,
+    remaining: Optional[int]
+) -> Tuple[Optional[Tuple[Any, Any]], Optional[int]]:
+    """返回 (下一页的 after, 剩余条数)，没有下一页时 after 为 None"""
+    count = len(page)
+    if remaining is not None:
+        remaining -= count
+    if count < page_limit or (remaining is not None and remaining <= 0):
+        return None, remaining
+    last = page.row(count - 1)
+    return (last.get(order_by) if order_by != "id" else None, last["node_id"]), remaining
+
+
+def iter_node_pages(
+    gpu_type: str = None,
+    region: str = None,
+    high_freq: bool = None,
+    idc: str = None,
+    min_free: int = None,
+    order_by: str = "free",
+    descending: bool = True,
+    page_size: int = None,
+    limit: int = None,
+    cached: bool = False
+) -> Iterator[GrafanaFrame]:
+    """
+    逐页查询节点（生成器），每页一个 GrafanaFrame
 
-    return result
+    每页是一条 ORDER BY (order_by, 节点主键) LIMIT n 的查询，下一页从上一页最后一行的
+    (排序值, 主键) 之后开始（keyset 分页），不使用 OFFSET，翻到多深都只扫描一页的数据。
+    某一页查询失败时抛出异常（cached 时也不使用旧快照），不会把失败当成最后一页而返回不完整的结果。
 
+    Args:
+        gpu_type: GPU 类型，如 "H100"
+        region: "国内" / "海外"
+        high_freq: 高主频筛选
+        idc: 只查某个机房
+        min_free: 空闲卡数下限
+        order_by: total / free / used / unavailable / id
+        descending: 是否降序
+        page_size: 每页行数
+        limit: 最多返回的节点数（top-N），None 表示全部
+        cached: 每页经过结果缓存（按 SQL 文本共享），见 query_inventory_frame
+    """
+    page_size = max(int(page_size or INVENTORY_NODE_PAGE_SIZE), 1)
+    filter = make_filter(gpu_type, region, high_freq, idc, min_free)
+    # 某页失败时必须抛出异常：空页会被当成最后一页，调用方拿到看似完整的部分结果
+    fetch = partial(_cached_query_frame, strict=True) if cached else _execute_grafana_frame
+    after = None
+    remaining = limit
+    while remaining is None or remaining > 0:
+        page_limit = page_size if remaining is None else min(page_size, remaining)
+        page = fetch(_node_query(filter, order_by, descending, page_limit, after))
+        if len(page):
+            yield page
+        after, remaining = _next_page(page, order_by, page_limit, remaining)
+        if after is None:
+            return
+
+
+def iter_nodes(**kwargs) -> Iterator[Dict]:
+    """逐个产出节点字典，参数见 iter_node_pages"""
+    for page in iter_node_pages(**kwargs):
+        yield from page.rows()
+
+
+def get_top_nodes(gpu_type: str = None, n: int = 10, order_by: str = "free", **kwargs) -> List[Dict]:
+    """
+    按 order_by 取前 n 个节点（服务端 ORDER BY ... LIMIT n，结果经过缓存）
 
-def format_inventory_message(inventory: List[Dict]) -> str:
-    """格式化库存信息为消息"""
+    例：get_top_nodes("H100", n=20, min_free=8) 返回有 8 张及以上空闲 H100 的节点
+    查询失败时抛出异常。
+    """
+    kwargs.setdefault("cached", True)
+    return list(iter_nodes(gpu_type=gpu_type, order_by=order_by, limit=n, page_size=n, **kwargs))
+
+
+async def iter_node_pages_async(
+    gpu_type: str = None,
+    region: str = None,
+    high_freq: bool = None,
+    idc: str = None,
+    min_free: int = None,
+    order_by: str = "free",
+    descending: bool = True,
+    page_size: int = None,
+    limit: int = None,
+    cached: bool = False
+) -> AsyncIterator[GrafanaFrame]:
+    """iter_node_pages 的异步版本"""
+    page_size = max(int(page_size or INVENTORY_NODE_PAGE_SIZE), 1)
+    filter = make_filter(gpu_type, region, high_freq, idc, min_free)
+    fetch = partial(_cached_query_frame_async, strict=True) if cached else _execute_grafana_frame_async
+    after = None
+    remaining = limit
+    while remaining is None or remaining > 0:
+        page_limit = page_size if remaining is None else min(page_size, remaining)
+        page = await fetch(_node_query(filter, order_by, descending, page_limit, after))
+        if len(page):
+            yield page
+        after, remaining = _next_page(page, order_by, page_limit, remaining)
+        if after is None:
+            return
+
+
+async def iter_nodes_async(**kwargs) -> AsyncIterator[Dict]:
+    """iter_nodes 的异步版本"""
+    async for page in iter_node_pages_async(**kwargs):
+        for row in page.rows():
+            yield row
+
+
+def _format_data_time(data_time: Optional[datetime]) -> str:
+    return f"📅 数据时间: {data_time.strftime('%Y-%m-%d %H:%M:%S')}" if data_time else ""
+
+
+def format_inventory_message(inventory: List[Dict], data_time: Optional[datetime] = None) -> str:
+    """格式化库存信息为消息，传入 data_time 时附带数据时间"""
     if not inventory:
         return "暂无库存数据"
 
     lines = ["📊 GPU 库存汇总\n"]
     for item in inventory:
         # 简化 GPU 名称显示
-        name = item["name"]
-        for short, full in GPU_TYPE_MAP.items():
-            if full == name:
-                name = short
-                break
+        name = short_gpu_name(item["name"])
 
         # 添加高主频标识
         if item.get("is_high_freq"):
@@ -348,46 +2230,46 @@ def format_inventory_message(inventory: List[Dict]) -> str:
         lines.append(f"   总数: {item['total']} | 空闲: {item['free']} | 使用中: {item['used']}")
         lines.append("")
 
+    if data_time:
+        lines.append(_format_data_time(data_time))
+
     return "\n".join(lines)
 
 
-def format_single_gpu_message(gpu_info: Dict, high_freq: bool = None) -> str:
-    """格式化单个 GPU 类型的库存信息"""
+def format_single_gpu_message(gpu_info: Dict, high_freq: bool = None, data_time: Optional[datetime] = None) -> str:
+    """格式化单个 GPU 类型的库存信息，传入 data_time 时附带数据时间"""
     if not gpu_info:
         return "未找到该 GPU 类型的库存信息"
 
-    name = gpu_info["name"]
-    for short, full in GPU_TYPE_MAP.items():
-        if full == name:
-            name = short
-            break
+    name = short_gpu_name(gpu_info["name"])
 
     # 添加高主频标识
     if high_freq is True or gpu_info.get("is_high_freq"):
         name = f"高主频{name}"
 
-    return f"""🖥️ {name} 库存
+    message = f"""🖥️ {name} 库存
 
 总数: {gpu_info['total']} 卡
 空闲: {gpu_info['free']} 卡
 使用中: {gpu_info['used']} 卡
 不可用: {gpu_info['unavailable']} 卡"""
 
+    if data_time:
+        message += "\n\n" + _format_data_time(data_time)
+    return message
+
 
 def parse_user_question(text: str) -> Tuple[Optional[str], Optional[str], Optional[bool]]:
     """
     解析用户问题，提取 GPU 类型、地区和是否高主频
     返回: (gpu_type, region, high_freq)
     """
-    text_upper = text.upper()
     text_lower = text.lower()
 
-    # 识别 GPU 类型
-    gpu_type = None
-    for short_name in GPU_TYPE_MAP.keys():
-        if short_name in text_upper:
-            gpu_type = short_name
-            break
+    # 识别 GPU 类型（最长匹配，"H200" 不会被识别成 "H20"）；
+    # 库存表中没有的型号（db_name 为 None，如 L40）不返回，否则会被模糊匹配成 L40S 等其他型号
+    model = match_gpu_model(text)
+    gpu_type = model.short if model and model.db_name else None
 
     # 识别地区
     region = None
@@ -406,67 +2288,248 @@ def parse_user_question(text: str) -> Tuple[Optional[str], Optional[str], Option
     return gpu_type, region, high_freq
 
 
-async def get_gpu_availability(gpu_type: str, region: str = None, high_freq: bool = None) -> Optional[int]:
+async def get_gpu_availability(
+    gpu_type: str,
+    region: str = None,
+    high_freq: bool = None,
+    budget: float = None,
+    hedge: bool = None
+) -> Optional[int]:
     """
     获取指定 GPU 类型的可用卡数
-    用于飞书机器人问答
+    用于飞书机器人问答，默认使用 INVENTORY_BOT_BUDGET / INVENTORY_BOT_HEDGE 的调用策略，
+    超出时间预算时返回缓存数据
     """
-    gpu_info = get_gpu_inventory_by_type(gpu_type, region=region, high_freq=high_freq)
+    with query_policy(
+        budget=INVENTORY_BOT_BUDGET if budget is None else budget,
+        hedge=INVENTORY_BOT_HEDGE if hedge is None else hedge
+    ):
+        gpu_info = await get_gpu_inventory_by_type_async(gpu_type, region=region, high_freq=high_freq)
     if gpu_info:
         return gpu_info["free"]
     return None
 
 
-# 测试
+# ==================== 命令行 ====================
+
+def format_idc_inventory_message(inventory: List[Dict], data_time: Optional[datetime] = None) -> str:
+    """格式化按机房的库存信息为消息，传入 data_time 时附带数据时间"""
+    if not inventory:
+        return "暂无库存数据"
+
+    lines = ["📊 GPU 机房库存\n"]
+    for item in inventory:
+        name = short_gpu_name(item["name"])
+        if item.get("is_high_freq"):
+            name = f"高主频{name}"
+        region = "海外" if item.get("is_overseas") else "国内"
+        lines.append(f"🏢 {item['idc']}（{region}）{name}")
+        lines.append(f"   总数: {item['total']} | 空闲: {item['free']} | 使用中: {item['used']}")
+        lines.append("")
+
+    if data_time:
+        lines.append(_format_data_time(data_time))
+
+    return "\n".join(lines)
+
+
+def _cli_cache(args) -> InventorySnapshotCache:
+    """命令行视图读取的快照缓存（按机房列出始终读取 inventory_cache）"""
+    return inventory_cache if args.by_idc else _mode_cache()
+
+
+def _cli_view(args) -> List:
+    """命令行参数对应的库存视图（均读取快照缓存）"""
+    if args.by_idc:
+        return get_gpu_inventory_by_region(args.gpu, args.region)
+    if args.gpu:
+        item = get_gpu_inventory_by_type(args.gpu, args.region, args.high_freq)
+        return [item] if item else []
+    return get_all_gpu_inventory(args.region, args.high_freq)
+
+
+def _record_key(record) -> Tuple:
+    return record["name"], record.get("idc"), record.get("is_high_freq")
+
+
+def _diff_views(old: List, new: List) -> List[Tuple[str, Any, Any]]:
+    """比较两次视图，返回 (added / removed / changed, 旧记录, 新记录)"""
+    old_by_key = {_record_key(record): record for record in old}
+    new_by_key = {_record_key(record): record for record in new}
+    changes = []
+    for key, record in new_by_key.items():
+        previous = old_by_key.get(key)
+        if previous is None:
+            changes.append(("added", None, record))
+        elif any(previous[field] != record[field] for field in INVENTORY_FIELDS if field in record):
+            changes.append(("changed", previous, record))
+    for key, record in old_by_key.items():
+        if key not in new_by_key:
+            changes.append(("removed", record, None))
+    return changes
+
+
+def _write_view(args, records: List, out=None, cache: Optional[InventorySnapshotCache] = None):
+    """一次性查询的输出：文本 / JSON / CSV；数据时间取自提供视图的缓存（默认按参数推断）"""
+    out = out or sys.stdout
+    cache = cache or _cli_cache(args)
+    data_time = get_inventory_data_time(cache)
+    if args.json:
+        json.dump({
+            "data_time": data_time.isoformat() if data_time else None,
+            "stale": cache.is_stale,
+            "items": to_dicts(records),
+        }, out, ensure_ascii=False, indent=2)
+        out.write("\n")
+    elif args.csv:
+        if records:
+            writer = csv.DictWriter(out, fieldnames=list(records[0].keys()))
+            writer.writeheader()
+            writer.writerows(to_dicts(records))
+    elif args.by_idc:
+        out.write(format_idc_inventory_message(records, data_time) + "\n")
+    elif args.gpu:
+        message = format_single_gpu_message(records[0] if records else None, args.high_freq, data_time)
+        out.write(message + "\n")
+    else:
+        out.write(format_inventory_message(records, data_time) + "\n")
+
+
+class _DeltaWriter:
+    """watch 模式的变化输出：文本 / JSON Lines / CSV"""
+
+    def __init__(self, args, out=None):
+        self.args = args
+        self.out = out or sys.stdout
+        self._csv = None
+
+    def _text(self, change: str, old, new) -> str:
+        record = new if new is not None else old
+        name = short_gpu_name(record["name"])
+        if record.get("is_high_freq"):
+            name = f"高主频{name}"
+        if record.get("idc"):
+            name = f"{name} @ {record['idc']}"
+        if change == "added":
+            return f"+ {name}: 总数 {new['total']} | 空闲 {new['free']} | 使用中 {new['used']}"
+        if change == "removed":
+            return f"- {name}: 已移除（原空闲 {old['free']}）"
+        return (f"~ {name}: 空闲 {old['free']} → {new['free']}"
+                f" | 总数 {new['total']} | 使用中 {new['used']}")
+
+    def write(self, changes: List[Tuple[str, Any, Any]], ts: float):
+        stamp = datetime.fromtimestamp(ts)
+        for change, old, new in changes:
+            record = new if new is not None else old
+            if self.args.json:
+                self.out.write(json.dumps({
+                    "time": stamp.isoformat(),
+                    "change": change,
+                    "old": old.to_dict() if old is not None else None,
+                    "new": new.to_dict() if new is not None else None,
+                }, ensure_ascii=False) + "\n")
+            elif self.args.csv:
+                if self._csv is None:
+                    self._csv = csv.DictWriter(self.out, fieldnames=["time", "change", *record.keys(), "old_free"])
+                    self._csv.writeheader()
+                row = {"time": stamp.isoformat(), "change": change, **record.to_dict()}
+                row["old_free"] = old["free"] if old is not None else ""
+                self._csv.writerow(row)
+            else:
+                self.out.write(f"[{stamp.strftime('%H:%M:%S')}] {self._text(change, old, new)}\n")
+        self.out.flush()
+
+
+def _watch(args) -> int:
+    """
+    按间隔刷新并只输出变化
+
+    由后台刷新线程按间隔刷新快照（复用同一个 Grafana 会话），每次刷新成功后在内存中重新计算视图，
+    与上一次比较后输出变化；第一次刷新的全部记录作为 added 输出。刷新失败时不输出，旧数据保留。
+    """
+    writer = _DeltaWriter(args)
+    cache = _cli_cache(args)
+    lock = threading.Lock()
+    state = {"previous": [], "ticks": 0}
+    done = threading.Event()
+
+    def on_refresh(frame: GrafanaFrame, fetched_at: float):
+        with lock:
+            current = _cli_view(args)
+            changes = _diff_views(state["previous"], current)
+            state["previous"] = current
+            state["ticks"] += 1
+            writer.write(changes, fetched_at)
+            if args.count and state["ticks"] >= args.count:
+                done.set()
+
+    cache.add_listener(on_refresh)
+    # 只刷新监听的缓存，每次刷新一次 Grafana 请求
+    start_background_refresh(args.watch, caches=[cache])
+    try:
+        while not done.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_background_refresh()
+        cache.remove_listener(on_refresh)
+        close_grafana_session()
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    命令行入口
+
+    示例:
+        python gpu_inventory.py                          # 全部 GPU 库存
+        python gpu_inventory.py 4090 --region 国内 --high-freq
+        python gpu_inventory.py 4090 --by-idc --csv      # 按机房，CSV
+        python gpu_inventory.py --ask "海外4090还有吗" --json
+        python gpu_inventory.py --watch 30               # 每 30 秒刷新，只输出变化
+        python gpu_inventory.py --watch 30 --metrics-port 9108   # 同时在 9108 端口提供 /metrics
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="GPU 库存查询")
+    parser.add_argument("gpu", nargs="?", help="GPU 类型，如 4090、H100，不指定时查询全部")
+    parser.add_argument("--region", choices=("国内", "海外"), help="地区")
+    freq = parser.add_mutually_exclusive_group()
+    freq.add_argument("--high-freq", dest="high_freq", action="store_const", const=True, help="只看高主频")
+    freq.add_argument("--normal", dest="high_freq", action="store_const", const=False, help="只看普通（非高主频）")
+    parser.add_argument("--by-idc", action="store_true", help="按机房列出")
+    parser.add_argument("--ask", metavar="问题", help="用自然语言提问，如 \"国内高主频4090有多少\"")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--json", action="store_true", help="JSON 输出（watch 模式为每行一个变化）")
+    output.add_argument("--csv", action="store_true", help="CSV 输出")
+    parser.add_argument("--watch", type=float, metavar="秒", help="按间隔刷新，只输出变化")
+    parser.add_argument("--count", type=int, default=0, help="watch 模式下刷新多少次后退出，0 表示一直运行")
+    parser.add_argument("--metrics-port", type=int, default=0, help="watch 模式下在该端口提供 /metrics（Prometheus 指标）")
+    args = parser.parse_args(argv)
+
+    if args.ask:
+        gpu_type, region, high_freq = parse_user_question(args.ask)
+        args.gpu = args.gpu or gpu_type
+        args.region = args.region or region
+        args.high_freq = args.high_freq if args.high_freq is not None else high_freq
+
+    if args.watch is not None:
+        if args.watch <= 0:
+            parser.error("--watch 的间隔必须大于 0")
+        if args.metrics_port:
+            start_metrics_server(args.metrics_port)
+        return _watch(args)
+
+    try:
+        records = _cli_view(args)
+        _write_view(args, records, cache=_cli_cache(args))
+    finally:
+        close_grafana_session()
+    return 0 if records else 1
+
+
 if __name__ == "__main__":
-    print("=== 测试 GPU 库存查询 ===\n")
-
-    # 查询所有库存
-    print("1. 所有 GPU 库存:")
-    all_inventory = get_all_gpu_inventory()
-    print(format_inventory_message(all_inventory))
-
-    print("\n" + "="*50 + "\n")
-
-    # 查询国内普通 4090
-    print("2. 查询国内普通 4090 库存:")
-    gpu_4090 = get_gpu_inventory_by_type("4090", region="国内", high_freq=False)
-    print(format_single_gpu_message(gpu_4090))
-
-    print("\n" + "="*50 + "\n")
-
-    # 查询国内高主频 4090
-    print("3. 查询国内高主频 4090 库存:")
-    gpu_4090_high = get_gpu_inventory_by_type("4090", region="国内", high_freq=True)
-    print(format_single_gpu_message(gpu_4090_high, high_freq=True))
-
-    print("\n" + "="*50 + "\n")
-
-    # 查询海外 4090
-    print("4. 查询海外 4090 库存:")
-    gpu_4090_overseas = get_gpu_inventory_by_type("4090", region="海外")
-    print(format_single_gpu_message(gpu_4090_overseas))
-
-    print("\n" + "="*50 + "\n")
-
-    # 查询 5090 库存
-    print("5. 查询 5090 库存:")
-    gpu_5090 = get_gpu_inventory_by_type("5090")
-    print(format_single_gpu_message(gpu_5090))
-
-    print("\n" + "="*50 + "\n")
-
-    # 测试解析用户问题
-    print("6. 测试解析用户问题:")
-    test_questions = [
-        "4090有多少卡",
-        "查一下5090库存",
-        "H100还有多少",
-        "国内A100库存",
-        "高主频4090有多少",
-        "国内高主频5090库存",
-        "海外4090还有吗",
-    ]
-    for q in test_questions:
-        gpu_type, region, high_freq = parse_user_question(q)
-        print(f"  问题: {q} -> GPU: {gpu_type}, 地区: {region}, 高主频: {high_freq}")
+    # 以脚本运行时转到 gpu_inventory 模块执行，inventory_events 等模块 import 到的是同一份缓存
+    import gpu_inventory
+    sys.exit(gpu_inventory.main())
@@ -0,0 +1,98 @@
+"""
+GPU 型号注册表
+库存查询、红线价格查询、工单汇总共用的 GPU 型号别名和匹配器
+"""
+
+import re
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+
+class GpuModel(NamedTuple):
+    """GPU 型号"""
+    short: str                  # 简称，如 "4090"、"H100"
+    db_name: Optional[str]      # nexus_nodes_v2.gpu_product_name 中的名称
+    price_name: Optional[str]   # 红线价格（CMDB）中的型号，None 表示不支持价格查询
+    aliases: Tuple[str, ...]    # 用户消息中可识别的写法
+
+
+GPU_MODELS: List[GpuModel] = [
+    GpuModel("5090", "NVIDIA GeForce RTX 5090", "RTX5090", ("5090", "RTX5090")),
+    GpuModel("4090", "NVIDIA GeForce RTX 4090", "RTX4090", ("4090", "RTX4090")),
+    GpuModel("3090", "NVIDIA GeForce RTX 3090", "RTX3090", ("3090", "RTX3090")),
+    GpuModel("H100", "NVIDIA H100 80GB HBM3", "H100", ("H100", "H100-80GB")),
+    GpuModel("H20", "NVIDIA H20", "H20", ("H20",)),
+    GpuModel("H200", "NVIDIA H200", "H200", ("H200", "H200-141GB")),
+    GpuModel("A100", "NVIDIA A100-SXM4-80GB", "A100", ("A100", "A100-80GB", "A100-40GB")),
+    GpuModel("L40S", "NVIDIA L40S", "L40S", ("L40S",)),
+    GpuModel("L40", None, "L40", ("L40",)),
+    GpuModel("5880", "NVIDIA RTX 5880 Ada Generation", None, ("5880",)),
+    # 价格表中没有 RTX 6000 Ada，沿用 A6000 的红线价格
+    GpuModel("6000", "NVIDIA RTX 6000 Ada Generation", "A6000", ("6000", "RTX6000")),
+    GpuModel("A6000", None, "A6000", ("A6000",)),
+    GpuModel("A800", None, "A800", ("A800",)),
+    GpuModel("H800", None, None, ("H800",)),
+    GpuModel("V100", None, "V100", ("V100",)),
+]
+
+
+class GpuAliasMatcher:
+    """
+    GPU 别名匹配器
+
+    所有别名编译成一个正则，按长度降序排列，在同一位置总是优先匹配最长的别名，
+    因此 "H200" 不会被识别成 "H20"，"A6000" 不会被识别成 "6000"。
+    """
+
+    def __init__(self, models: Iterable[GpuModel]):
+        self._by_alias: Dict[str, GpuModel] = {}
+        for model in models:
+            for alias in (model.short,) + tuple(model.aliases):
+                self._by_alias.setdefault(alias.upper(), model)
+
+        aliases = sorted(self._by_alias, key=len, reverse=True)
+        self._pattern = re.compile("|".join(re.escape(alias) for alias in aliases), re.IGNORECASE)
+
+    def search(self, text: str) -> Optional[GpuModel]:
+        """在文本中查找第一个出现的 GPU 型号"""
+        if not text:
+            return None
+        match = self._pattern.search(text)
+        return self._by_alias[match.group(0).upper()] if match else None
+
+    def find_all(self, text: str) -> List[GpuModel]:
+        """按出现顺序返回文本中的全部 GPU 型号（去重）"""
+        result = []
+        for match in self._pattern.finditer(text or ""):
+            model = self._by_alias[match.group(0).upper()]
+            if model not in result:
+                result.append(model)
+        return result
+
+    def lookup(self, name: str) -> Optional[GpuModel]:
+        """按别名精确查找（不区分大小写）"""
+        if not name:
+            return None
+        return self._by_alias.get(name.strip().upper())
+
+
+gpu_matcher = GpuAliasMatcher(GPU_MODELS)
+
+# 数据库名称 -> 简称
+DB_NAME_TO_SHORT: Dict[str, str] = {
+    model.db_name: model.short for model in GPU_MODELS if model.db_name
+}
+
+
+def match_gpu_model(text: str) -> Optional[GpuModel]:
+    """从用户消息中识别 GPU 型号"""
+    return gpu_matcher.search(text)
+
+
+def lookup_gpu_model(name: str) -> Optional[GpuModel]:
+    """按简称或别名查找 GPU 型号"""
+    return gpu_matcher.lookup(name)
+
+
+def short_gpu_name(db_name: str) -> str:
+    """数据库中的 GPU 名称转换为简称，未知名称原样返回"""
+    return DB_NAME_TO_SHORT.get(db_name, db_name)
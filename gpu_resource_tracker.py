@@ -23,6 +23,8 @@ import threading
 import sys
 import os
 
+from gpu_models import match_gpu_model
+
 try:
     import pandas as pd
     HAS_PANDAS = True
@@ -87,12 +89,8 @@ def save_ticket(data):
 
 def extract_gpu_type(text):
     """从文本中提取 GPU 类型"""
-    gpu_types = ["5090", "4090", "3090", "A100", "H20", "H100", "A800", "H800", "V100"]
-    text = str(text).upper()
-    for gpu in gpu_types:
-        if gpu in text:
-            return gpu
-    return "其他"
+    model = match_gpu_model(str(text))
+    return model.short if model else "其他"
 
 # ============ Excel 导入 ============
 def import_from_excel(file_path):
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地 Grafana /api/ds/query 替身
+按请求 SQL 的 SELECT 列生成合成数据帧，或回放录制的 Grafana 响应，行数（10 ~ 100k）、延迟、错误率可配置，
+不需要生产 Grafana 和 GRAFANA_API_KEY 就能运行 gpu_inventory 和 benchmark_inventory.py
+
+不执行 SQL：WHERE / GROUP BY / ORDER BY 都被忽略，只按 SELECT 列和 LIMIT 决定返回的列和行数。
+
+用法:
+    python grafana_stub_server.py --rows 10000 --latency 0.05
+    GRAFANA_URL=http://127.0.0.1:3300 GRAFANA_API_KEY=stub python gpu_inventory.py
+
+    # 录制一次生产快照（需要 GRAFANA_API_KEY），之后离线回放
+    python grafana_stub_server.py --record snapshot.json
+    python grafana_stub_server.py --replay snapshot.json --rows 50000
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from gpu_models import GPU_MODELS
+
+STUB_HOST = os.getenv("GRAFANA_STUB_HOST", "127.0.0.1")
+STUB_PORT = int(os.getenv("GRAFANA_STUB_PORT", "3300"))
+STUB_ROWS = int(os.getenv("GRAFANA_STUB_ROWS", "1000"))
+STUB_LATENCY = float(os.getenv("GRAFANA_STUB_LATENCY", "0"))
+
+# 合成机房名前缀，覆盖国内 / 海外 / 高主频三类（与 gpu_inventory 的默认关键词对应）
+STUB_IDC_PREFIXES = ("bj-idc", "gz", "sh-pd", "bingte-sh", "bingte-hz", "dallas", "gcore-eu", "canopy-us")
+
+# 合成数据的 GPU 型号
+STUB_GPUS = tuple(model.db_name for model in GPU_MODELS if model.db_name)
+
+_SELECT = re.compile(r"^\s*SELECT\s+(.*?)\s+FROM\s", re.IGNORECASE | re.DOTALL)
+_ALIAS = re.compile(r"\bas\s+([A-Za-z_][A-Za-z0-9_]*)\s*$", re.IGNORECASE)
+_COLUMN = re.compile(r"([A-Za-z_][A-Za-z0-9_]*)\s*$")
+_LIMIT = re.compile(r"\bLIMIT\s+(\d+)\s*$", re.IGNORECASE)
+
+_NUMBER_COLUMNS = {
+    "total": "total", "total_gpu_num": "total",
+    "free": "free", "free_gpu_num": "free",
+    "used": "used", "used_gpu_num": "used",
+    "unavailable": "unavailable", "unavailable_gpu_num": "unavailable",
+}
+
+
+def _split_top_level(text: str) -> List[str]:
+    """按不在括号内的逗号拆分"""
+    parts, depth, start = [], 0, 0
+    for i, char in enumerate(text):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts if part.strip()]
+
+
+def parse_select_columns(sql: str) -> List[str]:
+    """SQL 的输出列名（别名优先），无法识别时返回空列表"""
+    match = _SELECT.search(sql)
+    if not match:
+        return []
+    columns = []
+    for expr in _split_top_level(match.group(1)):
+        alias = _ALIAS.search(expr) or _COLUMN.search(expr)
+        columns.append(alias.group(1) if alias else expr)
+    return columns
+
+
+def parse_limit(sql: str) -> Optional[int]:
+    match = _LIMIT.search(sql.strip())
+    return int(match.group(1)) if match else None
+
+
+class SyntheticTable:
+    """
+    合成节点表
+
+    第 i 行的 (GPU 型号, 机房) 组合互不相同，聚合查询的结果和节点查询的结果都可以直接取前 N 行；
+    数值由固定随机种子生成，多次运行结果一致。
+    """
+
+    def __init__(self, seed: int = 0):
+        self.seed = seed
+        self._columns: Dict[str, List[Any]] = {}
+        self._size = 0
+
+    def _grow(self, rows: int):
+        if rows <= self._size:
+            return
+        rng = random.Random(self.seed)
+        gpus, idcs, totals, frees, useds, unavailables = [], [], [], [], [], []
+        for i in range(rows):
+            gpu = STUB_GPUS[i % len(STUB_GPUS)]
+            k = i // len(STUB_GPUS)
+            idc = f"{STUB_IDC_PREFIXES[k % len(STUB_IDC_PREFIXES)]}-{k // len(STUB_IDC_PREFIXES) + 1}"
+            total = rng.choice((8, 16, 32, 64, 128))
+            used = rng.randint(0, total)
+            unavailable = rng.randint(0, total - used) // 4
+            gpus.append(gpu)
+            idcs.append(idc)
+            totals.append(total)
+            useds.append(used)
+            unavailables.append(unavailable)
+            frees.append(total - used - unavailable)
+        self._columns = {
+            "gpu_product_name": gpus, "idc": idcs,
+            "total": totals, "free": frees, "used": useds, "unavailable": unavailables,
+        }
+        self._size = rows
+
+    def column(self, name: str, rows: int) -> List[Any]:
+        """生成 name 列的前 rows 行"""
+        self._grow(rows)
+        if name in ("gpu_product_name", "idc"):
+            return self._columns[name][:rows]
+        if name in _NUMBER_COLUMNS:
+            return self._columns[_NUMBER_COLUMNS[name]][:rows]
+        if name in ("node_id", "id"):
+            return list(range(1, rows + 1))
+        if name == "hostname":
+            return [f"node-{i + 1:06d}" for i in range(rows)]
+        if name == "region":
+            return ["海外" if idc.startswith(("dallas", "gcore", "canopy")) else "国内"
+                    for idc in self._columns["idc"][:rows]]
+        if name == "is_high_freq":
+            return [1 if idc.startswith("bingte") else 0 for idc in self._columns["idc"][:rows]]
+        return [None] * rows
+
+    def frame(self, columns: Sequence[str], rows: int) -> Dict:
+        """Grafana data frame（schema.fields + data.values）"""
+        fields = []
+        for name in columns:
+            sample = self.column(name, 1)[0] if rows else None
+            field = {"name": name}
+            if isinstance(sample, (int, float)) and not isinstance(sample, bool):
+                field["type"] = "number"
+            elif isinstance(sample, str):
+                field["type"] = "string"
+            fields.append(field)
+        return {
+            "schema": {"fields": fields},
+            "data": {"values": [self.column(name, rows) for name in columns]},
+        }
+
+
+def _resize_frame(frame: Dict, rows: int) -> Dict:
+    """把录制的数据帧重复 / 截断到 rows 行"""
+    values = frame.get("data", {}).get("values", [])
+    if not values or not values[0]:
+        return frame
+    size = len(values[0])
+    resized = [[column[i % size] for i in range(rows)] for column in values]
+    return {"schema": frame.get("schema", {}), "data": {"values": resized}}
+
+
+class GrafanaStubServer:
+    """
+    /api/ds/query 替身
+
+    rows / latency / jitter / error_rate 可在运行中直接修改，下一个请求生效；
+    相同（列、行数）的响应只编码一次，替身本身不成为基准测试的瓶颈。
+
+    Args:
+        rows: 每个查询返回的行数（SQL 带 LIMIT 时取较小值），回放时为 None 表示保持录制的行数
+        latency: 每个请求的固定延迟（秒）
+        jitter: 在 latency 上额外增加 [0, jitter) 的随机延迟
+        error_rate: 返回 502 的概率
+        replay: 录制的 Grafana 响应（{"results": {...}}）或单个数据帧，None 为合成数据
+    """
+
+    def __init__(
+        self,
+        host: str = STUB_HOST,
+        port: int = STUB_PORT,
+        rows: Optional[int] = STUB_ROWS,
+        latency: float = STUB_LATENCY,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        replay: Optional[Dict] = None,
+        seed: int = 0
+    ):
+        self.rows = rows
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.replay = replay
+        self.table = SyntheticTable(seed)
+        self.requests = 0
+        self._rng = random.Random(seed)
+        self._encoded: Dict[Tuple, bytes] = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _replay_frame(self, ref_id: str) -> Dict:
+        if "results" not in self.replay:
+            frame = self.replay
+        else:
+            results = self.replay["results"]
+            result = results.get(ref_id) or next(iter(results.values()), {})
+            frames = result.get("frames", [])
+            frame = frames[0] if frames else {}
+        return _resize_frame(frame, self.rows) if self.rows is not None else frame
+
+    def _query_frame(self, ref_id: str, sql: str) -> Dict:
+        limit = parse_limit(sql)
+        if self.replay is not None:
+            frame = self._replay_frame(ref_id)
+            if limit is not None:
+                values = frame.get("data", {}).get("values", [])
+                frame = {"schema": frame.get("schema", {}), "data": {"values": [column[:limit] for column in values]}}
+            return frame
+        rows = self.rows if self.rows is not None else STUB_ROWS
+        if limit is not None:
+            rows = min(rows, limit)
+        columns = parse_select_columns(sql) or ["gpu_product_name", "idc", "total", "free", "used", "unavailable"]
+        return self.table.frame(columns, rows)
+
+    def response_body(self, queries: List[Dict]) -> bytes:
+        """/api/ds/query 的响应体（同一组查询和行数只编码一次）"""
+        key = (tuple((q.get("refId", "A"), q.get("rawSql", "")) for q in queries), self.rows, id(self.replay))
+        with self._lock:
+            body = self._encoded.get(key)
+        if body is None:
+            results = {
+                q.get("refId", "A"): {"frames": [self._query_frame(q.get("refId", "A"), q.get("rawSql", ""))]}
+                for q in queries
+            }
+            body = json.dumps({"results": results}, ensure_ascii=False).encode("utf-8")
+            with self._lock:
+                if len(self._encoded) >= 64:
+                    self._encoded.clear()
+                self._encoded[key] = body
+        return body
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 响应头和响应体分两次写出，关闭 Nagle 避免与客户端的延迟确认叠加出 40ms 等待
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, body: bytes = b"", content_type: str = "application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/api/health":
+                    self._send(200, b'{"database": "ok", "version": "stub"}')
+                else:
+                    self._send(404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length)
+                if self.path.split("?")[0] != "/api/ds/query":
+                    self._send(404)
+                    return
+                with stub._lock:
+                    stub.requests += 1
+                    delay = stub.latency + (stub._rng.random() * stub.jitter if stub.jitter else 0)
+                    fail = stub.error_rate and stub._rng.random() < stub.error_rate
+                if delay > 0:
+                    time.sleep(delay)
+                if fail:
+                    self._send(502, b'{"message": "stub error"}')
+                    return
+                try:
+                    queries = json.loads(raw or b"{}").get("queries", [])
+                except ValueError:
+                    self._send(400, b'{"message": "invalid json"}')
+                    return
+                self._send(200, stub.response_body(queries))
+
+        return Handler
+
+    def start(self) -> "GrafanaStubServer":
+        """在后台线程中启动"""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+def record_response(path: str, sql: str = None):
+    """用当前 GRAFANA_URL / GRAFANA_API_KEY 执行一次查询，把原始响应保存到 path"""
+    import gpu_inventory
+
+    sql = sql or gpu_inventory.INVENTORY_SNAPSHOT_SQL
+    url, headers, payload = gpu_inventory._grafana_request({"A": sql})
+    response = gpu_inventory.get_grafana_session().post(
+        url, json=payload, headers=headers,
+        timeout=(gpu_inventory.GRAFANA_CONNECT_TIMEOUT, gpu_inventory.GRAFANA_READ_TIMEOUT)
+    )
+    response.raise_for_status()
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(response.json(), f, ensure_ascii=False)
+    frames = response.json().get("results", {}).get("A", {}).get("frames", [])
+    values = frames[0].get("data", {}).get("values", []) if frames else []
+    print(f"已录制 {len(values[0]) if values else 0} 行到 {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 Grafana /api/ds/query 替身")
+    parser.add_argument("--host", default=STUB_HOST)
+    parser.add_argument("--port", type=int, default=STUB_PORT)
+    parser.add_argument("--rows", type=int, default=None, help=f"每个查询返回的行数（合成数据默认 {STUB_ROWS}）")
+    parser.add_argument("--latency", type=float, default=STUB_LATENCY, help="每个请求的延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="额外的随机延迟上限（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 502 的概率")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", help="回放录制的 Grafana 响应文件")
+    parser.add_argument("--record", help="从 GRAFANA_URL 录制一次库存快照到文件后退出")
+    args = parser.parse_args()
+
+    if args.record:
+        record_response(args.record)
+        return
+
+    replay = None
+    if args.replay:
+        with open(args.replay, "r", encoding="utf-8") as f:
+            replay = json.load(f)
+    rows = args.rows if args.rows is not None or replay is not None else STUB_ROWS
+
+    stub = GrafanaStubServer(
+        args.host, args.port, rows=rows, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, replay=replay, seed=args.seed
+    )
+    print("=" * 60)
+    print(f"Grafana 替身已启动: {stub.url}")
+    print(f"  数据: {'回放 ' + args.replay if replay is not None else '合成'}，行数: {rows if rows is not None else '录制行数'}")
+    print(f"  延迟: {args.latency}s + [0, {args.jitter})s，错误率: {args.error_rate}")
+    print(f"  使用: GRAFANA_URL={stub.url} GRAFANA_API_KEY=stub")
+    print("=" * 60)
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -17,11 +17,16 @@ import json
 import os
 import requests
 import schedule
+import threading
 import time
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set, Tuple, Union
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+import feishu_delivery
+import feishu_token
 import gpu_inventory
+import metrics
 
 # 加载环境变量
 load_dotenv()
@@ -29,6 +34,13 @@ load_dotenv()
 # 配置文件路径
 CONFIG_FILE = "inventory_alert_config.json"
 ALERT_HISTORY_FILE = ".inventory_alert_history.json"
+RECEIVE_ID_TYPES_FILE = ".inventory_alert_receive_id_types.json"
+
+# 库存查询的时间预算（秒），定时任务可以等待，默认不限时
+ALERT_QUERY_BUDGET = float(os.getenv("INVENTORY_ALERT_BUDGET", "0"))
+
+# 定时运行时 Prometheus 指标（Grafana 查询耗时、缓存年龄等）的监听端口，0 表示不开启
+ALERT_METRICS_PORT = int(os.getenv("INVENTORY_ALERT_METRICS_PORT", "0"))
 
 # 飞书配置
 APP_ID = os.getenv("FEISHU_APP_ID")
@@ -79,23 +91,149 @@ def should_send_alert(gpu_type: str, history: Dict) -> bool:
 
 
 def get_tenant_access_token() -> Optional[str]:
-    """获取飞书 tenant_access_token"""
-    url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
-    payload = {"app_id": APP_ID, "app_secret": APP_SECRET}
+    """获取飞书 tenant_access_token（进程内缓存，过期前后台刷新）"""
+    return feishu_token.get_tenant_access_token(APP_ID, APP_SECRET)
+
+
+FEISHU_MESSAGE_URL = "https://open.feishu.cn/open-apis/im/v1/messages"
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def get_feishu_session() -> requests.Session:
+    """并发发送共用的 HTTP 会话（连接池大小与发送线程数一致）"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=feishu_delivery.FEISHU_SEND_WORKERS)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def build_alert_card(content: str) -> str:
+    """构建预警卡片并序列化（同一次投递的所有接收人共用）"""
+    return json.dumps({
+        "config": {"wide_screen_mode": True},
+        "header": {
+            "title": {"tag": "plain_text", "content": "⚠️ GPU库存预警"},
+            "template": "orange"
+        },
+        "elements": [
+            {
+                "tag": "div",
+                "text": {"tag": "lark_md", "content": content}
+            }
+        ]
+    }, ensure_ascii=False)
+
+
+class PreparedCard:
+    """
+    已序列化的卡片
+
+    card 为卡片 JSON；逐个发送时请求体中的 content 字段（卡片 JSON 再编码成字符串）也只编码一次，
+    之后每个接收人只需拼上 receive_id，批量发送直接嵌入 card。
+    """
 
+    def __init__(self, card: str):
+        self.card = card
+        self._content = json.dumps(card, ensure_ascii=False)
+
+    def message_body(self, receive_id: str) -> bytes:
+        """im/v1/messages 的请求体"""
+        return (
+            '{"receive_id": %s, "msg_type": "interactive", "content": %s}'
+            % (json.dumps(receive_id, ensure_ascii=False), self._content)
+        ).encode("utf-8")
+
+    def batch_body(self, targets: Dict[str, List[str]]) -> bytes:
+        """message/v4/batch_send 的请求体，targets 为 {"open_ids": [...], "department_ids": [...]} 等"""
+        ids = ", ".join(f'"{field}": {json.dumps(values, ensure_ascii=False)}' for field, values in targets.items())
+        return ('{"msg_type": "interactive", "card": %s, %s}' % (self.card, ids)).encode("utf-8")
+
+
+def _post(token: str, url: str, body: bytes) -> Tuple[feishu_delivery.SendOutcome, Dict]:
+    """POST 已编码的请求体，返回 (结果, 响应中的 data)"""
+    response = get_feishu_session().post(
+        url,
+        headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json; charset=utf-8"},
+        data=body,
+        timeout=10
+    )
     try:
-        response = requests.post(url, json=payload, timeout=10)
-        response.raise_for_status()
         data = response.json()
+    except ValueError:
+        data = {}
+    code = data.get("code", response.status_code if not response.ok else -1)
+    if code == 0:
+        return feishu_delivery.SendOutcome(True, 0), data.get("data") or {}
+    # token 失效时丢弃缓存，重试时重新获取
+    if code in feishu_token.TOKEN_INVALID_CODES:
+        feishu_token.invalidate_tenant_access_token(APP_ID, APP_SECRET, token)
+        return feishu_delivery.SendOutcome(False, code, data.get("msg"), retryable=True), {}
+    outcome = feishu_delivery.SendOutcome(
+        False, code, data.get("msg") or response.text[:200],
+        retryable=feishu_delivery.is_retryable(code, response.status_code)
+    )
+    return outcome, {}
+
+
+def _post_card(token: str, receive_id: str, receive_id_type: str, card: PreparedCard) -> feishu_delivery.SendOutcome:
+    """发送一次卡片消息"""
+    outcome, _ = _post(token, f"{FEISHU_MESSAGE_URL}?receive_id_type={receive_id_type}", card.message_body(receive_id))
+    return outcome
 
-        if data.get("code") == 0:
-            return data["tenant_access_token"]
-        else:
-            print(f"❌ 获取token失败: {data}")
-            return None
-    except Exception as e:
-        print(f"❌ 获取token异常: {e}")
-        return None
+
+# 接收人已确认可用的 receive_id_type
+receive_id_types = feishu_delivery.ReceiveIdTypeCache(RECEIVE_ID_TYPES_FILE)
+
+# 类型未知时依次尝试的 receive_id_type
+PROBE_RECEIVE_ID_TYPES = ("open_id", "user_id")
+
+
+def send_card(user_id: str, card: Union[str, PreparedCard]) -> feishu_delivery.SendOutcome:
+    """
+    发送已序列化的卡片给一个用户
+
+    receive_id_type 依次取：显式写法 / ID 前缀推断 / 之前成功过的类型，确定时只发一次请求；
+    都没有时依次尝试 open_id、user_id，成功的类型记入 receive_id_types（调用方负责 save()）。
+    记住的类型失效（如用户 ID 变更）时忘掉它并重新尝试。
+    """
+    if isinstance(card, str):
+        card = PreparedCard(card)
+    token = get_tenant_access_token()
+    if not token:
+        return feishu_delivery.SendOutcome(False, error="无法获取tenant_access_token", retryable=True)
+
+    receive_id, id_type = feishu_delivery.parse_recipient(user_id)
+    if id_type is not None:
+        return _post_card(token, receive_id, id_type, card)
+
+    learned = receive_id_types.get(receive_id)
+    if learned is not None:
+        outcome = _post_card(token, receive_id, learned, card)
+        if outcome.ok or outcome.retryable:
+            return outcome
+        receive_id_types.forget(receive_id)
+        feishu_delivery.feishu_send_limiter.acquire()
+
+    outcome = None
+    candidates = [t for t in PROBE_RECEIVE_ID_TYPES if t != learned]
+    for i, candidate in enumerate(candidates):
+        if i:
+            # 后续尝试同样计入应用的发送速率
+            feishu_delivery.feishu_send_limiter.acquire()
+        outcome = _post_card(token, receive_id, candidate, card)
+        if outcome.ok:
+            receive_id_types.remember(receive_id, candidate)
+            return outcome
+        if outcome.retryable:
+            return outcome
+    return outcome
 
 
 def send_feishu_message(user_id: str, content: str) -> bool:
@@ -103,69 +241,160 @@ def send_feishu_message(user_id: str, content: str) -> bool:
     发送飞书私聊消息
 
     Args:
-        user_id: 用户ID（open_id 或 user_id）
+        user_id: 用户ID（open_id / user_id，也可以写成 "user_id:xxx" 指定类型）
         content: 消息内容（支持Markdown）
     """
-    token = get_tenant_access_token()
-    if not token:
+    try:
+        outcome = send_card(user_id, build_alert_card(content))
+    except Exception as e:
+        print(f"❌ 发送消息异常: {e}")
         return False
+    finally:
+        receive_id_types.save()
 
-    url = "https://open.feishu.cn/open-apis/im/v1/messages"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-
-    # 构建消息
-    payload = {
-        "receive_id": user_id,
-        "msg_type": "interactive",
-        "content": json.dumps({
-            "config": {"wide_screen_mode": True},
-            "header": {
-                "title": {"tag": "plain_text", "content": "⚠️ GPU库存预警"},
-                "template": "orange"
-            },
-            "elements": [
-                {
-                    "tag": "div",
-                    "text": {"tag": "lark_md", "content": content}
-                }
-            ]
-        }, ensure_ascii=False)
-    }
+    if outcome.ok:
+        print(f"✅ 消息发送成功 ({user_id})")
+    else:
+        print(f"❌ 消息发送失败: {outcome.code} {outcome.error}")
+    return outcome.ok
 
-    try:
-        # 先尝试 open_id
-        response = requests.post(
-            url + "?receive_id_type=open_id",
-            headers=headers,
-            json=payload,
-            timeout=10
-        )
 
-        if response.json().get("code") == 0:
-            print(f"✅ 消息发送成功 (open_id: {user_id})")
-            return True
+FEISHU_BATCH_SEND_URL = "https://open.feishu.cn/open-apis/message/v4/batch_send/"
 
-        # 如果失败，尝试 user_id
-        response = requests.post(
-            url + "?receive_id_type=user_id",
-            headers=headers,
-            json=payload,
-            timeout=10
-        )
+# 同一条预警发给多个用户时使用批量发送接口（应用需要开通批量发送消息权限），不可用时逐个发送
+ALERT_BATCH_SEND = os.getenv("INVENTORY_ALERT_BATCH_SEND", "true").lower() == "true"
+
+# 可批量发送的用户数达到多少时才使用批量接口
+ALERT_BATCH_MIN = int(os.getenv("INVENTORY_ALERT_BATCH_MIN", "2"))
+
+# 批量发送每次请求最多的 ID 数
+FEISHU_BATCH_SIZE = 200
+
+# 批量接口支持的 receive_id_type -> 请求字段（群聊、邮箱只能逐个发送）
+BATCH_ID_FIELDS = {"open_id": "open_ids", "user_id": "user_ids", "union_id": "union_ids"}
+
+# 批量接口不可用（如没有权限）时记下原因，本进程之后直接逐个发送
+_batch_unavailable: Optional[str] = None
+
+
+def send_batch(targets: Dict[str, List[str]], card: PreparedCard) -> Tuple[feishu_delivery.SendOutcome, Set[str]]:
+    """
+    批量发送一次，返回 (结果, 无效的 ID)
 
-        if response.json().get("code") == 0:
-            print(f"✅ 消息发送成功 (user_id: {user_id})")
-            return True
+    Args:
+        targets: {"open_ids": [...], "user_ids": [...], "department_ids": [...]} 中的一项或多项
+    """
+    token = get_tenant_access_token()
+    if not token:
+        return feishu_delivery.SendOutcome(False, error="无法获取tenant_access_token", retryable=True), set()
+    outcome, data = _post(token, FEISHU_BATCH_SEND_URL, card.batch_body(targets))
+    invalid = set()
+    for field in targets:
+        invalid.update(data.get(f"invalid_{field}") or [])
+    return outcome, invalid
+
+
+def _plan_batches(user_ids: List[str], department_ids: List[str]) -> Tuple[List[Tuple[Dict[str, List[str]], List[str]]], List[str]]:
+    """
+    把接收人分成批量发送的分片和需要逐个发送的接收人
+
+    Returns:
+        ([(请求字段 -> ID 列表, 对应的接收人), ...], 逐个发送的接收人)
+    """
+    groups: Dict[str, List[Tuple[str, str]]] = {field: [] for field in BATCH_ID_FIELDS.values()}
+    individual = []
+    for recipient in user_ids:
+        receive_id, id_type = feishu_delivery.parse_recipient(recipient)
+        field = BATCH_ID_FIELDS.get(id_type or receive_id_types.get(receive_id))
+        if field:
+            groups[field].append((recipient, receive_id))
         else:
-            print(f"❌ 消息发送失败: {response.json()}")
-            return False
+            individual.append(recipient)
+
+    if sum(len(members) for members in groups.values()) < ALERT_BATCH_MIN and not department_ids:
+        return [], list(user_ids)
+
+    batches = []
+    for field, members in groups.items():
+        for start in range(0, len(members), FEISHU_BATCH_SIZE):
+            chunk = members[start:start + FEISHU_BATCH_SIZE]
+            batches.append(({field: [receive_id for _, receive_id in chunk]}, [recipient for recipient, _ in chunk]))
+    for start in range(0, len(department_ids), FEISHU_BATCH_SIZE):
+        chunk = department_ids[start:start + FEISHU_BATCH_SIZE]
+        batches.append(({"department_ids": chunk}, [f"department:{d}" for d in chunk]))
+    return batches, individual
+
+
+def send_alert(
+    user_ids: List[str],
+    content: str,
+    department_ids: Optional[List[str]] = None
+) -> feishu_delivery.DeliveryReport:
+    """
+    把同一条预警发送给多个用户 / 部门
 
-    except Exception as e:
-        print(f"❌ 发送消息异常: {e}")
-        return False
+    卡片只序列化一次。能确定 open_id / user_id / union_id 的用户（以及部门）按批量接口每 200 个一次请求发送，
+    批量接口不可用、整批失败或返回无效 ID 时，相应用户改为逐个并发发送（见 feishu_delivery 的 FEISHU_SEND_* 配置），
+    只有失败的请求会被重试。部门只能批量发送。返回每个接收人（部门为 "department:<id>"）的结果。
+    """
+    global _batch_unavailable
+    card = PreparedCard(build_alert_card(content))
+    started = time.monotonic()
+    user_ids = list(dict.fromkeys(user_ids))
+    department_ids = list(dict.fromkeys(department_ids or []))
+
+    results: Dict[str, feishu_delivery.DeliveryResult] = {}
+    batch_attempts: Dict[str, int] = {}
+    if ALERT_BATCH_SEND and _batch_unavailable is None:
+        batches, individual = _plan_batches(user_ids, department_ids)
+    else:
+        # 部门没有逐个发送的接口，始终走批量接口
+        batches, _ = _plan_batches([], department_ids)
+        individual = list(user_ids)
+
+    if batches:
+        invalid: Dict[str, Set[str]] = {}
+        keys = {f"batch-{i}": batch for i, batch in enumerate(batches)}
+
+        def send_chunk(key: str) -> feishu_delivery.SendOutcome:
+            outcome, invalid_ids = send_batch(keys[key][0], card)
+            invalid[key] = invalid_ids
+            return outcome
+
+        batch_report = feishu_delivery.deliver(list(keys), send_chunk)
+        for result in batch_report.results:
+            targets, recipients = keys[result.recipient]
+            receive_ids = next(iter(targets.values()))
+            for recipient, receive_id in zip(recipients, receive_ids):
+                batch_attempts[recipient] = result.attempts
+                is_department = recipient.startswith("department:")
+                if result.ok and receive_id not in invalid.get(result.recipient, ()):
+                    results[recipient] = result._replace(recipient=recipient)
+                elif is_department:
+                    error = "无效的部门 ID" if result.ok else result.error
+                    results[recipient] = result._replace(recipient=recipient, ok=False, error=error)
+                else:
+                    # 整批失败或 ID 无效：改为逐个发送，记住的类型可能已失效
+                    if result.ok:
+                        receive_id_types.forget(receive_id)
+                    individual.append(recipient)
+            # 飞书明确拒绝（如没有批量发送权限）时本进程不再尝试批量接口
+            if (not result.ok and result.code and not feishu_delivery.is_retryable(result.code)
+                    and result.code not in feishu_token.TOKEN_INVALID_CODES):
+                _batch_unavailable = f"{result.code} {result.error}"
+                print(f"⚠️  批量发送不可用，改为逐个发送: {_batch_unavailable}")
+
+    try:
+        if individual:
+            individual_report = feishu_delivery.deliver(individual, lambda user_id: send_card(user_id, card))
+            for result in individual_report.results:
+                results[result.recipient] = result._replace(
+                    attempts=result.attempts + batch_attempts.get(result.recipient, 0)
+                )
+    finally:
+        receive_id_types.save()
+    order = user_ids + [f"department:{d}" for d in department_ids]
+    return feishu_delivery.DeliveryReport([results[r] for r in order if r in results], time.monotonic() - started)
 
 
 def check_inventory_and_alert():
@@ -183,14 +412,28 @@ def check_inventory_and_alert():
     thresholds = config.get("gpu_thresholds", {})
     notification = config.get("notification", {})
     user_ids = notification.get("user_ids", [])
+    department_ids = notification.get("department_ids", [])
+    if user_ids == ["请填写飞书用户ID"]:
+        user_ids = []
 
-    if not user_ids or user_ids == ["请填写飞书用户ID"]:
+    if not user_ids and not department_ids:
         print("❌ 请先在配置文件中设置用户ID")
         return
 
     # 加载提醒历史
     history = load_alert_history()
 
+    # 取一份库存快照，所有阈值都在同一份快照上判断（一次 Grafana 查询）
+    with gpu_inventory.query_policy(budget=ALERT_QUERY_BUDGET, hedge=False):
+        cube = gpu_inventory.get_current_inventory_cube()
+    if len(cube) == 0:
+        print("❌ 无法获取库存数据，本次不检查")
+        return
+    data_time = gpu_inventory.get_inventory_data_time()
+    if data_time:
+        stale_note = "（旧数据）" if gpu_inventory.is_inventory_stale() else ""
+        print(f"📅 数据时间: {data_time.strftime('%Y-%m-%d %H:%M:%S')}{stale_note}")
+
     # 检查每种GPU的库存
     alerts = []
 
@@ -198,8 +441,7 @@ def check_inventory_and_alert():
         min_free = threshold_config["min_free"]
         description = threshold_config["description"]
 
-        # 查询库存
-        inventory = gpu_inventory.get_gpu_inventory_by_type(gpu_type)
+        inventory = cube.summarize_type(gpu_type)
 
         if not inventory:
             print(f"⚠️  {description} ({gpu_type}): 无库存数据")
@@ -248,14 +490,20 @@ def check_inventory_and_alert():
         message_lines.append(
             f"\n📅 检查时间：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
         )
+        if data_time:
+            message_lines.append(f"📅 数据时间：{data_time.strftime('%Y-%m-%d %H:%M:%S')}")
 
         message_content = "\n".join(message_lines)
 
-        # 发送给所有配置的用户
-        success_count = 0
-        for user_id in user_ids:
-            if send_feishu_message(user_id, message_content):
-                success_count += 1
+        # 并发发送给所有配置的用户
+        report = send_alert(user_ids, message_content, department_ids)
+        for result in report.results:
+            if result.ok:
+                print(f"  ✅ {result.recipient}（尝试 {result.attempts} 次）")
+            else:
+                print(f"  ❌ {result.recipient}（尝试 {result.attempts} 次）: {result.code} {result.error}")
+        success_count = len(report.succeeded)
+        print(f"  ⏱️  发送耗时 {report.elapsed:.2f} 秒")
 
         # 更新提醒历史
         if success_count > 0:
@@ -263,7 +511,7 @@ def check_inventory_and_alert():
             for alert in alerts:
                 history[alert['gpu_type']] = now
             save_alert_history(history)
-            print(f"\n✅ 提醒已发送给 {success_count}/{len(user_ids)} 个用户")
+            print(f"\n✅ 提醒已发送给 {success_count}/{len(report.results)} 个用户")
         else:
             print("\n❌ 消息发送失败")
     else:
@@ -287,6 +535,10 @@ def run_scheduled():
     print("📧 当库存不足时会自动发送飞书提醒")
     print("="*60)
 
+    if ALERT_METRICS_PORT:
+        metrics.start_metrics_server(ALERT_METRICS_PORT)
+        print(f"📈 Prometheus 指标: http://0.0.0.0:{ALERT_METRICS_PORT}/metrics")
+
     # 设置定时任务
     schedule.every().day.at(check_time).do(check_inventory_and_alert)
 
@@ -0,0 +1,281 @@
+"""
+GPU 库存变化事件
+比较相邻两份 (gpu_product_name, idc) 库存快照，产生类型化的变化事件并分发给订阅者，
+下游只需处理发生变化的部分，不必每次重新读取全部库存
+"""
+
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import gpu_inventory
+from gpu_inventory import GrafanaFrame, InventoryCube, get_inventory_cube
+
+# 后台比较线程最多积压的快照数，超过时丢弃新快照（下一份快照仍与当前基准比较，变化不会丢失）
+INVENTORY_EVENTS_QUEUE_SIZE = int(os.getenv("INVENTORY_EVENTS_QUEUE_SIZE", "100"))
+
+# 事件类型
+GPU_ADDED = "gpu_added"            # 新出现的 GPU 型号
+GPU_REMOVED = "gpu_removed"        # GPU 型号从快照中消失
+IDC_ADDED = "idc_added"            # 新出现的机房
+IDC_REMOVED = "idc_removed"        # 机房从快照中消失
+FREE_CHANGED = "free_changed"      # 某个 GPU 型号的空闲卡数变化
+LEVEL_CROSSED = "level_crossed"    # 空闲卡数穿过订阅的水位线
+
+EVENT_KINDS = (GPU_ADDED, GPU_REMOVED, IDC_ADDED, IDC_REMOVED, FREE_CHANGED, LEVEL_CROSSED)
+
+
+class InventoryEvent(NamedTuple):
+    """库存变化事件"""
+    kind: str
+    gpu: Optional[str] = None        # GPU 数据库名称；水位线事件为订阅时的 gpu_type
+    idc: Optional[str] = None
+    old: Optional[float] = None
+    new: Optional[float] = None
+    level: Optional[float] = None    # 仅 LEVEL_CROSSED
+    direction: Optional[str] = None  # 仅 LEVEL_CROSSED："down" 跌破 / "up" 恢复
+    region: Optional[str] = None
+    high_freq: Optional[bool] = None
+    ts: Optional[float] = None       # 新快照的查询时间
+
+
+class LevelWatch(NamedTuple):
+    """空闲卡数水位线"""
+    gpu_type: str
+    level: float
+    region: Optional[str] = None
+    high_freq: Optional[bool] = None
+
+
+def _free_by_gpu(cube: InventoryCube) -> Dict[str, float]:
+    free = gpu_inventory.INVENTORY_FIELDS.index("free")
+    values = cube.cells[:len(cube.gpus), cube.ALL, cube.ALL, free].tolist()
+    return dict(zip(cube.gpus.tolist(), values))
+
+
+def _watched_free(cube: InventoryCube, watch: LevelWatch) -> Optional[float]:
+    summary = cube.summarize_type(watch.gpu_type, watch.region, watch.high_freq)
+    return summary["free"] if summary else None
+
+
+def diff_inventory(
+    old: InventoryCube,
+    new: InventoryCube,
+    watches: Iterable[LevelWatch] = (),
+    ts: Optional[float] = None
+) -> List[InventoryEvent]:
+    """
+    比较两份库存立方体，返回变化事件
+
+    型号和空闲数的比较只涉及两份快照中的 GPU 型号数，机房比较只涉及机房数；
+    水位线按订阅逐条检查，没有数据的一侧按 0 处理。
+    """
+    events: List[InventoryEvent] = []
+
+    old_free = _free_by_gpu(old)
+    new_free = _free_by_gpu(new)
+    for gpu in new_free.keys() - old_free.keys():
+        events.append(InventoryEvent(GPU_ADDED, gpu=gpu, new=new_free[gpu], ts=ts))
+    for gpu in old_free.keys() - new_free.keys():
+        events.append(InventoryEvent(GPU_REMOVED, gpu=gpu, old=old_free[gpu], ts=ts))
+    for gpu in old_free.keys() & new_free.keys():
+        if old_free[gpu] != new_free[gpu]:
+            events.append(InventoryEvent(
+                FREE_CHANGED, gpu=gpu,
+                old=gpu_inventory._as_number(old_free[gpu]),
+                new=gpu_inventory._as_number(new_free[gpu]), ts=ts
+            ))
+
+    if old.has_idc and new.has_idc:
+        old_idcs = set(old.idc_names.tolist())
+        new_idcs = set(new.idc_names.tolist())
+        for idc in sorted(new_idcs - old_idcs):
+            events.append(InventoryEvent(IDC_ADDED, idc=idc, ts=ts))
+        for idc in sorted(old_idcs - new_idcs):
+            events.append(InventoryEvent(IDC_REMOVED, idc=idc, ts=ts))
+
+    for watch in watches:
+        before = _watched_free(old, watch) or 0
+        after = _watched_free(new, watch) or 0
+        if before >= watch.level > after:
+            direction = "down"
+        elif before < watch.level <= after:
+            direction = "up"
+        else:
+            continue
+        events.append(InventoryEvent(
+            LEVEL_CROSSED, gpu=watch.gpu_type, old=before, new=after, level=watch.level,
+            direction=direction, region=watch.region, high_freq=watch.high_freq, ts=ts
+        ))
+
+    return events
+
+
+class InventoryDiffer:
+    """
+    库存快照差异引擎
+
+    feed() 接收新快照，与上一份快照比较后把事件分发给订阅者；第一份快照只作为基准，不产生事件。
+    attach() 后每次 inventory_cache 刷新成功都会通过 submit() 交给后台线程调用 feed()，
+    比较和订阅回调不在刷新路径（持锁的同步刷新、事件循环）上执行；flush() 等待已提交的快照处理完。
+    订阅回调按事件逐条调用，可以只订阅部分事件类型；回调异常只打印，不影响其他订阅者。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._previous: Optional[InventoryCube] = None
+        self._previous_ts: Optional[float] = None
+        self._subscribers: List[Tuple[Callable[[InventoryEvent], None], Optional[frozenset]]] = []
+        self._watches: List[LevelWatch] = []
+        self._attached = False
+        self._queue: "queue.Queue" = queue.Queue(maxsize=INVENTORY_EVENTS_QUEUE_SIZE)
+        self._worker: Optional[threading.Thread] = None
+
+    def subscribe(
+        self,
+        callback: Callable[[InventoryEvent], None],
+        kinds: Optional[Iterable[str]] = None
+    ) -> Callable[[InventoryEvent], None]:
+        """
+        订阅变化事件
+
+        Args:
+            callback: 回调，参数为 InventoryEvent
+            kinds: 只接收这些类型的事件，None 表示全部
+        """
+        kinds = frozenset(kinds) if kinds is not None else None
+        if kinds is not None and not kinds <= set(EVENT_KINDS):
+            raise ValueError(f"未知的事件类型: {sorted(kinds - set(EVENT_KINDS))}")
+        with self._lock:
+            self._subscribers.append((callback, kinds))
+        return callback
+
+    def unsubscribe(self, callback: Callable[[InventoryEvent], None]):
+        """取消订阅"""
+        with self._lock:
+            self._subscribers = [item for item in self._subscribers if item[0] is not callback]
+
+    def watch_level(self, gpu_type: str, level: float, region: str = None, high_freq: bool = None) -> LevelWatch:
+        """订阅空闲卡数水位线，空闲数跌破或恢复到 level 时产生 LEVEL_CROSSED 事件"""
+        watch = LevelWatch(gpu_type, level, region, high_freq)
+        with self._lock:
+            if watch not in self._watches:
+                self._watches.append(watch)
+        return watch
+
+    def unwatch_level(self, watch: LevelWatch):
+        """取消水位线"""
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+    def feed(self, frame: GrafanaFrame, ts: Optional[float] = None) -> List[InventoryEvent]:
+        """输入一份新快照，返回并分发相对上一份快照的事件"""
+        cube = get_inventory_cube(frame)
+        ts = ts if ts is not None else time.time()
+        with self._lock:
+            previous = self._previous
+            if previous is cube:
+                return []
+            self._previous = cube
+            self._previous_ts = ts
+            watches = list(self._watches)
+            subscribers = list(self._subscribers)
+
+        if previous is None:
+            return []
+
+        events = diff_inventory(previous, cube, watches, ts)
+        for event in events:
+            for callback, kinds in subscribers:
+                if kinds is not None and event.kind not in kinds:
+                    continue
+                try:
+                    callback(event)
+                except Exception as e:
+                    print(f"库存事件回调失败: {e}")
+        return events
+
+    def submit(self, frame: GrafanaFrame, ts: Optional[float] = None):
+        """交给后台线程 feed() 一份快照，立即返回"""
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._feed_loop, name="inventory-events", daemon=True)
+                self._worker.start()
+        try:
+            self._queue.put_nowait((frame, ts))
+        except queue.Full:
+            print("库存事件处理积压，丢弃本次快照")
+
+    def _feed_loop(self):
+        while True:
+            frame, ts = self._queue.get()
+            try:
+                self.feed(frame, ts)
+            except Exception as e:
+                print(f"库存事件处理失败: {e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待 submit() 的快照处理完（包括订阅回调），超时返回 False"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def reset(self):
+        """丢弃基准快照，下一份快照重新作为基准"""
+        with self._lock:
+            self._previous = None
+            self._previous_ts = None
+
+    def attach(self, cache=None):
+        """挂到库存快照缓存上，刷新成功后在后台线程比较"""
+        cache = cache or gpu_inventory.inventory_cache
+        cache.add_listener(self.submit)
+        self._attached = True
+
+    def detach(self, cache=None):
+        """从库存快照缓存上取下"""
+        cache = cache or gpu_inventory.inventory_cache
+        cache.remove_listener(self.submit)
+        self._attached = False
+
+    @property
+    def baseline_ts(self) -> Optional[float]:
+        """当前基准快照的查询时间"""
+        with self._lock:
+            return self._previous_ts
+
+
+inventory_differ = InventoryDiffer()
+
+
+def subscribe(callback: Callable[[InventoryEvent], None], kinds: Optional[Iterable[str]] = None):
+    """
+    订阅库存变化事件（首次订阅时自动挂到 inventory_cache 上）
+
+    事件只在快照刷新时产生，需要配合 start_background_refresh() 或其他定期查询使用。
+    """
+    if not inventory_differ._attached:
+        inventory_differ.attach()
+    return inventory_differ.subscribe(callback, kinds)
+
+
+def unsubscribe(callback: Callable[[InventoryEvent], None]):
+    """取消订阅"""
+    inventory_differ.unsubscribe(callback)
+
+
+def watch_level(gpu_type: str, level: float, region: str = None, high_freq: bool = None) -> LevelWatch:
+    """订阅空闲卡数水位线，见 InventoryDiffer.watch_level"""
+    if not inventory_differ._attached:
+        inventory_differ.attach()
+    return inventory_differ.watch_level(gpu_type, level, region, high_freq)
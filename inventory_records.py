@@ -0,0 +1,106 @@
+"""
+库存记录类型
+库存汇总结果使用带 __slots__ 的只读记录，不为每行分配字典；
+同时保留 record["free"]、record.get("free", 0)、dict(record) 等字典式访问，现有调用方无需修改
+"""
+
+from typing import Any, Dict, Iterator, List, Tuple
+
+
+class InventoryRecord:
+    """
+    只读记录基类（字典兼容）
+
+    子类只需声明 __slots__，字段顺序即 __slots__ 顺序。
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        fields = self.__slots__
+        if len(args) > len(fields):
+            raise TypeError(f"{type(self).__name__} 最多 {len(fields)} 个字段")
+        values = dict(zip(fields, args))
+        for key, value in kwargs.items():
+            if key not in fields:
+                raise TypeError(f"{type(self).__name__} 没有字段 {key}")
+            values[key] = value
+        for field in fields:
+            object.__setattr__(self, field, values.get(field))
+
+    def __setattr__(self, name: str, value: Any):
+        raise AttributeError(f"{type(self).__name__} 是只读记录")
+
+    __delattr__ = __setattr__
+
+    # ---- 字典兼容 ----
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__slots__
+
+    def keys(self) -> Tuple[str, ...]:
+        return self.__slots__
+
+    def values(self) -> List[Any]:
+        return [getattr(self, field) for field in self.__slots__]
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return [(field, getattr(self, field)) for field in self.__slots__]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.__slots__)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为普通字典（如需 JSON 序列化或修改）"""
+        return dict(self.items())
+
+    def replace(self, **changes) -> "InventoryRecord":
+        """返回修改了部分字段的新记录"""
+        values = self.to_dict()
+        values.update(changes)
+        return type(self)(**values)
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, InventoryRecord):
+            return type(self) is type(other) and self.values() == other.values()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash((type(self), tuple(self.values())))
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+    def __reduce__(self):
+        return type(self), tuple(self.values())
+
+
+class GpuInventory(InventoryRecord):
+    """GPU 型号库存汇总（get_all_gpu_inventory / get_gpu_inventory_by_type）"""
+    __slots__ = ("name", "is_high_freq", "total", "free", "used", "unavailable")
+
+
+class IdcInventory(InventoryRecord):
+    """GPU 型号在单个机房的库存（get_gpu_inventory_by_region）"""
+    __slots__ = ("name", "idc", "is_overseas", "is_high_freq", "total", "free", "used")
+
+
+def to_dicts(records) -> List[Dict[str, Any]]:
+    """记录列表转换为字典列表"""
+    return [record.to_dict() if isinstance(record, InventoryRecord) else dict(record) for record in records]
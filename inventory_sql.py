@@ -0,0 +1,324 @@
+"""
+库存 SQL 构建
+把类型化的过滤条件转换为规范化、已转义的 nexus.nexus_nodes_v2 查询语句。
+同一"形状"（分组、排序、有哪些过滤条件）的语句模板只渲染一次，之后只替换字面量；
+等价的问题（如 "4090" 与 "RTX4090"）得到完全相同的 SQL 文本，可直接作为结果缓存的键
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from gpu_models import lookup_gpu_model
+
+INVENTORY_TABLE = "nexus.nexus_nodes_v2"
+
+# 有效节点的公共条件
+BASE_CONDITIONS = (
+    "(deleted_time IS NULL OR deleted_time = 0)",
+    "gpu_product_name != ''",
+)
+
+# 数值字段 -> 表中的列
+FIELD_COLUMNS = {
+    "total": "total_gpu_num",
+    "free": "free_gpu_num",
+    "used": "used_gpu_num",
+    "unavailable": "unavailable_gpu_num",
+}
+
+# 可分组的维度
+GROUP_DIMENSIONS = ("gpu_product_name", "idc", "region", "is_high_freq")
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# 模板中字面量的占位符，不会出现在已转义的 SQL 中
+_SLOT = "\x00"
+
+
+def sql_identifier(name: str) -> str:
+    """校验列名（只允许字母、数字、下划线）"""
+    if not _IDENTIFIER.match(name or ""):
+        raise ValueError(f"非法列名: {name}")
+    return name
+
+
+def sql_string(value: str) -> str:
+    """字符串字面量，转义反斜杠和单引号"""
+    escaped = str(value).replace("\\", "\\\\").replace("'", "''").replace(_SLOT, "")
+    return f"'{escaped}'"
+
+
+def sql_literal(value: Any) -> str:
+    """Python 值转换为 SQL 字面量"""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(int(value))
+    if isinstance(value, float):
+        return repr(float(value))
+    # NumPy 标量
+    if hasattr(value, "item"):
+        return sql_literal(value.item())
+    return sql_string(value)
+
+
+def like_contains(value: str) -> str:
+    """LIKE '%value%' 的模式，value 中的 % 和 _ 按普通字符匹配"""
+    escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def keyword_condition(column: str, keywords: Sequence[str]) -> str:
+    """将关键词列表转换为 SQL 条件：LOWER(column) LIKE '%kw1%' OR ..."""
+    if not keywords:
+        return "1 = 0"
+    return " OR ".join(
+        f"LOWER({column}) LIKE {sql_string(like_contains(keyword.lower()))}" for keyword in keywords
+    )
+
+
+class InventoryFilter(NamedTuple):
+    """规范化后的过滤条件"""
+    gpu: Optional[str] = None        # 精确匹配的 gpu_product_name
+    gpu_like: Optional[str] = None   # 模糊匹配（小写，不区分大小写）
+    region: Optional[str] = None     # "国内" / "海外"
+    high_freq: Optional[bool] = None
+    idc: Optional[str] = None
+    min_free: Optional[int] = None
+
+
+def make_filter(
+    gpu_type: str = None,
+    region: str = None,
+    high_freq: bool = None,
+    idc: str = None,
+    min_free: int = None
+) -> InventoryFilter:
+    """
+    把用户输入转换为规范化的过滤条件
+
+    已知 GPU 类型（任意别名）统一为数据库名称，未知类型转小写后做模糊匹配；
+    region 只接受 "国内" / "海外"，high_freq 只接受 True / False，其余值视为不过滤，
+    与快照查询的行为一致。
+    """
+    gpu = gpu_like = None
+    gpu_type = (gpu_type or "").strip()
+    if gpu_type:
+        model = lookup_gpu_model(gpu_type)
+        if model and model.db_name:
+            gpu = model.db_name
+        else:
+            gpu_like = gpu_type.lower()
+    return InventoryFilter(
+        gpu=gpu,
+        gpu_like=gpu_like,
+        region=region if region in ("国内", "海外") else None,
+        high_freq=high_freq if isinstance(high_freq, bool) else None,
+        idc=idc or None,
+        min_free=int(min_free) if min_free is not None else None,
+    )
+
+
+class InventoryQuery(NamedTuple):
+    """
+    库存查询
+
+    group_by 为空时按节点逐行返回，否则按给定维度 SUM 聚合；
+    after 为上一页最后一行的 (排序值, 节点主键)，只用于节点级 keyset 分页。
+    """
+    filter: InventoryFilter = InventoryFilter()
+    group_by: Tuple[str, ...] = ()
+    order_by: Optional[str] = None
+    descending: bool = True
+    limit: Optional[int] = None
+    after: Optional[Tuple[Any, Any]] = None
+
+
+class QueryBuilder:
+    """
+    SQL 构建器
+
+    render() 先按查询的形状（分组、排序、过滤条件种类、机房关键词、节点列配置）取模板，
+    模板中字面量位置留空，命中后只需把转义后的字面量拼进去。模板缓存有上限（LRU）。
+    """
+
+    def __init__(
+        self,
+        node_id_column: str = "id",
+        extra_columns: Sequence[str] = (),
+        cache_size: int = 256
+    ):
+        self.node_id_column = node_id_column
+        self.extra_columns = tuple(extra_columns)
+        self.cache_size = cache_size
+        self._templates: "OrderedDict[Tuple, List[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _shape(self, query: InventoryQuery, overseas: Tuple[str, ...], high_freq: Tuple[str, ...]) -> Tuple:
+        f = query.filter
+        return (
+            query.group_by,
+            f.gpu is not None,
+            f.gpu_like is not None,
+            f.region,
+            f.high_freq,
+            f.idc is not None,
+            f.min_free is not None,
+            query.order_by,
+            query.descending,
+            query.limit is not None,
+            query.after is not None,
+            # 只有用到关键词时才区分关键词
+            overseas if (f.region or "region" in query.group_by) else None,
+            high_freq if (f.high_freq is not None or "is_high_freq" in query.group_by) else None,
+            (self.node_id_column, self.extra_columns) if not query.group_by else None,
+        )
+
+    def _values(self, query: InventoryQuery) -> List[Any]:
+        """按模板中占位符的顺序排列的字面量"""
+        f = query.filter
+        values: List[Any] = []
+        if f.gpu is not None:
+            values.append(f.gpu)
+        if f.gpu_like is not None:
+            values.append(like_contains(f.gpu_like))
+        if f.idc is not None:
+            values.append(f.idc)
+        if f.min_free is not None:
+            values.append(f.min_free)
+        if query.after is not None:
+            if query.order_by == "id":
+                values.append(query.after[1])
+            else:
+                values.extend([query.after[0], query.after[0], query.after[1]])
+        if query.limit is not None:
+            values.append(int(query.limit))
+        return values
+
+    def _build_template(self, query: InventoryQuery, overseas: Sequence[str], high_freq: Sequence[str]) -> List[str]:
+        f = query.filter
+        region_expr = f"CASE WHEN {keyword_condition('idc', overseas)} THEN '海外' ELSE '国内' END"
+        high_freq_expr = f"CASE WHEN {keyword_condition('idc', high_freq)} THEN 1 ELSE 0 END"
+        dimension_exprs = {
+            "gpu_product_name": "gpu_product_name",
+            "idc": "idc",
+            "region": region_expr,
+            "is_high_freq": high_freq_expr,
+        }
+        node_id = sql_identifier(self.node_id_column)
+
+        conditions = list(BASE_CONDITIONS)
+        if f.gpu is not None:
+            conditions.append(f"gpu_product_name = {_SLOT}")
+        if f.gpu_like is not None:
+            conditions.append(f"gpu_product_name LIKE {_SLOT}")
+        if f.region == "海外":
+            conditions.append(f"({keyword_condition('idc', overseas)})")
+        elif f.region == "国内":
+            conditions.append(f"NOT ({keyword_condition('idc', overseas)})")
+        if f.high_freq is True:
+            conditions.append(f"({keyword_condition('idc', high_freq)})")
+        elif f.high_freq is False:
+            conditions.append(f"NOT ({keyword_condition('idc', high_freq)})")
+        if f.idc is not None:
+            conditions.append(f"idc = {_SLOT}")
+        if f.min_free is not None:
+            conditions.append(f"COALESCE(free_gpu_num, 0) >= {_SLOT}")
+
+        if query.group_by:
+            for dimension in query.group_by:
+                if dimension not in dimension_exprs:
+                    raise ValueError(f"不支持的分组维度: {dimension}")
+            columns = [
+                dimension if dimension_exprs[dimension] == dimension
+                else f"{dimension_exprs[dimension]} as {dimension}"
+                for dimension in query.group_by
+            ]
+            columns += [f"SUM({column}) as {field}" for field, column in FIELD_COLUMNS.items()]
+            # GROUP BY 中重复表达式而不是引用别名，避免与表中同名列冲突
+            group_clause = ", ".join(dimension_exprs[dimension] for dimension in query.group_by)
+            sort_exprs = {field: f"SUM({column})" for field, column in FIELD_COLUMNS.items()}
+        else:
+            columns = [f"{node_id} as node_id", "gpu_product_name", "idc"]
+            columns += [f"COALESCE({column}, 0) as {field}" for field, column in FIELD_COLUMNS.items()]
+            columns += [sql_identifier(column) for column in self.extra_columns]
+            group_clause = None
+            sort_exprs = {field: f"COALESCE({column}, 0)" for field, column in FIELD_COLUMNS.items()}
+
+        direction = "DESC" if query.descending else "ASC"
+        order_clause = None
+        if query.order_by == "id":
+            if query.group_by:
+                raise ValueError("聚合查询不能按节点主键排序")
+            order_clause = f"{node_id} {direction}"
+            if query.after is not None:
+                conditions.append(f"{node_id} {'<' if query.descending else '>'} {_SLOT}")
+        elif query.order_by is not None:
+            if query.order_by not in sort_exprs:
+                raise ValueError(f"不支持的排序字段: {query.order_by}")
+            expr = sort_exprs[query.order_by]
+            if query.group_by:
+                order_clause = f"{expr} {direction}"
+            else:
+                order_clause = f"{expr} {direction}, {node_id} ASC"
+            if query.after is not None:
+                if query.group_by:
+                    raise ValueError("keyset 分页只支持节点级查询")
+                compare = "<" if query.descending else ">"
+                conditions.append(
+                    f"({expr} {compare} {_SLOT} OR ({expr} = {_SLOT} AND {node_id} > {_SLOT}))"
+                )
+        elif query.after is not None:
+            raise ValueError("keyset 分页需要指定 order_by")
+
+        lines = ["SELECT", "    " + ",\n    ".join(columns), f"FROM {INVENTORY_TABLE}"]
+        lines.append("WHERE " + "\n  AND ".join(conditions))
+        if group_clause:
+            lines.append(f"GROUP BY {group_clause}")
+        if order_clause:
+            lines.append(f"ORDER BY {order_clause}")
+        if query.limit is not None:
+            lines.append(f"LIMIT {_SLOT}")
+        return "\n".join(lines).split(_SLOT)
+
+    def render(
+        self,
+        query: InventoryQuery,
+        overseas_keywords: Sequence[str] = (),
+        high_freq_keywords: Sequence[str] = ()
+    ) -> str:
+        """渲染规范化的 SQL 文本"""
+        overseas = tuple(overseas_keywords)
+        high_freq = tuple(high_freq_keywords)
+        shape = self._shape(query, overseas, high_freq)
+        with self._lock:
+            parts = self._templates.get(shape)
+            if parts is not None:
+                self._templates.move_to_end(shape)
+                self.hits += 1
+
+        if parts is None:
+            parts = self._build_template(query, overseas, high_freq)
+            with self._lock:
+                self.misses += 1
+                self._templates[shape] = parts
+                while len(self._templates) > self.cache_size:
+                    self._templates.popitem(last=False)
+
+        values = self._values(query)
+        sql = [parts[0]]
+        for literal, part in zip(values, parts[1:]):
+            sql.append(sql_literal(literal))
+            sql.append(part)
+        return "".join(sql)
+
+    def stats(self) -> Dict:
+        """模板缓存统计"""
+        with self._lock:
+            return {"templates": len(self._templates), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,255 @@
+"""
+GPU 库存快照本地存储
+把每次查询到的 (gpu_product_name, idc) 聚合快照写入 SQLite，支持按时间范围和粒度回溯，
+趋势类问题（如"过去 7 天 4090 的空闲卡数"）不需要再查 Grafana
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# 默认数据库文件
+INVENTORY_STORE_FILE = os.getenv("INVENTORY_HISTORY_DB", "inventory_history.db")
+
+# 快照保留天数，每次写入时删除更早的快照，0 表示不清理
+INVENTORY_HISTORY_RETENTION_DAYS = float(os.getenv("INVENTORY_HISTORY_RETENTION_DAYS", "30"))
+
+# 后台写线程最多积压的快照数，超过时丢弃新快照
+INVENTORY_HISTORY_QUEUE_SIZE = int(os.getenv("INVENTORY_HISTORY_QUEUE_SIZE", "100"))
+
+# 可查询的数值字段
+STORE_FIELDS = ("total", "free", "used", "unavailable")
+
+# 同一粒度内多个快照的合并方式
+STORE_AGGREGATES = {"avg": "AVG", "min": "MIN", "max": "MAX"}
+
+
+class InventoryStore:
+    """
+    库存快照存储（SQLite）
+
+    表以 (gpu, ts, idc) 为主键并使用 WITHOUT ROWID，数据按主键聚簇存放，
+    "某个 GPU 在某段时间内" 的查询只扫描主键上的一段连续区间，不需要回表；
+    ts 上的索引包含全部数值列，用于不限 GPU 的范围查询和过期清理。
+
+    append() 同步写入；submit() 交给后台写线程，供刷新路径（事件循环、持锁的刷新）使用。
+    设置了 retention_days 时每次写入顺带删除过期快照。
+    """
+
+    def __init__(self, path: str = INVENTORY_STORE_FILE, retention_days: float = INVENTORY_HISTORY_RETENTION_DAYS):
+        self.path = path
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue(maxsize=INVENTORY_HISTORY_QUEUE_SIZE)
+        self._writer: Optional[threading.Thread] = None
+        self._init_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS inventory_snapshots (
+                    ts INTEGER NOT NULL,
+                    gpu TEXT NOT NULL,
+                    idc TEXT NOT NULL,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    free INTEGER NOT NULL DEFAULT 0,
+                    used INTEGER NOT NULL DEFAULT 0,
+                    unavailable INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (gpu, ts, idc)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_inventory_snapshots_ts
+                ON inventory_snapshots (ts, gpu, idc, total, free, used, unavailable)
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def append(self, rows: Iterable[Tuple], ts: Optional[float] = None) -> int:
+        """
+        写入一次快照
+
+        Args:
+            rows: (gpu, idc, total, free, used, unavailable) 元组
+            ts: 快照时间（时间戳），默认当前时间
+
+        Returns:
+            写入的行数
+        """
+        ts = int(ts if ts is not None else time.time())
+        records = [
+            (ts, gpu or "", idc or "", total or 0, free or 0, used or 0, unavailable or 0)
+            for gpu, idc, total, free, used, unavailable in rows
+        ]
+        if not records:
+            return 0
+
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO inventory_snapshots
+                    (ts, gpu, idc, total, free, used, unavailable)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', records)
+                if self.retention_days:
+                    conn.execute(
+                        "DELETE FROM inventory_snapshots WHERE ts < ?",
+                        (int(ts - self.retention_days * 86400),)
+                    )
+                conn.commit()
+            finally:
+                conn.close()
+        return len(records)
+
+    def submit(self, rows: Callable[[], Iterable[Tuple]], ts: float):
+        """
+        交给后台写线程写入一次快照，立即返回
+
+        Args:
+            rows: 返回 (gpu, idc, total, free, used, unavailable) 元组的函数，在写线程中调用
+            ts: 快照时间（时间戳）
+        """
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="inventory-history-writer", daemon=True)
+                self._writer.start()
+        try:
+            self._queue.put_nowait((rows, ts))
+        except queue.Full:
+            print("库存历史写入积压，丢弃本次快照")
+
+    def _write_loop(self):
+        while True:
+            rows, ts = self._queue.get()
+            try:
+                self.append(rows(), ts=ts)
+            except Exception as e:
+                print(f"库存历史写入失败: {e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待 submit() 的快照写完，超时返回 False"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def query_range(
+        self,
+        gpu: Optional[str] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        resolution: int = 3600,
+        field: str = "free",
+        agg: str = "avg",
+        idcs: Optional[List[str]] = None,
+        gpu_like: bool = False
+    ) -> List[Dict]:
+        """
+        按时间粒度查询库存变化
+
+        每个快照先在 GPU/机房过滤后求和，再把同一粒度内的多个快照按 agg 合并
+
+        Args:
+            gpu: GPU 数据库名称，None 表示全部 GPU
+            start / end: 时间范围（时间戳），默认最近 7 天
+            resolution: 时间粒度（秒）
+            field: total / free / used / unavailable
+            agg: avg / min / max
+            idcs: 只统计这些机房，None 表示全部
+            gpu_like: gpu 按子串模糊匹配（不区分大小写）
+
+        Returns:
+            [{"ts": 粒度起始时间戳, "value": 数值, "samples": 快照数}, ...]
+        """
+        if field not in STORE_FIELDS:
+            raise ValueError(f"不支持的字段: {field}")
+        if agg not in STORE_AGGREGATES:
+            raise ValueError(f"不支持的聚合方式: {agg}")
+        resolution = max(int(resolution), 1)
+
+        end = int(end if end is not None else time.time())
+        start = int(start if start is not None else end - 7 * 86400)
+
+        conditions = ["ts >= ?", "ts <= ?"]
+        params: List = [start, end]
+        if gpu is not None:
+            if gpu_like:
+                conditions.append("gpu LIKE ?")
+                params.append(f"%{gpu}%")
+            else:
+                conditions.append("gpu = ?")
+                params.append(gpu)
+        if idcs is not None:
+            if not idcs:
+                return []
+            conditions.append(f"idc IN ({','.join('?' for _ in idcs)})")
+            params.extend(idcs)
+
+        sql = f'''
+            SELECT (ts / ?) * ? AS bucket, {STORE_AGGREGATES[agg]}(value), COUNT(*)
+            FROM (
+                SELECT ts, SUM({field}) AS value
+                FROM inventory_snapshots
+                WHERE {" AND ".join(conditions)}
+                GROUP BY ts
+            )
+            GROUP BY bucket
+            ORDER BY bucket
+        '''
+        conn = self._connect()
+        try:
+            cursor = conn.execute(sql, [resolution, resolution] + params)
+            return [
+                {"ts": bucket, "value": value, "samples": samples}
+                for bucket, value, samples in cursor.fetchall()
+            ]
+        finally:
+            conn.close()
+
+    def list_idcs(self, gpu: Optional[str] = None) -> List[str]:
+        """存储中出现过的机房"""
+        conn = self._connect()
+        try:
+            if gpu is None:
+                cursor = conn.execute("SELECT DISTINCT idc FROM inventory_snapshots")
+            else:
+                cursor = conn.execute("SELECT DISTINCT idc FROM inventory_snapshots WHERE gpu = ?", (gpu,))
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            conn.close()
+
+    def latest_ts(self) -> Optional[int]:
+        """最近一次快照时间"""
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT MAX(ts) FROM inventory_snapshots").fetchone()[0]
+        finally:
+            conn.close()
+
+    def prune(self, older_than: float) -> int:
+        """删除早于 older_than（时间戳）的快照，返回删除行数"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                cursor = conn.execute("DELETE FROM inventory_snapshots WHERE ts < ?", (int(older_than),))
+                conn.commit()
+                return cursor.rowcount
+            finally:
+                conn.close()
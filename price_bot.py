@@ -11,12 +11,14 @@ import logging
 import os
 from typing import Optional
 from fastapi import FastAPI, Request, Header
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 import uvicorn
 import httpx
 
 # 导入价格查询模块
 from price_query import handle_price_query
+from metrics import CONTENT_TYPE, render_metrics
+import feishu_token
 
 # 配置日志
 logging.basicConfig(
@@ -34,40 +36,39 @@ VERIFICATION_TOKEN = os.getenv("FEISHU_VERIFICATION_TOKEN", "")
 
 
 async def get_tenant_access_token() -> Optional[str]:
-    """获取飞书 tenant_access_token"""
-    url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal"
-    payload = {
-        "app_id": APP_ID,
-        "app_secret": APP_SECRET
-    }
+    """获取飞书 tenant_access_token（进程内缓存，过期前后台刷新）"""
+    return await feishu_token.get_tenant_access_token_async(APP_ID, APP_SECRET)
 
-    try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            response = await client.post(url, json=payload)
-            result = response.json()
 
-            if result.get("code") == 0:
-                return result.get("tenant_access_token")
-            else:
-                logger.error(f"获取 token 失败: {result}")
-                return None
-    except Exception as e:
-        logger.error(f"获取 token 异常: {str(e)}")
-        return None
+async def _post_message(payload: dict) -> Optional[dict]:
+    """
+    发送消息到飞书群聊，返回飞书的响应；获取不到 token 时返回 None
+
+    token 失效（feishu_token.TOKEN_INVALID_CODES）时丢弃缓存的 token，重新获取后重试一次。
+    """
+    url = "https://open.feishu.cn/open-apis/im/v1/messages?receive_id_type=chat_id"
+    result = None
+    for attempt in range(2):
+        token = await get_tenant_access_token()
+        if not token:
+            return None
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        }
+        async with httpx.AsyncClient(timeout=30) as client:
+            response = await client.post(url, headers=headers, json=payload)
+            result = response.json()
+        if result.get("code") not in feishu_token.TOKEN_INVALID_CODES:
+            break
+        feishu_token.invalidate_tenant_access_token(APP_ID, APP_SECRET, token)
+        if attempt == 0:
+            logger.warning(f"tenant_access_token 已失效，重新获取后重试: {result.get('msg')}")
+    return result
 
 
 async def send_text_message(chat_id: str, text: str) -> bool:
     """发送文本消息到飞书群聊"""
-    token = await get_tenant_access_token()
-    if not token:
-        return False
-
-    url = "https://open.feishu.cn/open-apis/im/v1/messages?receive_id_type=chat_id"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-
     payload = {
         "receive_id": chat_id,
         "msg_type": "text",
@@ -75,16 +76,16 @@ async def send_text_message(chat_id: str, text: str) -> bool:
     }
 
     try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.post(url, headers=headers, json=payload)
-            result = response.json()
+        result = await _post_message(payload)
+        if result is None:
+            return False
 
-            if result.get("code") == 0:
-                logger.info(f"消息已发送: {chat_id}")
-                return True
-            else:
-                logger.error(f"发送消息失败: {result}")
-                return False
+        if result.get("code") == 0:
+            logger.info(f"消息已发送: {chat_id}")
+            return True
+        else:
+            logger.error(f"发送消息失败: {result}")
+            return False
     except Exception as e:
         logger.error(f"发送消息异常: {str(e)}")
         return False
@@ -92,16 +93,6 @@ async def send_text_message(chat_id: str, text: str) -> bool:
 
 async def send_card_message(chat_id: str, title: str, content: str) -> bool:
     """发送卡片消息到飞书群聊"""
-    token = await get_tenant_access_token()
-    if not token:
-        return False
-
-    url = "https://open.feishu.cn/open-apis/im/v1/messages?receive_id_type=chat_id"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-
     # 构建卡片内容
     card = {
         "config": {"wide_screen_mode": True},
@@ -124,16 +115,16 @@ async def send_card_message(chat_id: str, title: str, content: str) -> bool:
     }
 
     try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.post(url, headers=headers, json=payload)
-            result = response.json()
+        result = await _post_message(payload)
+        if result is None:
+            return False
 
-            if result.get("code") == 0:
-                logger.info(f"卡片消息已发送: {chat_id}")
-                return True
-            else:
-                logger.error(f"发送卡片失败: {result}")
-                return False
+        if result.get("code") == 0:
+            logger.info(f"卡片消息已发送: {chat_id}")
+            return True
+        else:
+            logger.error(f"发送卡片失败: {result}")
+            return False
     except Exception as e:
         logger.error(f"发送卡片异常: {str(e)}")
         return False
@@ -267,6 +258,12 @@ async def health():
     return JSONResponse(content={"status": "ok", "service": "Price Bot"})
 
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 指标"""
+    return Response(content=render_metrics(), headers={"Content-Type": CONTENT_TYPE})
+
+
 @app.get("/")
 async def root():
     """根路径"""
@@ -275,7 +272,8 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "webhook": "/webhook",
-            "health": "/health"
+            "health": "/health",
+            "metrics": "/metrics"
         }
     })
 
@@ -12,6 +12,8 @@ from typing import Optional, Dict, List
 from openai import OpenAI
 import os
 
+from gpu_models import match_gpu_model
+
 logger = logging.getLogger(__name__)
 
 # CMDB API 配置
@@ -154,37 +156,9 @@ def parse_price_query(text: str) -> Optional[str]:
     Returns:
         GPU 型号，如 "A100", "H100", "4090" 等，找不到返回 None
     """
-    text_upper = text.upper()
-
-    # GPU 型号列表
-    gpu_types = [
-        "A100", "A100-80GB", "A100-40GB",
-        "H100", "H100-80GB",
-        "H200", "H200-141GB",
-        "H20",
-        "L40S", "L40",
-        "RTX4090", "4090",
-        "RTX3090", "3090",
-        "RTX5090", "5090",
-        "A6000", "6000",
-        "A800",
-        "V100"
-    ]
-
-    for gpu in gpu_types:
-        if gpu in text_upper:
-            # 标准化返回格式
-            if "4090" in gpu:
-                return "RTX4090"
-            elif "3090" in gpu:
-                return "RTX3090"
-            elif "5090" in gpu:
-                return "RTX5090"
-            elif "6000" in gpu:
-                return "A6000"
-            else:
-                return gpu
-
+    model = match_gpu_model(text)
+    if model:
+        return model.price_name
     return None
 
 